@@ -0,0 +1,82 @@
+import asyncio
+import json
+
+import pytest
+
+from viv_pay.admission import AdmissionController, Overloaded
+
+
+def test_admission_queues_then_sheds():
+    async def scenario():
+        admission = AdmissionController(max_concurrent=1, max_queue=1, queue_timeout=1.0)
+        release = asyncio.Event()
+        order = []
+
+        async def job(name):
+            async with admission.admit():
+                order.append(name)
+                await release.wait()
+
+        first = asyncio.create_task(job("first"))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(job("second"))
+        await asyncio.sleep(0)
+        assert admission.stats()["in_flight"] == 1
+        assert admission.stats()["queued"] == 1
+
+        with pytest.raises(Overloaded):
+            await job("third")
+
+        release.set()
+        await asyncio.gather(first, second)
+        return admission, order
+
+    admission, order = asyncio.run(scenario())
+    assert order == ["first", "second"]
+    stats = admission.stats()
+    assert stats == {
+        "in_flight": 0,
+        "queued": 0,
+        "admitted": 2,
+        "shed": 1,
+        "max_concurrent": 1,
+        "max_queue": 1,
+    }
+
+
+def test_admission_queue_timeout_sheds():
+    async def scenario():
+        admission = AdmissionController(max_concurrent=1, max_queue=5, queue_timeout=0.01)
+        hold = asyncio.Event()
+
+        async def holder():
+            async with admission.admit():
+                await hold.wait()
+
+        task = asyncio.create_task(holder())
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded) as exc_info:
+            async with admission.admit():
+                pass
+        hold.set()
+        await task
+        return admission, exc_info.value
+
+    admission, exc = asyncio.run(scenario())
+    assert exc.retry_after == 30
+    assert admission.queued == 0
+    assert admission.in_flight == 0
+
+
+def test_webhook_endpoint_returns_503_when_overloaded(app_with_pay, client):
+    admission = app_with_pay[0].state.pay_webhook_admission
+    admission.max_concurrent = 0
+    admission.max_queue = 0
+
+    resp = client.post(
+        "/pay/webhook",
+        content=json.dumps({"type": "customer.created", "data": {"object": {}}}),
+    )
+    assert resp.status_code == 503
+    assert resp.headers["retry-after"] == "30"
+    assert admission.stats()["shed"] == 1
@@ -0,0 +1,88 @@
+from datetime import timedelta
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+from viv_pay.archive import PaymentArchive, create_payment_archiver
+from viv_pay.models import create_pay_models, utcnow
+
+
+def _setup(tmp_path):
+    engine = create_engine("sqlite:///:memory:")
+    Base = declarative_base()
+    StripeCustomer, _, Payment = create_pay_models(Base)
+    Base.metadata.create_all(bind=engine)
+    SessionLocal = sessionmaker(bind=engine)
+
+    def get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    db = SessionLocal()
+    customer = StripeCustomer(user_id=1, email="a@example.com", stripe_customer_id="cus_1")
+    db.add(customer)
+    db.commit()
+    now = utcnow()
+    for i in range(10):
+        db.add(
+            Payment(
+                customer_id=customer.id,
+                stripe_session_id=f"cs_{i}",
+                stripe_payment_intent_id=f"pi_{i}",
+                amount_cents=100 * i,
+                status="completed",
+                created_at=now - timedelta(days=800 if i < 7 else 1),
+            )
+        )
+    db.commit()
+    db.close()
+    return get_db, SessionLocal, Payment, PaymentArchive(tmp_path / "archive")
+
+
+def test_archive_moves_old_rows_out_of_hot_table(tmp_path):
+    get_db, SessionLocal, Payment, archive = _setup(tmp_path)
+    run_archive = create_payment_archiver(
+        get_db, Payment, archive, archive_after_days=365, batch_size=3
+    )
+
+    assert run_archive() == 7
+    assert len(archive.chunks()) == 3
+
+    db = SessionLocal()
+    remaining = sorted(p.stripe_session_id for p in db.query(Payment).all())
+    db.close()
+    assert remaining == ["cs_7", "cs_8", "cs_9"]
+
+    scanned = list(archive.iter_rows())
+    assert [r["stripe_session_id"] for r in scanned] == [f"cs_{i}" for i in range(7)]
+    assert scanned[3]["amount_cents"] == 300
+
+    # Nothing left to move
+    assert run_archive() == 0
+
+
+def test_archive_lookup_by_stripe_ids(tmp_path):
+    get_db, _, Payment, archive = _setup(tmp_path)
+    create_payment_archiver(get_db, Payment, archive, batch_size=4)()
+
+    row = archive.find(stripe_session_id="cs_5")
+    assert row["stripe_payment_intent_id"] == "pi_5"
+    assert archive.find(stripe_payment_intent_id="pi_2")["stripe_session_id"] == "cs_2"
+    assert archive.find(stripe_session_id="cs_9") is None
+
+    # A fresh reader rebuilds the lookup from the sidecar files
+    reopened = PaymentArchive(archive.directory)
+    assert reopened.find(stripe_session_id="cs_0")["amount_cents"] == 0
+
+
+def test_archive_retention_purges_old_chunks(tmp_path):
+    get_db, _, Payment, archive = _setup(tmp_path)
+    run_archive = create_payment_archiver(
+        get_db, Payment, archive, archive_after_days=365, retention_days=700
+    )
+    run_archive()
+    assert archive.chunks() == []
+    assert archive.find(stripe_session_id="cs_1") is None
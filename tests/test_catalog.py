@@ -0,0 +1,207 @@
+import json
+import time
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from viv_pay import init_pay
+from viv_pay.catalog import InvalidPrice, PriceCatalog
+from viv_pay.config import PayConfig
+from viv_pay.models import create_catalog_models
+from viv_pay.storage import SQLAlchemyStore
+
+
+def _product(product_id, name, active=True):
+    return {"id": product_id, "object": "product", "name": name, "active": active}
+
+
+def _price(price_id, product_id, amount, interval="month", active=True):
+    return {
+        "id": price_id,
+        "object": "price",
+        "product": product_id,
+        "active": active,
+        "currency": "usd",
+        "unit_amount": amount,
+        "type": "recurring" if interval else "one_time",
+        "recurring": {"interval": interval, "interval_count": 1} if interval else None,
+    }
+
+
+class FakeStripeCatalog:
+    def __init__(self, products, prices):
+        self.objects = {"product": products, "price": prices}
+
+    def __call__(self, kind):
+        return list(self.objects[kind])
+
+
+@pytest.fixture
+def catalog(db_setup):
+    engine, Base, get_db, _ = db_setup
+    PayProduct, PayPrice = create_catalog_models(Base)
+    Base.metadata.create_all(bind=engine)
+    stripe_catalog = FakeStripeCatalog(
+        [_product("prod_pro", "Pro"), _product("prod_old", "Legacy", active=False)],
+        [
+            _price("price_pro_month", "prod_pro", 2000),
+            _price("price_pro_year", "prod_pro", 20000, interval="year"),
+            _price("price_credits", "prod_pro", 500, interval=None),
+            _price("price_archived", "prod_pro", 1500, active=False),
+            _price("price_legacy", "prod_old", 1000),
+        ],
+    )
+    store = SQLAlchemyStore(get_db, None, None, None)
+    catalog = PriceCatalog(store, PayProduct, PayPrice, list_objects=stripe_catalog)
+    return catalog, stripe_catalog
+
+
+def test_sync_builds_index_and_checks_prices(catalog):
+    catalog, stripe_catalog = catalog
+    catalog.check("price_typo")  # nothing synced yet: not ours to reject
+
+    assert catalog.sync() == 5
+    catalog.check("price_pro_month", "subscription")
+    catalog.check("price_credits", "payment")
+    for price_id, mode, message in [
+        ("price_typo", "subscription", "unknown price"),
+        ("price_archived", "subscription", "inactive price"),
+        ("price_legacy", "subscription", "inactive price"),  # product archived
+        ("price_credits", "subscription", "one_time"),
+        ("price_pro_month", "payment", "recurring"),
+    ]:
+        with pytest.raises(InvalidPrice, match=message):
+            catalog.check(price_id, mode)
+
+    body, etag = catalog.prices_response()
+    prices = json.loads(body)["prices"]
+    assert [p["id"] for p in prices] == ["price_credits", "price_pro_month", "price_pro_year"]
+    assert prices[1]["product"]["name"] == "Pro"
+    assert prices[1]["interval"] == "month"
+
+    # Deleted in Stripe without an event: the next sync deactivates it
+    stripe_catalog.objects["price"] = stripe_catalog.objects["price"][1:]
+    catalog.sync()
+    with pytest.raises(InvalidPrice, match="inactive"):
+        catalog.check("price_pro_month")
+    assert catalog.prices_response()[1] != etag
+
+
+def test_events_apply_in_order_and_reload_only_on_change(catalog):
+    catalog, _ = catalog
+    catalog.sync()
+    loads = catalog.stats["loads"]
+    assert catalog.load(if_changed=True) == 3
+    assert catalog.stats["loads"] == loads
+
+    future = 2**31 - 1
+    assert catalog.apply_event("price.deleted", _price("price_pro_year", "prod_pro", 20000), future)
+    assert not catalog.apply_event(
+        "price.updated", _price("price_pro_year", "prod_pro", 20000), future - 10
+    )
+    assert catalog.stats["stale_events"] == 1
+    with pytest.raises(InvalidPrice, match="inactive"):
+        catalog.check("price_pro_year")
+
+    catalog.apply_event("product.created", _product("prod_team", "Team"))
+    catalog.apply_event("price.created", _price("price_team", "prod_team", 5000))
+    catalog.check("price_team")
+    assert catalog.stats_snapshot()["offered"] == 3
+
+
+def test_sync_keeps_events_applied_during_the_listing(catalog):
+    catalog, stripe_catalog = catalog
+    catalog.sync()
+
+    def listing(kind):
+        objects = stripe_catalog(kind)
+        if kind == "price":
+            # Archived in Stripe after the page with it was fetched
+            archived = _price("price_pro_month", "prod_pro", 2000, active=False)
+            catalog.apply_event("price.updated", archived, int(time.time()) + 5)
+        return objects
+
+    catalog._list_objects = listing
+    catalog.sync()
+    with pytest.raises(InvalidPrice, match="inactive"):
+        catalog.check("price_pro_month")
+
+
+def test_sync_deactivates_a_large_unlisted_catalog_in_chunks(catalog, db_setup):
+    from sqlalchemy import event
+
+    import viv_pay.catalog
+
+    catalog, stripe_catalog = catalog
+    engine = db_setup[0]
+    stripe_catalog.objects["price"] = [
+        _price(f"price_{n}", "prod_pro", 100 + n) for n in range(1200)
+    ]
+    catalog.sync()
+    stripe_catalog.objects["price"] = []
+    updates = []
+    event.listen(
+        engine,
+        "before_cursor_execute",
+        lambda conn, cursor, sql, params, *args: updates.append(len(params))
+        if sql.lstrip().startswith("UPDATE pay_prices") else None,
+    )
+    catalog.sync()
+    assert max(updates) <= viv_pay.catalog.DEACTIVATE_CHUNK + 3
+    assert len(updates) == 3
+    assert catalog.stats_snapshot()["offered"] == 0
+
+
+def test_catalog_writes_go_through_the_sqlite_writer(db_setup):
+    from viv_pay.sqlite import SQLiteWriter
+
+    engine, Base, get_db, _ = db_setup
+    PayProduct, PayPrice = create_catalog_models(Base)
+    Base.metadata.create_all(bind=engine)
+    writer = SQLiteWriter(get_db)
+    store = SQLAlchemyStore(get_db, None, None, None, writer=writer)
+    stripe_catalog = FakeStripeCatalog(
+        [_product("prod_pro", "Pro")], [_price("price_pro", "prod_pro", 2000)]
+    )
+    catalog = PriceCatalog(store, PayProduct, PayPrice, list_objects=stripe_catalog)
+    catalog.sync()
+    catalog.apply_event("price.created", _price("price_team", "prod_pro", 5000))
+    writer.close()
+    assert writer.stats["writes"] == 2
+    assert catalog.stats_snapshot()["offered"] == 2
+
+
+def _webhook(client, event_type, obj):
+    event = {"id": f"evt_{obj['id']}", "type": event_type, "data": {"object": obj}}
+    return client.post("/pay/webhook", content=json.dumps(event))
+
+
+def test_init_pay_serves_prices_and_validates_checkout(db_setup):
+    engine, Base, get_db, _ = db_setup
+    app = FastAPI()
+    init_pay(app, engine, Base, get_db, config=PayConfig(price_catalog=True))
+    assert "catalog.sync" in app.state.pay_scheduler.jobs
+
+    with TestClient(app) as client:
+        assert _webhook(client, "product.created", _product("prod_pro", "Pro")).status_code == 200
+        _webhook(client, "price.created", _price("price_pro", "prod_pro", 2000))
+
+        resp = client.get("/pay/prices")
+        assert resp.status_code == 200
+        assert [p["id"] for p in resp.json()["prices"]] == ["price_pro"]
+        assert resp.headers["cache-control"] == "public, max-age=60"
+        etag = resp.headers["etag"]
+        resp = client.get("/pay/prices", headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+
+        checkout = {"user_id": 1, "email": "a@example.com"}
+        resp = client.post("/pay/checkout", content=json.dumps(dict(checkout, price_id="price_typo")))
+        assert resp.status_code == 400
+        assert "unknown price" in resp.json()["error"]
+        with app.state.pay_store.session() as db:
+            assert app.state.pay_store.get_customer(db, 1) is None
+
+        resp = client.post("/pay/checkout", content=json.dumps(dict(checkout, price_id="price_pro")))
+        assert resp.status_code == 200
+        assert client.get("/pay/health/deep").json()["catalog"]["rejected"] == 1
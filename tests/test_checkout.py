@@ -67,3 +67,31 @@ def test_checkout_payment_mode(client):
     )
     assert resp.status_code == 200
     assert "url" in resp.json()
+
+
+def test_checkout_and_portal_run_off_the_event_loop(db_setup):
+    import threading
+
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+
+    from viv_pay import init_pay
+    from viv_pay.storage import MemoryStore
+
+    class ThreadRecordingStore(MemoryStore):
+        def get_customer(self, db, user_id):
+            threads.append(threading.current_thread().name)
+            return super().get_customer(db, user_id)
+
+    threads = []
+    engine, Base, get_db, _ = db_setup
+    app = FastAPI()
+    init_pay(app, engine, Base, get_db, store=ThreadRecordingStore())
+
+    with TestClient(app) as client:
+        loop_thread = client.portal.call(lambda: threading.current_thread().name)
+        checkout = {"user_id": 7, "email": "t@example.com", "price_id": "price_x"}
+        assert client.post("/pay/checkout", content=json.dumps(checkout)).status_code == 200
+        assert client.post("/pay/portal", content=json.dumps({"user_id": 7})).status_code == 200
+    assert len(threads) == 2
+    assert loop_thread not in threads
@@ -0,0 +1,112 @@
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from viv_pay.customer import create_customer_helpers
+from viv_pay.customer_cache import CachedCustomer, CustomerIdCache
+from viv_pay.models import create_pay_models
+from viv_pay.storage import SQLAlchemyStore
+
+
+def _store(cache):
+    engine = create_engine(
+        "sqlite:///:memory:",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    Base = declarative_base()
+    models = create_pay_models(Base)
+    Base.metadata.create_all(bind=engine)
+    SessionLocal = sessionmaker(bind=engine)
+    queries = []
+    event.listen(engine, "before_cursor_execute", lambda *args: queries.append(args[2]))
+
+    def get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    return SQLAlchemyStore(get_db, *models, customer_cache=cache), queries
+
+
+def test_cache_maps_all_three_ids_and_evicts_oldest():
+    cache = CustomerIdCache(max_entries=2)
+    cache.put(1, 10, "cus_a", "a@example.com")
+    cache.put(2, 20, "cus_b", "b@example.com")
+    assert cache.by_stripe_id("cus_a").user_id == 10
+    assert cache.by_id(2).stripe_customer_id == "cus_b"
+
+    cache.put(3, 30, "cus_c", "c@example.com")
+    assert cache.by_user_id(10) is None
+    assert cache.by_stripe_id("cus_a") is None
+    assert cache.by_id(1) is None
+    stats = cache.stats()
+    assert (stats["entries"], stats["evictions"]) == (2, 1)
+    assert stats["approx_bytes"] > 0
+
+
+def test_forget_drops_all_three_ids():
+    cache = CustomerIdCache()
+    cache.put(1, 10, "cus_a", "a@example.com")
+    assert cache.forget(10)
+    assert not cache.forget(10)
+    assert (cache.by_user_id(10), cache.by_stripe_id("cus_a"), cache.by_id(1)) == (None,) * 3
+    assert cache.stats()["entries"] == 0
+
+
+def test_init_pay_leaves_the_cache_off_by_default(db_setup):
+    from fastapi import FastAPI
+
+    from viv_pay import init_pay
+
+    engine, Base, get_db, _ = db_setup
+    app = FastAPI()
+    _, get_customer, _ = init_pay(app, engine, Base, get_db)
+    assert not hasattr(app.state, "pay_customer_cache")
+    with app.state.pay_store.session() as db:
+        app.state.pay_store.add_customer(db, 1, "a@example.com", "cus_1")
+        db.commit()
+    customer = get_customer(1)
+    assert not isinstance(customer, CachedCustomer)
+    assert customer.created_at is not None
+
+
+def test_store_lookups_skip_db_once_cached():
+    store, queries = _store(CustomerIdCache())
+    _, get_or_create_customer = create_customer_helpers(store)
+
+    with store.session() as db:
+        get_or_create_customer(db, 5, "e@example.com")
+
+    queries.clear()
+    with store.session() as db:
+        by_user = store.get_customer(db, 5)
+        by_stripe = store.get_customer_by_stripe_id(db, "cus_dev_5")
+        by_id = store.get_customer_by_id(db, by_user.id)
+    assert queries == []
+    assert isinstance(by_stripe, CachedCustomer)
+    assert by_user is by_stripe is by_id
+
+
+def test_warm_load_in_chunks_respects_cap():
+    cache = CustomerIdCache(max_entries=7)
+    store, queries = _store(cache)
+    with store.session() as db:
+        store.add_customers(db, [
+            {"user_id": i, "email": f"u{i}@example.com", "stripe_customer_id": f"cus_{i}"}
+            for i in range(1, 11)
+        ])
+        store.commit(db)
+
+    queries.clear()
+    assert store.warm_customer_cache(chunk_size=3) == 7
+    assert len([q for q in queries if q.lstrip().upper().startswith("SELECT")]) == 3
+    assert cache.by_stripe_id("cus_7").user_id == 7
+    assert cache.by_user_id(8) is None
+
+    # Misses still fall through to the DB and are cached
+    with store.session() as db:
+        assert store.get_customer(db, 9).stripe_customer_id == "cus_9"
+    assert cache.stats()["evictions"] == 1
@@ -0,0 +1,74 @@
+import pytest
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+
+from viv_pay import PayConfig, init_pay
+from viv_pay.entitlements import FeatureMap
+from viv_pay.storage import MemoryStore
+
+PRICE_FEATURES = {
+    "price_basic": {"reports"},
+    "price_pro": {"reports", "exports"},
+    "price_addon_api": {"api"},
+}
+
+
+def test_feature_map_compiles_bitmasks():
+    fmap = FeatureMap(PRICE_FEATURES)
+    assert set(fmap.bits) == {"api", "exports", "reports"}
+    assert len(set(fmap.bits.values())) == 3
+
+    mask = fmap.mask_for_prices(["price_basic", "price_addon_api"])
+    assert mask & fmap.bit("reports")
+    assert mask & fmap.bit("api")
+    assert not mask & fmap.bit("exports")
+    assert fmap.features(mask) == {"reports", "api"}
+    assert fmap.mask_for_prices(["price_unknown"]) == 0
+
+    with pytest.raises(ValueError):
+        fmap.bit("nope")
+
+
+def test_require_feature_gates_by_price(db_setup, monkeypatch):
+    import viv_pay.entitlements as entitlements
+
+    engine, Base, get_db, _ = db_setup
+    store = MemoryStore()
+    app = FastAPI()
+    pay = init_pay(
+        app, engine, Base, get_db,
+        config=PayConfig(price_features=PRICE_FEATURES),
+        store=store,
+    )
+
+    @app.get("/api/exports", dependencies=[Depends(pay.require_feature("exports"))])
+    async def exports():
+        return {"ok": True}
+
+    @app.get("/api/api-access")
+    async def api_access(mask=Depends(pay.require_feature("api"))):
+        return {"features": sorted(pay.feature_map.features(mask))}
+
+    with pytest.raises(ValueError):
+        pay.require_feature("unknown")
+
+    customer = store.add_customer(None, 1, "a@example.com", "cus_1")
+    store.add_subscription(None, customer.id, "sub_basic", "price_basic", "active")
+    store.add_subscription(None, customer.id, "sub_api", "price_addon_api", "active")
+    store.add_subscription(None, customer.id, "sub_old", "price_pro", "canceled")
+
+    monkeypatch.setattr(entitlements, "is_dev_mode", lambda: False)
+    client = TestClient(app)
+
+    assert client.get("/api/exports?user_id=1").status_code == 403
+    assert client.get("/api/api-access?user_id=1").json() == {"features": ["api", "reports"]}
+    assert client.get("/api/api-access?user_id=2").status_code == 403
+
+    store.update_subscription(None, store.subscriptions["sub_old"], status="active")
+    assert client.get("/api/exports?user_id=1").status_code == 200
+
+
+def test_init_pay_still_unpacks_three(app_with_pay):
+    _, create_checkout, get_customer, require_subscription, _, _ = app_with_pay
+    assert callable(create_checkout) and callable(get_customer)
+    assert callable(require_subscription)
@@ -0,0 +1,216 @@
+import threading
+import time
+
+import pytest
+
+from viv_pay.config import PayConfig
+from viv_pay.gateway import StripeGateway, StripeUnavailable
+from viv_pay.ratelimit import FairLimiter, RetryBudget, TokenBucket
+
+
+class FakeStripeError(Exception):
+    def __init__(self, http_status, headers=None, code=None):
+        super().__init__(f"HTTP {http_status}")
+        self.http_status = http_status
+        self.headers = headers or {}
+        self.code = code
+
+
+def _config(**overrides):
+    defaults = dict(
+        stripe_global_rate=(1000.0, 1000),
+        stripe_default_rate=(1000.0, 1000),
+        stripe_retry_base_delay=0.001,
+        stripe_retry_max_delay=0.01,
+    )
+    defaults.update(overrides)
+    return PayConfig(**defaults)
+
+
+def test_token_bucket_refills_over_time():
+    now = [0.0]
+    bucket = TokenBucket(rate=2.0, burst=1, clock=lambda: now[0])
+    assert bucket.wait_time() == 0
+    bucket.take()
+    assert bucket.wait_time() == pytest.approx(0.5)
+    now[0] = 0.5
+    assert bucket.wait_time() == 0
+
+
+def test_retry_budget_caps_retries():
+    budget = RetryBudget(ratio=0.5, min_reserve=2)
+    assert budget.withdraw()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    budget.deposit()
+    budget.deposit()
+    assert budget.withdraw()
+
+
+def test_gateway_retries_429_then_succeeds():
+    gateway = StripeGateway(_config())
+    attempts = []
+
+    def flaky(**params):
+        attempts.append(params)
+        if len(attempts) < 3:
+            raise FakeStripeError(429)
+        return "ok"
+
+    assert gateway.call("customer.create", flaky, idempotent=True, email="a@b.c") == "ok"
+    assert len(attempts) == 3
+    # Same idempotency key on every attempt
+    assert len({a["idempotency_key"] for a in attempts}) == 1
+    assert gateway.stats()["operations"]["customer.create"]["retries"] == 2
+
+
+def test_gateway_does_not_retry_client_errors():
+    gateway = StripeGateway(_config())
+    calls = []
+
+    def bad_request():
+        calls.append(1)
+        raise FakeStripeError(400)
+
+    with pytest.raises(FakeStripeError):
+        gateway.call("checkout.session.create", bad_request)
+    assert len(calls) == 1
+
+
+def test_gateway_gives_up_with_stripe_unavailable():
+    gateway = StripeGateway(_config(stripe_max_retries=2))
+
+    def down():
+        raise FakeStripeError(503)
+
+    with pytest.raises(StripeUnavailable):
+        gateway.call("billing_portal.session.create", down)
+    stats = gateway.stats()["operations"]["billing_portal.session.create"]
+    assert stats["calls"] == 3
+    assert stats["failures"] == 1
+
+
+def test_gateway_rejects_when_queue_wait_exceeded():
+    gateway = StripeGateway(
+        _config(stripe_global_rate=(0.5, 1), stripe_max_queue_wait=0.05)
+    )
+    gateway.call("customer.create", lambda: None)
+    with pytest.raises(StripeUnavailable):
+        gateway.call("customer.create", lambda: None)
+    assert gateway.stats()["operations"]["customer.create"]["rejected"] == 1
+
+
+def test_fair_limiter_does_not_starve_other_operations():
+    limiter = FairLimiter(
+        global_rate=(50.0, 1),
+        default_rate=(1000.0, 1000),
+    )
+    order = []
+    lock = threading.Lock()
+
+    def worker(op):
+        limiter.acquire(op, timeout=5)
+        with lock:
+            order.append(op)
+
+    threads = [threading.Thread(target=worker, args=("customer.create",)) for _ in range(10)]
+    for t in threads:
+        t.start()
+    time.sleep(0.03)
+    other = threading.Thread(target=worker, args=("billing_portal.session.create",))
+    other.start()
+    for t in threads + [other]:
+        t.join()
+
+    # The portal call must not wait behind the whole customer.create burst
+    assert order.index("billing_portal.session.create") < len(order) - 3
+
+
+def test_circuit_breaker_opens_and_probes():
+    from viv_pay.breaker import CircuitBreaker, CircuitOpen
+
+    now = [0.0]
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=lambda: now[0])
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpen):
+        breaker.before_call()
+
+    now[0] = 10.0
+    assert breaker.state == "half_open"
+    breaker.before_call()  # the single probe
+    with pytest.raises(CircuitOpen):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+def test_gateway_fails_fast_when_circuit_open():
+    gateway = StripeGateway(
+        _config(stripe_max_retries=0, stripe_breaker_threshold=1)
+    )
+    calls = []
+
+    def down():
+        calls.append(1)
+        raise FakeStripeError(500)
+
+    with pytest.raises(StripeUnavailable):
+        gateway.call("customer.create", down)
+    with pytest.raises(StripeUnavailable) as exc_info:
+        gateway.call("customer.create", down)
+    assert len(calls) == 1
+    assert "circuit open" in str(exc_info.value)
+    assert exc_info.value.retry_after >= 1
+
+
+def test_gateway_attempt_timeout_and_deadline():
+    gateway = StripeGateway(
+        _config(
+            stripe_default_timeout=0.05,
+            stripe_request_deadline=0.2,
+            stripe_max_retries=10,
+        )
+    )
+    start = time.monotonic()
+    with pytest.raises(StripeUnavailable):
+        gateway.call("checkout.session.create", time.sleep, 1)
+    assert time.monotonic() - start < 0.5
+    assert gateway.stats()["operations"]["checkout.session.create"]["timeouts"] >= 1
+
+
+def test_gateway_retries_while_abandoned_attempt_holds_the_key():
+    gateway = StripeGateway(_config(stripe_default_timeout=0.05, stripe_retry_max_delay=0.05))
+    in_flight = threading.Lock()
+    keys = []
+
+    def create(**params):
+        keys.append(params["idempotency_key"])
+        if not in_flight.acquire(blocking=False):
+            raise FakeStripeError(409, code="idempotency_key_in_use")
+        try:
+            if len(keys) == 1:
+                time.sleep(0.15)  # first attempt outlives its timeout
+            return "cus_1"
+        finally:
+            in_flight.release()
+
+    assert gateway.call("customer.create", create, idempotent=True) == "cus_1"
+    assert len(set(keys)) == 1
+    stats = gateway.stats()["operations"]["customer.create"]
+    assert stats["timeouts"] == 1
+    assert stats["retries"] >= 2
+    assert gateway.breaker.state == "closed"
+
+
+def test_stripe_unavailable_maps_to_503(app_with_pay, client):
+    app = app_with_pay[0]
+
+    @app.get("/needs-stripe")
+    async def needs_stripe():
+        raise StripeUnavailable(retry_after=7.2)
+
+    resp = client.get("/needs-stripe")
+    assert resp.status_code == 503
+    assert resp.headers["retry-after"] == "8"
@@ -0,0 +1,142 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+
+from viv_pay import PayConfig
+from viv_pay.admission import AdmissionController
+from viv_pay.gateway import StripeGateway
+from viv_pay.health import LoopLagMonitor, StripeProbe, create_health_handlers, pool_stats
+
+
+def test_health_is_cheap_and_reports_basics(client):
+    resp = client.get("/pay/health")
+    assert resp.status_code == 200
+    body = resp.json()
+    assert body["status"] == "ok"
+    assert body["mode"] == "dev"
+    assert body["stripe_circuit"] == "closed"
+    # The test engine uses StaticPool, which has no counters
+    assert body["pool"]["class"] == "StaticPool"
+    assert body["pool"]["checked_out"] is None
+    assert "db" not in body
+
+
+def test_health_deep_pings_db(client):
+    resp = client.get("/pay/health/deep")
+    assert resp.status_code == 200
+    body = resp.json()
+    assert body["db"]["ok"] is True
+    assert body["stripe"] == {"reachable": None}
+    assert "circuit" in body["gateway"]
+    assert body["webhook_admission"]["in_flight"] == 0
+
+
+def test_pool_stats_counts_checkouts(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'h.db'}", poolclass=QueuePool, pool_size=3, max_overflow=2
+    )
+    with engine.connect():
+        stats = pool_stats(engine)
+    assert stats["class"] == "QueuePool"
+    assert stats["size"] == 3
+    assert stats["checked_out"] == 1
+
+
+def test_stripe_probe_is_cached():
+    calls = []
+
+    def check():
+        calls.append(1)
+        if len(calls) > 1:
+            raise ConnectionError("down")
+
+    probe = StripeProbe(ttl=60, check=check)
+    assert probe.status()["reachable"] is True
+    assert probe.status()["reachable"] is True
+    assert len(calls) == 1
+
+    probe._checked_at -= 61
+    status = probe.status()
+    assert (status["reachable"], status["error"]) == (False, "ConnectionError")
+    assert len(calls) == 2
+
+
+def test_stripe_probe_serves_the_cached_result_while_refreshing():
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def check():
+        calls.append(1)
+        if len(calls) > 1:
+            started.set()
+            release.wait(5)
+
+    probe = StripeProbe(ttl=60, check=check)
+    assert probe.status()["reachable"] is True
+    probe._checked_at -= 61
+    refresher = threading.Thread(target=probe.status)
+    refresher.start()
+    assert started.wait(5)
+    # A second caller does not queue behind the slow Stripe call
+    status = probe.status()
+    assert status["reachable"] is True
+    assert status["age_seconds"] >= 60
+    release.set()
+    refresher.join()
+    assert len(calls) == 2
+    assert probe.status()["age_seconds"] < 60
+
+
+def _health_deep(engine, check, monkeypatch):
+    monkeypatch.setenv("STRIPE_SECRET_KEY", "sk_test_health")
+    config = PayConfig()
+    _, health_deep = create_health_handlers(
+        engine,
+        StripeGateway(config),
+        AdmissionController(max_concurrent=1, max_queue=1, queue_timeout=1, retry_after=1),
+        config,
+        LoopLagMonitor(),
+        StripeProbe(check=check),
+    )
+    resp = asyncio.run(health_deep())
+    return resp.status_code, json.loads(resp.body)
+
+
+def _unreachable():
+    raise ConnectionError("down")
+
+
+@pytest.mark.parametrize(
+    "db_ok, stripe_ok, expected",
+    [(True, True, 200), (False, True, 503), (True, False, 503), (False, False, 503)],
+)
+def test_health_deep_is_503_when_db_or_stripe_is_unreachable(
+    tmp_path, monkeypatch, db_ok, stripe_ok, expected
+):
+    url = f"sqlite:///{tmp_path / 'h.db'}" if db_ok else f"sqlite:///{tmp_path}/missing/h.db"
+    status_code, body = _health_deep(
+        create_engine(url), (lambda: None) if stripe_ok else _unreachable, monkeypatch
+    )
+    assert status_code == expected
+    assert body["status"] == ("ok" if expected == 200 else "down")
+    assert body["db"]["ok"] is db_ok
+    assert body["stripe"]["reachable"] is stripe_ok
+
+
+def test_loop_lag_monitor_sees_blocked_loop():
+    async def scenario():
+        monitor = LoopLagMonitor(interval=0.01)
+        await monitor.start()
+        await asyncio.sleep(0.02)
+        time.sleep(0.1)  # block the loop
+        await asyncio.sleep(0.03)
+        await monitor.stop()
+        return monitor
+
+    monitor = asyncio.run(scenario())
+    assert monitor.max_lag >= 0.05
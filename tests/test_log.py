@@ -0,0 +1,95 @@
+import json
+import logging
+
+from viv_pay.log import JsonFormatter, SamplingFilter, configure_logging
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+
+def _record(msg, *args, level=logging.INFO, **extra):
+    record = logging.LogRecord("viv-pay", level, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_sampling_filter_rate_limits_per_message_type():
+    sampling = SamplingFilter(rate_limit=(0.001, 3))
+    kept = [sampling.filter(_record("[viv-pay] Sub %s updated", i)) for i in range(10)]
+    assert kept.count(True) == 3
+    # Another message type has its own budget
+    assert sampling.filter(_record("[viv-pay] Payment %s refunded", 1))
+    # Warnings are never dropped
+    assert sampling.filter(_record("[viv-pay] Sub %s updated", 1, level=logging.WARNING))
+    assert sampling.suppressed == {"[viv-pay] Sub %s updated": 7}
+
+
+def test_sampling_filter_samples_by_prefix():
+    sampling = SamplingFilter(sample_rates={"[viv-pay] DEV MODE": 0.0}, rate_limit=None)
+    assert not sampling.filter(_record("[viv-pay] DEV MODE — webhook received: %s", "x"))
+    assert sampling.filter(_record("[viv-pay] Subscription %s canceled", "sub_1"))
+
+
+def test_json_formatter_includes_extra_fields():
+    line = JsonFormatter().format(
+        _record("[viv-pay] Webhook %s handled", "invoice.paid", event_type="invoice.paid", duration_ms=1.5)
+    )
+    entry = json.loads(line)
+    assert entry["msg"] == "[viv-pay] Webhook invoice.paid handled"
+    assert entry["event_type"] == "invoice.paid"
+    assert entry["duration_ms"] == 1.5
+    assert entry["level"] == "INFO"
+
+
+def test_configure_logging_writes_through_queue():
+    target = ListHandler()
+    setup = configure_logging(target=target, rate_limit=(0.001, 1))
+    try:
+        logger = logging.getLogger("viv-pay")
+        for i in range(5):
+            logger.info("[viv-pay] Subscription %s canceled", f"sub_{i}", extra={"user_id": i})
+    finally:
+        setup.stop()  # drains the queue
+    assert len(target.lines) == 1
+    assert json.loads(target.lines[0])["user_id"] == 0
+    assert setup.stats()["suppressed"] == {"[viv-pay] Subscription %s canceled": 4}
+    assert logging.getLogger("viv-pay").propagate is True
+
+
+def test_structured_logging_starts_with_app_and_restores_logger(db_setup):
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+
+    from viv_pay import init_pay
+    from viv_pay.config import PayConfig
+
+    engine, Base, get_db, _ = db_setup
+    logger = logging.getLogger("viv-pay")
+    own = ListHandler()
+    logger.addHandler(own)
+    logger.setLevel(logging.WARNING)
+    try:
+        app = FastAPI()
+        init_pay(app, engine, Base, get_db, config=PayConfig(structured_logging=True))
+        setup = app.state.pay_logging
+        # Nothing changes until the app starts
+        assert logger.level == logging.WARNING
+        assert setup.handler not in logger.handlers
+
+        with TestClient(app):
+            assert logger.level == logging.INFO
+            assert logger.handlers == [setup.handler]
+            assert logger.propagate is False
+
+        assert logger.level == logging.WARNING
+        assert logger.handlers == [own]
+        assert logger.propagate is True
+    finally:
+        logger.removeHandler(own)
+        logger.setLevel(logging.NOTSET)
@@ -15,6 +15,33 @@ def test_require_subscription_dev_mode_passes(app_with_pay, client):
     assert "sub_dev_1" in data["sub_id"]
 
 
+def test_dev_mode_entitlements_are_shared(app_with_pay, client):
+    app, _, _, require_subscription, _, _ = app_with_pay
+    seen = []
+
+    @app.get("/test-shared")
+    async def shared(sub=Depends(require_subscription)):
+        seen.append(sub)
+        return {}
+
+    client.get("/test-shared?user_id=5")
+    client.get("/test-shared?user_id=5")
+    assert seen[0] is seen[1]
+    assert seen[0].stripe_subscription_id == "sub_dev_5"
+
+
+def test_require_subscription_rejects_non_numeric_user_id(app_with_pay, client):
+    app, _, _, require_subscription, _, _ = app_with_pay
+
+    @app.get("/test-user-id")
+    async def premium(sub=Depends(require_subscription)):
+        return {}
+
+    resp = client.get("/test-user-id", headers={"x-user-id": "abc"})
+    assert resp.status_code == 400
+    assert resp.json() == {"detail": "Invalid user_id"}
+
+
 def test_require_subscription_no_user_id_raises(app_with_pay, client):
     app, _, _, require_subscription, _, _ = app_with_pay
 
@@ -84,3 +111,101 @@ def test_portal_unknown_user(client):
         content=json.dumps({"user_id": 999}),
     )
     assert resp.status_code == 404
+
+
+def _gated_app(resolve):
+    from fastapi import FastAPI, Request
+
+    from viv_pay.middleware import SubscriptionGateMiddleware
+
+    app = FastAPI()
+    app.add_middleware(
+        SubscriptionGateMiddleware, resolve=resolve, prefixes=["/api/pro", "/pro"]
+    )
+
+    @app.get("/api/pro/data")
+    async def pro_data(request: Request):
+        return {"sub": request.state.subscription.stripe_subscription_id}
+
+    @app.get("/pro/page")
+    async def pro_page():
+        return {"ok": True}
+
+    @app.get("/public")
+    async def public():
+        return {"ok": True}
+
+    @app.get("/api/professional")
+    async def professional():
+        return {"ok": True}
+
+    return app
+
+
+def test_gate_middleware_blocks_and_passes(monkeypatch):
+    from types import SimpleNamespace
+
+    from fastapi.testclient import TestClient
+
+    import viv_pay.middleware as middleware
+
+    monkeypatch.setattr(middleware, "is_dev_mode", lambda: False)
+    subs = {7: SimpleNamespace(stripe_subscription_id="sub_7")}
+    lookups = []
+
+    def resolve(user_id):
+        lookups.append(user_id)
+        return subs.get(user_id)
+
+    client = TestClient(_gated_app(resolve))
+
+    assert client.get("/public").status_code == 200
+    # Only whole path segments match the "/api/pro" prefix
+    assert client.get("/api/professional").status_code == 200
+    assert lookups == []
+
+    resp = client.get("/api/pro/data?user_id=7")
+    assert resp.status_code == 200
+    assert resp.json() == {"sub": "sub_7"}
+
+    resp = client.get("/api/pro/data", headers={"x-user-id": "8"})
+    assert resp.status_code == 403
+    assert resp.json() == {"detail": "Subscription required"}
+
+    resp = client.get("/pro/page", cookies={"user_id": "8"})
+    assert resp.status_code == 403
+    assert "/pricing" in resp.text
+
+    assert client.get("/api/pro/data").status_code == 403
+    # Query values are URL-decoded
+    assert client.get("/api/pro/data?x=1&user%5Fid=%37").status_code == 200
+    # Cookies are parsed like request.cookies: quoted values are unquoted
+    assert client.get("/api/pro/data", headers={"cookie": 'user_id="7"'}).status_code == 200
+    assert lookups == [7, 8, 8, 7, 7]
+
+    for bad in ("abc", "4_2", "+7"):
+        resp = client.get("/api/pro/data", headers={"x-user-id": bad})
+        assert resp.status_code == 400
+        assert resp.json() == {"detail": "Invalid user_id"}
+    assert lookups == [7, 8, 8, 7, 7]
+
+
+def test_gate_middleware_dev_mode_and_config(db_setup):
+    from fastapi import FastAPI, Request
+    from fastapi.testclient import TestClient
+
+    from viv_pay import PayConfig, init_pay
+
+    engine, Base, get_db, _ = db_setup
+    app = FastAPI()
+    init_pay(
+        app, engine, Base, get_db, config=PayConfig(gated_prefixes=["/api/pro"])
+    )
+
+    @app.get("/api/pro/data")
+    async def pro_data(request: Request):
+        return {"status": request.state.subscription.status}
+
+    client = TestClient(app)
+    assert client.get("/api/pro/data?user_id=3").json() == {"status": "active"}
+    assert client.get("/api/pro/data").status_code == 403
@@ -0,0 +1,233 @@
+import asyncio
+from types import SimpleNamespace
+
+import stripe
+from sqlalchemy import create_engine
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+from viv_pay.models import create_event_cursor_model
+from viv_pay.poller import EventPoller, MemoryCursor, SQLCursor
+from viv_pay.storage import MemoryStore
+from viv_pay.webhooks import create_default_registry
+
+
+class FakeEvents:
+    """Stands in for Stripe's Events API: `events` is oldest first."""
+
+    def __init__(self, events):
+        self.events = events
+        self.calls = []
+
+    def __call__(self, ending_before, limit):
+        self.calls.append((ending_before, limit))
+        if ending_before is None:
+            return self.events[-limit:], len(self.events) > limit
+        ids = [e["id"] for e in self.events]
+        newer = self.events[ids.index(ending_before) + 1 :]
+        return newer[:limit], len(newer) > limit
+
+
+def _event(n, event_type, obj):
+    return {"id": f"evt_{n}", "type": event_type, "data": {"object": obj}}
+
+
+def _store_with_customer():
+    store = MemoryStore()
+    store.add_customer(None, 1, "a@example.com", "cus_1")
+    return store
+
+
+def _checkout(n, session_id):
+    return _event(
+        n,
+        "checkout.session.completed",
+        {
+            "id": session_id,
+            "customer": "cus_1",
+            "mode": "subscription",
+            "subscription": "sub_1",
+            "amount_total": 900,
+            "currency": "usd",
+            "metadata": {"price_id": "price_pro"},
+        },
+    )
+
+
+def test_poller_starts_at_newest_event_then_handles_new_ones():
+    store = _store_with_customer()
+    events = FakeEvents([_event(1, "customer.created", {})])
+    cursor = MemoryCursor()
+    poller = EventPoller(store, create_default_registry(store), cursor, list_events=events)
+
+    assert asyncio.run(poller.poll_once()) == 0
+    assert cursor.event_id == "evt_1"  # history is not replayed
+
+    events.events.append(_checkout(2, "cs_1"))
+    events.events.append(
+        _event(3, "customer.subscription.updated", {"id": "sub_1", "status": "past_due"})
+    )
+    assert asyncio.run(poller.poll_once()) == 2
+    assert cursor.event_id == "evt_3"
+    assert store.subscriptions["sub_1"].status == "past_due"
+    assert len(store.payments) == 1
+    assert poller.stats["handled"] == 2
+
+
+def test_poller_drains_backlog_with_growing_pages():
+    store = _store_with_customer()
+    backlog = [_event(i, "customer.updated", {}) for i in range(1, 80)]
+    events = FakeEvents(backlog)
+    poller = EventPoller(
+        store,
+        create_default_registry(store),
+        MemoryCursor("evt_1"),
+        min_page_size=10,
+        list_events=events,
+    )
+
+    async def drain():
+        while await poller.poll_once() or poller.interval == 0:
+            pass
+
+    asyncio.run(drain())
+    assert poller.cursor.event_id == "evt_79"
+    assert [limit for _, limit in events.calls] == [10, 20, 40, 80, 80]
+    assert poller.page_size == 40  # idle poll shrinks the page again
+    assert poller.interval > poller.min_interval
+
+
+def test_poller_stops_at_failing_event_and_retries_from_it():
+    store = _store_with_customer()
+    registry = create_default_registry(store)
+    failures = []
+
+    @registry.on("invoice.paid", needs_db=False)
+    def flaky(db, data, event):
+        if not failures:
+            failures.append(event["id"])
+            raise RuntimeError("boom")
+
+    events = FakeEvents(
+        [
+            _event(1, "customer.updated", {}),
+            _checkout(2, "cs_1"),
+            _event(3, "invoice.paid", {}),
+            _event(4, "invoice.paid", {}),
+        ]
+    )
+    cursor = MemoryCursor("evt_1")
+    poller = EventPoller(store, registry, cursor, list_events=events)
+
+    assert asyncio.run(poller.poll_once()) == 1
+    assert cursor.event_id == "evt_2"
+    assert poller.stats["errors"] == 1
+
+    assert asyncio.run(poller.poll_once()) == 2
+    assert cursor.event_id == "evt_4"
+    assert failures == ["evt_3"]
+    assert poller.stats["skipped"] == 0
+
+
+def test_poller_skips_a_poison_event_after_max_attempts(caplog):
+    store = _store_with_customer()
+    registry = create_default_registry(store)
+
+    @registry.on("invoice.paid", needs_db=False)
+    def poison(db, data, event):
+        if event["id"] == "evt_2":
+            raise RuntimeError("boom")
+
+    events = FakeEvents([_event(n, "invoice.paid", {}) for n in (1, 2, 3)])
+    cursor = MemoryCursor("evt_1")
+    poller = EventPoller(store, registry, cursor, list_events=events, max_attempts=3)
+
+    assert [asyncio.run(poller.poll_once()) for _ in range(2)] == [0, 0]
+    assert cursor.event_id == "evt_1"
+    with caplog.at_level("ERROR", logger="viv-pay"):
+        assert asyncio.run(poller.poll_once()) == 1
+    assert cursor.event_id == "evt_3"
+    assert poller.stats["errors"] == 3
+    assert poller.stats["skipped"] == 1
+    assert poller.stats["handled"] == 1
+    assert "evt_2" in caplog.text and "skipping" in caplog.text
+
+
+def test_redelivered_checkout_records_one_payment():
+    store = _store_with_customer()
+    events = FakeEvents([_event(1, "customer.updated", {}), _checkout(2, "cs_1")])
+    cursor = MemoryCursor("evt_1")
+    poller = EventPoller(store, create_default_registry(store), cursor, list_events=events)
+
+    asyncio.run(poller.poll_once())
+    cursor.event_id = "evt_1"  # e.g. cursor write lost before a restart
+    asyncio.run(poller.poll_once())
+    assert len(store.payments) == 1
+
+
+def test_poller_converts_stripe_objects_from_gateway():
+    calls = []
+
+    class FakeGateway:
+        def call(self, op, fn, *args, **params):
+            calls.append((op, fn, params))
+            page = [
+                stripe.StripeObject.construct_from(
+                    _event(n, "customer.subscription.deleted", {"id": "sub_1"}), "sk_test"
+                )
+                for n in (6, 5)
+            ]
+            return SimpleNamespace(data=page, has_more=False)
+
+    store = _store_with_customer()
+    store.add_subscription(None, 1, "sub_1", "price_pro", "active")
+    poller = EventPoller(
+        store, create_default_registry(store), MemoryCursor("evt_4"), gateway=FakeGateway()
+    )
+
+    assert asyncio.run(poller.poll_once()) == 2
+    assert calls[0][0] == "event.list"
+    assert calls[0][1] == stripe.Event.list
+    assert calls[0][2] == {"limit": 10, "ending_before": "evt_4"}
+    assert poller.cursor.event_id == "evt_6"  # newest, after reversing the page
+    assert store.subscriptions["sub_1"].status == "canceled"
+
+
+def test_sql_cursor_round_trip():
+    engine = create_engine("sqlite:///:memory:")
+    Base = declarative_base()
+    PayEventCursor = create_event_cursor_model(Base)
+    Base.metadata.create_all(bind=engine)
+    SessionLocal = sessionmaker(bind=engine)
+
+    def get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    cursor = SQLCursor(get_db, PayEventCursor)
+    assert cursor.load() is None
+    assert cursor.save("evt_1")
+    assert not cursor.save("evt_0")  # another poller created it first
+    assert cursor.save("evt_2", "evt_1")
+    # A poller that started from evt_1 cannot move the cursor back
+    assert not cursor.save("evt_3", "evt_1")
+    assert cursor.load() == "evt_2"
+
+
+def test_poller_does_not_move_cursor_back_after_losing_a_race():
+    store = _store_with_customer()
+    events = FakeEvents([_event(i, "customer.updated", {}) for i in range(1, 6)])
+    cursor = MemoryCursor("evt_1")
+    registry = create_default_registry(store)
+    poller = EventPoller(store, registry, cursor, list_events=events)
+
+    @registry.on("customer.updated", needs_db=False)
+    def overtaken(db, data, event):
+        if event["id"] == "evt_3":
+            cursor.event_id = "evt_5"  # another worker finished the page meanwhile
+
+    assert asyncio.run(poller.drain()) == 4
+    assert cursor.event_id == "evt_5"
+    assert poller.stats["conflicts"] == 1
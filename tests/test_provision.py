@@ -0,0 +1,120 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import stripe
+
+from viv_pay.provision import provision_customers
+from viv_pay.storage import MemoryStore
+
+
+class FakeGateway:
+    def __init__(self, fail_users=()):
+        self.calls = []
+        self.fail_users = set(fail_users)
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def call(self, op, fn, *args, **params):
+        user_id = int(params["metadata"]["user_id"])
+        with self._lock:
+            self.calls.append((op, params["idempotency_key"]))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.002)
+        with self._lock:
+            self.in_flight -= 1
+        if user_id in self.fail_users:
+            raise ConnectionError("stripe down")
+        return SimpleNamespace(id=f"cus_{user_id}")
+
+
+def _live(monkeypatch):
+    monkeypatch.setattr("viv_pay.provision.is_dev_mode", lambda: False)
+
+
+def test_provision_creates_skips_and_bounds_concurrency(monkeypatch):
+    _live(monkeypatch)
+    store = MemoryStore()
+    store.add_customer(None, 3, "old@example.com", "cus_old")
+    gateway = FakeGateway()
+    users = ((i, f"u{i}@example.com") for i in range(1, 51))
+
+    stats = asyncio.run(
+        provision_customers(store, users, gateway, concurrency=4, chunk_size=20)
+    )
+    assert stats == {"created": 49, "skipped": 1, "failed": 0}
+    assert gateway.max_in_flight <= 4
+    assert store.customers_by_user[7].stripe_customer_id == "cus_7"
+    assert store.customers_by_user[3].stripe_customer_id == "cus_old"
+    assert ("customer.create", "viv-pay-app-customer-7") in gateway.calls
+
+
+def test_provision_resumes_after_failures(monkeypatch):
+    _live(monkeypatch)
+    store = MemoryStore()
+    users = [(i, f"u{i}@example.com") for i in range(1, 11)]
+
+    first = asyncio.run(provision_customers(store, users, FakeGateway(fail_users={4, 9})))
+    assert first == {"created": 8, "skipped": 0, "failed": 2}
+
+    gateway = FakeGateway()
+    second = asyncio.run(provision_customers(store, users, gateway))
+    assert second == {"created": 2, "skipped": 8, "failed": 0}
+    assert sorted(key for _, key in gateway.calls) == [
+        "viv-pay-app-customer-4",
+        "viv-pay-app-customer-9",
+    ]
+
+
+def test_provision_keys_are_namespaced_and_reused_keys_find_the_customer(monkeypatch):
+    _live(monkeypatch)
+    store = MemoryStore()
+    calls = []
+
+    class ReusedKeyGateway:
+        def call(self, op, fn, *args, **params):
+            calls.append((op, params))
+            if op == "customer.create":
+                # An earlier attempt used this key with another email
+                raise stripe.error.IdempotencyError("Keys for idempotent requests ...")
+            return SimpleNamespace(data=[SimpleNamespace(id="cus_earlier")])
+
+    users = [(5, "new@example.com")]
+    stats = asyncio.run(provision_customers(store, users, ReusedKeyGateway(), app_id="billing"))
+    assert stats == {"created": 1, "skipped": 0, "failed": 0}
+    assert store.customers_by_user[5].stripe_customer_id == "cus_earlier"
+    (_, create), (_, search) = calls
+    assert create["idempotency_key"] == "viv-pay-billing-customer-5"
+    assert create["metadata"] == {"user_id": "5", "viv_pay_app": "billing"}
+    assert search["query"] == "metadata['viv_pay_app']:'billing' AND metadata['user_id']:'5'"
+
+
+def test_provision_skips_customers_inserted_meanwhile(monkeypatch):
+    _live(monkeypatch)
+    store = MemoryStore()
+
+    class CheckoutRace(FakeGateway):
+        def call(self, op, fn, *args, **params):
+            customer = super().call(op, fn, *args, **params)
+            # The user's first checkout records the same customer concurrently
+            store.get_or_add_customer(None, 2, "u2@example.com", "cus_2")
+            return customer
+
+    users = [(1, "u1@example.com"), (2, "u2@example.com")]
+    stats = asyncio.run(provision_customers(store, users, CheckoutRace()))
+    assert stats == {"created": 1, "skipped": 1, "failed": 0}
+
+
+def test_provision_accepts_async_iterables_in_dev_mode():
+    store = MemoryStore()
+
+    async def users():
+        for i in range(5):
+            yield i, f"u{i}@example.com"
+
+    stats = asyncio.run(provision_customers(store, users(), chunk_size=2))
+    assert stats["created"] == 5
+    assert store.customers_by_user[4].stripe_customer_id == "cus_dev_4"
@@ -0,0 +1,116 @@
+import asyncio
+import time
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import inspect
+
+from viv_pay import PayConfig, init_pay
+from viv_pay.models import create_job_lease_model
+from viv_pay.scheduler import JobScheduler, MemoryLease, SQLLease
+
+
+@pytest.fixture
+def sql_lease(db_setup):
+    engine, Base, get_db, _ = db_setup
+    PayJobLease = create_job_lease_model(Base)
+    Base.metadata.create_all(bind=engine)
+    return SQLLease(get_db, PayJobLease)
+
+
+@pytest.mark.parametrize("lease_store", ["sql", "memory"])
+def test_lease_excludes_other_owners_until_expiry(lease_store, sql_lease):
+    lease = sql_lease if lease_store == "sql" else MemoryLease()
+    assert lease.acquire("job", "a", until=100.0, now=0.0)
+    assert not lease.acquire("job", "b", until=200.0, now=50.0)
+    # Holding a lease does not let the owner start early either
+    assert not lease.acquire("job", "a", until=200.0, now=50.0)
+    assert lease.acquire("job", "a", until=150.0, renew=True, now=50.0)
+    assert not lease.acquire("job", "b", until=150.0, renew=True, now=50.0)
+    assert lease.acquire("job", "b", until=300.0, now=150.0)
+
+
+def test_only_one_worker_runs_each_interval(sql_lease):
+    runs = []
+    workers = [JobScheduler(sql_lease, owner=name) for name in ("a", "b", "c")]
+    jobs = [w.add_job("rollup", lambda: runs.append(1), interval=0.2) for w in workers]
+
+    async def tick():
+        return [await w.run_job(job) for w, job in zip(workers, jobs)]
+
+    assert asyncio.run(tick()) == [True, False, False]
+    # Held until the next run is due, even though the run itself has finished
+    assert asyncio.run(tick()) == [False, False, False]
+    time.sleep(0.25)
+    assert sum(asyncio.run(tick())) == 1
+    assert len(runs) == 2
+    assert [w.jobs["rollup"].stats["skipped"] for w in workers] == [1, 3, 3]
+
+
+def test_scheduler_runs_jobs_and_stops_gracefully():
+    scheduler = JobScheduler(MemoryLease(), jitter=0.0, shutdown_timeout=2.0)
+    finished = []
+
+    async def slow():
+        await asyncio.sleep(0.1)
+        finished.append(1)
+
+    def broken():
+        raise RuntimeError("boom")
+
+    scheduler.add_job("slow", slow, interval=0.05)
+    scheduler.add_job("broken", broken, interval=0.05)
+    with pytest.raises(ValueError):
+        scheduler.add_job("slow", slow, interval=1)
+
+    async def main():
+        await scheduler.start()
+        await asyncio.sleep(0.2)
+        await scheduler.stop()
+
+    asyncio.run(main())
+    stats = scheduler.stats()["jobs"]
+    # The run in progress at stop() was allowed to finish
+    assert stats["slow"]["runs"] == len(finished) >= 1
+    assert not stats["slow"]["running"]
+    assert stats["slow"]["max_duration"] >= 0.1
+    assert stats["broken"]["failures"] == stats["broken"]["runs"] >= 1
+
+
+def test_init_pay_schedules_usage_push(db_setup):
+    engine, Base, get_db, _ = db_setup
+    app = FastAPI()
+    pay = init_pay(app, engine, Base, get_db, config=PayConfig(usage_metering=True))
+    pay.schedule("app.cleanup", lambda: None, interval=3600)
+
+    scheduler = app.state.pay_scheduler
+    assert set(scheduler.jobs) == {"usage.push", "app.cleanup"}
+    with TestClient(app) as client:
+        assert client.get("/pay/health/deep").json()["jobs"]["usage.push"]["runs"] == 0
+    assert scheduler._tasks == []
+
+
+def test_init_pay_without_jobs_has_no_scheduler_or_lease_table(db_setup):
+    engine, Base, get_db, _ = db_setup
+    app = FastAPI()
+    init_pay(app, engine, Base, get_db)
+
+    assert not hasattr(app.state, "pay_scheduler")
+    assert "pay_job_leases" not in Base.metadata.tables
+    with TestClient(app) as client:
+        assert "jobs" not in client.get("/pay/health/deep").json()
+    assert not inspect(engine).has_table("pay_job_leases")
+
+
+def test_app_job_added_after_init_creates_the_lease_table_at_startup(db_setup):
+    engine, Base, get_db, _ = db_setup
+    app = FastAPI()
+    pay = init_pay(app, engine, Base, get_db)
+    assert not inspect(engine).has_table("pay_job_leases")
+
+    pay.schedule("app.cleanup", lambda: None, interval=3600)
+    with TestClient(app) as client:
+        assert inspect(engine).has_table("pay_job_leases")
+        assert list(client.get("/pay/health/deep").json()["jobs"]) == ["app.cleanup"]
+    assert app.state.pay_scheduler._tasks == []
@@ -0,0 +1,105 @@
+import json
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi.testclient import TestClient
+
+from viv_pay.config import PayConfig
+from viv_pay.service import EntitlementService
+from viv_pay.storage import MemoryStore
+
+
+@pytest.fixture
+def store():
+    store = MemoryStore()
+    with store.session() as db:
+        customer = store.add_customer(db, 1, "a@example.com", "cus_1")
+        sub = store.add_subscription(db, customer.id, "sub_1", "price_pro", "active")
+        sub.current_period_end = datetime.now(timezone.utc) + timedelta(days=30)
+        customer = store.add_customer(db, 2, "b@example.com", "cus_2")
+        store.add_subscription(db, customer.id, "sub_2", "price_pro", "canceled")
+    return store
+
+
+def _service(store, dev=False, **config):
+    config = PayConfig(price_features={"price_pro": {"export", "api"}}, **config)
+    return EntitlementService(store, config, dev=dev)
+
+
+def test_get_entitlement_with_etag(store):
+    client = TestClient(_service(store))
+    resp = client.get("/entitlements/1")
+    assert resp.status_code == 200
+    body = resp.json()
+    assert body["entitled"] is True
+    assert body["features"] == ["api", "export"]
+    assert body["expires_at"] > time.time()
+
+    etag = resp.headers["etag"]
+    assert "max-age=2" in resp.headers["cache-control"]
+    resp = client.get("/entitlements/1", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    assert resp.headers["etag"] == etag
+
+    assert client.get("/entitlements/2").json() == {
+        "user_id": 2, "entitled": False, "expires_at": None, "features": []
+    }
+    assert client.get("/entitlements/abc").status_code == 400
+    assert client.delete("/entitlements/1").status_code == 405
+    assert client.get("/healthz").status_code == 200
+
+
+def test_batch_lookup_uses_one_query(store):
+    calls = []
+    rows = store.iter_entitlement_rows
+
+    def counting(db, statuses, user_id=None, user_ids=None):
+        calls.append(list(user_ids))
+        return rows(db, statuses, user_id, user_ids)
+
+    store.iter_entitlement_rows = counting
+    client = TestClient(_service(store))
+    resp = client.post("/entitlements", content=json.dumps({"user_ids": [2, 1, 3, 1]}))
+    assert resp.status_code == 200
+    entitled = [(e["user_id"], e["entitled"]) for e in resp.json()["entitlements"]]
+    assert entitled == [(2, False), (1, True), (3, False), (1, True)]
+    assert calls == [[2, 1, 3]]
+
+    # Cached now: no further queries
+    client.get("/entitlements/3")
+    assert len(calls) == 1
+
+    assert client.post("/entitlements", content=b"{}").status_code == 400
+    too_many = json.dumps({"user_ids": list(range(1001))})
+    assert client.post("/entitlements", content=too_many).status_code == 413
+
+
+def test_budget_exceeded_serves_stale_or_503(store):
+    service = _service(store, entitlement_budget=0.05, entitlement_cache_ttl=0.0)
+    client = TestClient(service)
+    assert client.get("/entitlements/1").json()["entitled"] is True
+
+    rows = store.iter_entitlement_rows
+
+    def slow(*args, **kwargs):
+        time.sleep(0.2)
+        return rows(*args, **kwargs)
+
+    store.iter_entitlement_rows = slow
+    assert client.get("/entitlements/1").json()["entitled"] is True  # stale
+    assert client.get("/entitlements/2").status_code == 503
+    assert service.stats["timeouts"] == 2
+    assert service.stats["stale"] == 1
+
+
+def test_dev_mode_entitles_everyone(store):
+    body = TestClient(_service(store, dev=True)).get("/entitlements/99").json()
+    assert body["entitled"] is True
+    assert body["features"] == ["api", "export"]
+
+
+def test_dev_mode_is_opt_in_without_stripe_key(store):
+    # conftest unsets STRIPE_SECRET_KEY; the service still checks the DB
+    body = TestClient(_service(store)).get("/entitlements/99").json()
+    assert body["entitled"] is False
@@ -0,0 +1,182 @@
+import json
+from datetime import timedelta
+
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+
+from viv_pay import PayConfig, init_pay
+from viv_pay.entitlements import FeatureMap
+from viv_pay.models import utcnow
+from viv_pay.snapshot import NO_EXPIRY, EntitlementSnapshot, SnapshotWriter
+from viv_pay.storage import Entitlement, MemoryStore
+
+
+def _store_with_users():
+    store = MemoryStore()
+    for user_id in (5, 1, 3):
+        customer = store.add_customer(None, user_id, f"u{user_id}@example.com", f"cus_{user_id}")
+        store.add_subscription(None, customer.id, f"sub_{user_id}", "price_pro", "active")
+    return store
+
+
+def test_snapshot_rebuild_and_lookup(tmp_path):
+    store = _store_with_users()
+    fmap = FeatureMap({"price_pro": {"exports"}})
+    path = tmp_path / "entitlements.snap"
+    writer = SnapshotWriter(path, store, PayConfig(), fmap)
+    assert writer.rebuild() == 3
+
+    snapshot = EntitlementSnapshot(path, check_interval=0)
+    assert len(snapshot) == 3
+    assert snapshot.lookup(3) == (NO_EXPIRY, fmap.bit("exports"))
+    assert snapshot.lookup(2) is None
+    entitlement = snapshot.entitlement(5)
+    assert isinstance(entitlement, Entitlement)
+    assert (entitlement.status, entitlement.current_period_end) == ("active", None)
+
+
+def test_snapshot_incremental_update_is_visible_to_readers(tmp_path):
+    store = _store_with_users()
+    path = tmp_path / "entitlements.snap"
+    writer = SnapshotWriter(path, store, PayConfig())
+    writer.rebuild()
+    snapshot = EntitlementSnapshot(path, check_interval=0)
+    assert len(snapshot) == 3
+    generation = snapshot.generation
+
+    store.update_subscription(None, store.subscriptions["sub_3"], status="canceled")
+    writer.refresh_user(None, 3)
+    assert snapshot.lookup(3) is None
+    assert snapshot.generation == generation + 1
+
+    customer = store.add_customer(None, 2, "u2@example.com", "cus_2")
+    sub = store.add_subscription(None, customer.id, "sub_2", "price_pro", "active")
+    store.update_subscription(None, sub, current_period_end=utcnow() - timedelta(days=1))
+    writer.refresh_user(None, 2)
+    assert snapshot.lookup(2) is not None
+    # Past its period end but renewal webhook not in yet: still entitled, as in the DB
+    assert snapshot.entitlement(2) is not None
+    assert [snapshot.lookup(u) is not None for u in (1, 2, 3, 5)] == [True, True, False, True]
+    assert len(snapshot) == 3
+
+
+def test_refresh_writes_a_delta_and_compacts_it(tmp_path):
+    store = _store_with_users()
+    path = tmp_path / "entitlements.snap"
+    writer = SnapshotWriter(path, store, PayConfig(), max_delta=2)
+    writer.rebuild()
+    snapshot = EntitlementSnapshot(path, check_interval=0)
+    base_inode = path.stat().st_ino
+
+    for user_id in (10, 11):
+        customer = store.add_customer(None, user_id, f"u{user_id}@example.com", f"cus_{user_id}")
+        store.add_subscription(None, customer.id, f"sub_{user_id}", "price_pro", "active")
+        writer.refresh_user(None, user_id)
+    # Only the delta was rewritten
+    assert path.stat().st_ino == base_inode
+    assert writer.delta_path.exists()
+    assert len(snapshot) == 5
+
+    store.update_subscription(None, store.subscriptions["sub_1"], status="canceled")
+    writer.refresh_user(None, 1)
+    # Past max_delta: merged into a new base
+    assert path.stat().st_ino != base_inode
+    assert not writer.delta_path.exists()
+    assert [snapshot.lookup(u) is not None for u in (1, 3, 5, 10, 11)] == [
+        False, True, True, True, True
+    ]
+    assert len(snapshot) == 4
+
+
+def test_rebuild_scans_without_the_lock_and_keeps_concurrent_refreshes(tmp_path):
+    store = _store_with_users()
+    path = tmp_path / "entitlements.snap"
+    writer = SnapshotWriter(path, store, PayConfig())
+    writer.rebuild()
+    scan = store.iter_entitlement_rows
+
+    def scan_while_a_webhook_lands(db, statuses, user_id=None, user_ids=None):
+        rows = list(scan(db, statuses, user_id=user_id, user_ids=user_ids))
+        if user_id is None and user_ids is None:
+            # The full scan already read sub_3; a webhook cancels it before the swap.
+            # refresh_user() takes the lock, so this would deadlock if rebuild held it.
+            store.update_subscription(None, store.subscriptions["sub_3"], status="canceled")
+            writer.refresh_user(None, 3)
+        return iter(rows)
+
+    store.iter_entitlement_rows = scan_while_a_webhook_lands
+    assert writer.rebuild() == 2
+    snapshot = EntitlementSnapshot(path, check_interval=0)
+    assert [snapshot.lookup(u) is not None for u in (1, 3, 5)] == [True, False, True]
+    assert not writer.delta_path.exists()
+    assert not writer.dirty_path.exists()
+
+
+def test_stale_snapshot_is_unavailable_and_rebuilt(tmp_path, monkeypatch):
+    import viv_pay.snapshot as snapshot_module
+
+    store = _store_with_users()
+    path = tmp_path / "entitlements.snap"
+    path.write_bytes(b"VPSNAP01" + bytes(16))  # left by an older deployment
+    snapshot = EntitlementSnapshot(path, check_interval=0, max_age=60)
+    assert not snapshot.available()
+
+    writer = SnapshotWriter(path, store, PayConfig())
+    writer.ensure(max_age=60)
+    assert snapshot.available()
+    assert len(snapshot) == 3
+
+    later = snapshot_module.time.time() + 120
+    monkeypatch.setattr(snapshot_module.time, "time", lambda: later)
+    assert not snapshot.available()
+    writer.ensure(max_age=60)
+    assert snapshot.available()
+
+
+def test_require_subscription_uses_snapshot(db_setup, tmp_path, monkeypatch):
+    import viv_pay.middleware as middleware
+
+    engine, Base, get_db, _ = db_setup
+    store = MemoryStore()
+    app = FastAPI()
+    config = PayConfig(
+        entitlement_snapshot_path=str(tmp_path / "ent.snap"),
+        entitlement_snapshot_check_interval=0,
+    )
+    _, _, require_subscription = init_pay(app, engine, Base, get_db, config=config, store=store)
+    assert any(job.startswith("entitlements.snapshot@") for job in app.state.pay_scheduler.jobs)
+
+    @app.get("/premium")
+    async def premium(sub=Depends(require_subscription)):
+        return {"type": type(sub).__name__, "status": sub.status}
+
+    client = TestClient(app)
+    client.post(
+        "/pay/checkout",
+        content=json.dumps({"user_id": 4, "email": "u4@example.com", "price_id": "price_pro"}),
+    )
+    client.post(
+        "/pay/webhook",
+        content=json.dumps({
+            "type": "checkout.session.completed",
+            "data": {"object": {
+                "id": "cs_4", "customer": "cus_dev_4", "mode": "subscription",
+                "subscription": "sub_4", "amount_total": 100,
+            }},
+        }),
+    )
+
+    monkeypatch.setattr(middleware, "is_dev_mode", lambda: False)
+    # Prove the DB/store is not consulted
+    monkeypatch.setattr(store, "get_active_subscription", None)
+    monkeypatch.setattr(store, "get_entitlement", None)
+    assert client.get("/premium?user_id=4").json() == {"type": "Entitlement", "status": "active"}
+
+    client.post(
+        "/pay/webhook",
+        content=json.dumps({
+            "type": "customer.subscription.deleted",
+            "data": {"object": {"id": "sub_4"}},
+        }),
+    )
+    assert client.get("/premium?user_id=4").status_code == 403
@@ -0,0 +1,197 @@
+import asyncio
+import json
+import threading
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+from viv_pay import init_pay
+from viv_pay.config import PayConfig
+from viv_pay.models import create_pay_models
+from viv_pay.sqlite import SQLiteWriter, configure_sqlite
+from viv_pay.storage import SQLAlchemyStore
+
+
+@pytest.fixture
+def file_db(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'app.db'}")
+    Base = declarative_base()
+    SessionLocal = sessionmaker(bind=engine)
+
+    def get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    yield engine, Base, get_db
+    engine.dispose()
+
+
+def test_configure_sqlite_sets_pragmas(file_db):
+    engine, _, _ = file_db
+    configure_sqlite(engine, busy_timeout=2.5, mmap_size=1 << 20)
+    with engine.connect() as conn:
+        pragma = lambda name: conn.execute(text(f"PRAGMA {name}")).scalar()
+        assert pragma("journal_mode") == "wal"
+        assert pragma("synchronous") == 1  # NORMAL
+        assert pragma("busy_timeout") == 2500
+        assert pragma("mmap_size") == 1 << 20
+
+
+def test_writer_groups_queued_writes_into_one_commit(file_db):
+    engine, Base, get_db = file_db
+    StripeCustomer, Subscription, Payment = create_pay_models(Base)
+    Base.metadata.create_all(bind=engine)
+    writer = SQLiteWriter(get_db, max_batch=10)
+    store = SQLAlchemyStore(get_db, StripeCustomer, Subscription, Payment, writer=writer)
+    started, release = threading.Event(), threading.Event()
+
+    def block(db):
+        started.set()
+        return release.wait()
+
+    def add(user_id):
+        def insert(db):
+            customer = store.add_customer(db, user_id, f"{user_id}@example.com", f"cus_{user_id}")
+            store.commit(db)
+            return customer
+
+        return insert
+
+    blocker = writer.submit(block)
+    started.wait(5)
+    futures = [writer.submit(add(user_id)) for user_id in (1, 2, 2, 3)]
+    release.set()
+    assert blocker.result(timeout=5)
+    assert futures[0].result(timeout=5).stripe_customer_id == "cus_1"
+    with pytest.raises(Exception):
+        futures[2].result(timeout=5)  # duplicate user: rolled back alone
+    writer.close()
+
+    assert writer.stats == {"writes": 5, "failures": 1, "commits": 2, "max_batch": 4}
+    with store.session() as db:
+        assert store.get_customer_user_ids(db, [1, 2, 3]) == {1, 2, 3}
+    with pytest.raises(RuntimeError):
+        writer.submit(add(4))
+
+
+def test_writer_runs_after_commit_callbacks_of_committed_writes(file_db):
+    engine, Base, get_db = file_db
+    StripeCustomer, Subscription, Payment = create_pay_models(Base)
+    Base.metadata.create_all(bind=engine)
+    writer = SQLiteWriter(get_db)
+    store = SQLAlchemyStore(get_db, StripeCustomer, Subscription, Payment, writer=writer)
+    seen = []
+
+    def add(user_id):
+        def insert(db):
+            store.add_customer(db, user_id, f"{user_id}@example.com", f"cus_{user_id}")
+            store.commit(db)
+
+            def committed():
+                # Visible to other sessions by the time the callback runs
+                with store.session() as other:
+                    seen.append(store.get_customer(other, user_id) is not None)
+
+            store.after_commit(db, committed)
+
+        return insert
+
+    store.write(None, add(1))
+    with pytest.raises(Exception):
+        store.write(None, add(1))  # duplicate user: rolled back, callback dropped
+    writer.close()
+    assert seen == [True]
+
+
+def test_writer_answers_callers_before_running_callbacks(file_db):
+    _, _, get_db = file_db
+    writer = SQLiteWriter(get_db)
+    store = SQLAlchemyStore(get_db, None, None, None, writer=writer)
+    release = threading.Event()
+    threads = []
+
+    def slow_callback():
+        threads.append(threading.current_thread())
+        release.wait(5)
+
+    def write(db):
+        store.after_commit(db, slow_callback)
+        return "done"
+
+    # Neither the caller nor the next write waits for the slow callback
+    assert writer.submit(write).result(timeout=1) == "done"
+    assert writer.submit(lambda db: 2).result(timeout=1) == 2
+    release.set()
+    writer.close()
+    assert len(threads) == 1 and threads[0] is not writer._thread
+
+
+def test_writer_survives_a_failure_to_open_a_session(file_db):
+    _, _, get_db = file_db
+    failing = iter([True])
+
+    def flaky_get_db():
+        if next(failing, False):
+            raise ConnectionError("database unavailable")
+        return get_db()
+
+    writer = SQLiteWriter(flaky_get_db)
+    with pytest.raises(ConnectionError):
+        writer.write(lambda db: 1)
+    assert writer.submit(lambda db: 2).result(timeout=5) == 2
+    writer.close()
+
+
+def _checkout_event(n):
+    return {
+        "id": f"evt_{n}",
+        "type": "checkout.session.completed",
+        "data": {
+            "object": {
+                "id": f"cs_{n}",
+                "customer": f"cus_dev_{n}",
+                "mode": "subscription",
+                "subscription": f"sub_{n}",
+                "amount_total": 1000,
+                "metadata": {"price_id": "price_pro"},
+            }
+        },
+    }
+
+
+def test_init_pay_routes_webhook_writes_through_the_writer(file_db):
+    engine, Base, get_db = file_db
+    app = FastAPI()
+    config = PayConfig(sqlite_profile=True, webhook_max_concurrency=32, webhook_max_queue=200)
+    pay = init_pay(app, engine, Base, get_db, config=config)
+    for n in range(50):
+        pay.create_checkout(n, f"{n}@example.com", "price_pro")
+
+    async def storm():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            responses = await asyncio.gather(
+                *(
+                    client.post("/pay/webhook", content=json.dumps(_checkout_event(n)))
+                    for n in range(50)
+                )
+            )
+            health = await client.get("/pay/health/deep")
+        return [r.status_code for r in responses], health.json()
+
+    statuses, health = asyncio.run(storm())
+    assert statuses == [200] * 50
+    writer = app.state.pay_sqlite_writer
+    assert health["sqlite_writer"]["writes"] == writer.stats["writes"] == 100
+    # Customers created by checkout plus one write per webhook, in fewer commits
+    assert writer.stats["commits"] < 100
+    store = app.state.pay_store
+    with store.session() as db:
+        assert all(store.get_subscription(db, f"sub_{n}") for n in range(50))
+    writer.close()
@@ -0,0 +1,290 @@
+import json
+
+import pytest
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.orm.attributes import set_committed_value
+
+from viv_pay import init_pay
+from viv_pay.models import create_pay_models, utcnow
+from viv_pay.storage import ConcurrentUpdateError, Entitlement, MemoryStore, SQLAlchemyStore
+
+
+def _sqlalchemy_store():
+    engine = create_engine("sqlite:///:memory:")
+    Base = declarative_base()
+    models = create_pay_models(Base)
+    Base.metadata.create_all(bind=engine)
+    SessionLocal = sessionmaker(bind=engine)
+
+    def get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    return SQLAlchemyStore(get_db, *models)
+
+
+@pytest.fixture(params=["sqlalchemy", "memory"])
+def store(request):
+    return _sqlalchemy_store() if request.param == "sqlalchemy" else MemoryStore()
+
+
+def test_store_customer_round_trip(store):
+    with store.session() as db:
+        store.add_customer(db, 1, "a@example.com", "cus_1")
+        store.commit(db)
+
+    with store.session() as db:
+        by_user = store.get_customer(db, 1)
+        by_stripe = store.get_customer_by_stripe_id(db, "cus_1")
+        assert by_user.id == by_stripe.id
+        assert by_user.email == "a@example.com"
+        assert store.get_customer(db, 2) is None
+
+
+def test_store_bulk_customers(store):
+    with store.session() as db:
+        store.add_customers(db, [
+            {"user_id": i, "email": f"u{i}@example.com", "stripe_customer_id": f"cus_{i}"}
+            for i in (1, 2, 3)
+        ])
+        store.commit(db)
+
+    with store.session() as db:
+        assert store.get_customer_user_ids(db, [2, 3, 4]) == {2, 3}
+        assert store.get_customer(db, 3).stripe_customer_id == "cus_3"
+
+
+def test_store_active_subscription(store):
+    with store.session() as db:
+        customer = store.add_customer(db, 1, "a@example.com", "cus_1")
+        store.add_subscription(db, customer.id, "sub_1", "price_1", "incomplete")
+        store.commit(db)
+
+    with store.session() as db:
+        assert store.get_active_subscription(db, 1, ["active"]) is None
+        sub = store.get_subscription(db, "sub_1")
+        store.update_subscription(db, sub, status="active")
+        store.commit(db)
+
+    with store.session() as db:
+        active = store.get_active_subscription(db, 1, ["active", "trialing"])
+        assert active.stripe_subscription_id == "sub_1"
+        assert store.get_active_subscription(db, 2, ["active"]) is None
+
+
+def test_store_entitlement_is_immutable_value(store):
+    with store.session() as db:
+        customer = store.add_customer(db, 1, "a@example.com", "cus_1")
+        store.add_subscription(db, customer.id, "sub_1", "price_1", "trialing")
+        store.commit(db)
+        customer_id = customer.id
+
+    with store.session() as db:
+        entitlement = store.get_entitlement(db, 1, ["active", "trialing"])
+        assert store.get_entitlement(db, 1, ["active"]) is None
+    assert isinstance(entitlement, Entitlement)
+    assert (entitlement.stripe_subscription_id, entitlement.status) == ("sub_1", "trialing")
+    assert entitlement.customer_id == customer_id
+    with pytest.raises(AttributeError):
+        entitlement.status = "canceled"
+    with pytest.raises(AttributeError):
+        entitlement.extra = 1
+
+
+def test_store_subscription_skips_stale_events(store):
+    with store.session() as db:
+        customer = store.add_customer(db, 1, "a@example.com", "cus_1")
+        store.add_subscription(db, customer.id, "sub_1", "price_1", "active")
+        store.commit(db)
+
+    with store.session() as db:
+        sub = store.get_subscription(db, "sub_1")
+        assert store.update_subscription(db, sub, event_at=200, status="past_due")
+        # Delivered late: older than what is already applied
+        assert not store.update_subscription(db, sub, event_at=100, status="active")
+        store.commit(db)
+
+    with store.session() as db:
+        sub = store.get_subscription(db, "sub_1")
+        assert sub.status == "past_due"
+        assert sub.last_event_at == 200
+        assert sub.version == 2
+
+
+def test_sqlalchemy_store_update_retries_after_concurrent_write(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'pay.db'}")
+    Base = declarative_base()
+    models = create_pay_models(Base)
+    Base.metadata.create_all(bind=engine)
+    SessionLocal = sessionmaker(bind=engine)
+
+    def get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    store = SQLAlchemyStore(get_db, *models)
+    with store.session() as db:
+        customer = store.add_customer(db, 1, "a@example.com", "cus_1")
+        store.add_subscription(db, customer.id, "sub_1", "price_1", "active")
+        store.commit(db)
+
+    with store.session() as slow:
+        stale = store.get_subscription(slow, "sub_1")
+        with store.session() as fast:
+            sub = store.get_subscription(fast, "sub_1")
+            store.update_subscription(fast, sub, event_at=100, cancel_at=utcnow())
+            store.commit(fast)
+
+        assert stale.version == 1
+        assert store.update_subscription(slow, stale, event_at=150, status="past_due")
+        store.commit(slow)
+
+    with store.session() as db:
+        sub = store.get_subscription(db, "sub_1")
+        assert (sub.status, sub.version, sub.last_event_at) == ("past_due", 3, 150)
+        assert sub.cancel_at is not None  # the concurrent write was not lost
+
+    with store.session() as db:
+        sub = store.get_subscription(db, "sub_1")
+        db.refresh = lambda obj: None  # never sees the winner's version
+        set_committed_value(sub, "version", 1)
+        with pytest.raises(ConcurrentUpdateError):
+            store.update_subscription(db, sub, status="active")
+
+
+def test_store_payments(store):
+    with store.session() as db:
+        customer = store.add_customer(db, 1, "a@example.com", "cus_1")
+        store.add_payment(
+            db,
+            customer_id=customer.id,
+            stripe_session_id="cs_1",
+            stripe_payment_intent_id="pi_1",
+            amount_cents=500,
+            status="completed",
+        )
+        store.commit(db)
+
+    with store.session() as db:
+        payment = store.get_payment_by_intent(db, "pi_1")
+        assert payment.amount_cents == 500
+        store.update_payment(db, payment, status="refunded")
+        store.commit(db)
+
+    with store.session() as db:
+        assert store.get_payment_by_intent(db, "pi_1").status == "refunded"
+
+
+def test_store_idempotent_writes(store):
+    with store.session() as db:
+        first = store.get_or_add_customer(db, 1, "a@example.com", "cus_1")
+        again = store.get_or_add_customer(db, 1, "b@example.com", "cus_2")
+        assert again.id == first.id
+        assert again.stripe_customer_id == "cus_1"
+
+        assert store.add_subscription_if_new(db, first.id, "sub_1", "price_1", "active")
+        assert not store.add_subscription_if_new(db, first.id, "sub_1", "price_2", "trialing")
+        fields = dict(
+            customer_id=first.id,
+            stripe_session_id="cs_1",
+            stripe_payment_intent_id="pi_1",
+            amount_cents=500,
+            status="completed",
+        )
+        assert store.add_payment_if_new(db, **fields)
+        assert not store.add_payment_if_new(db, **fields)
+        store.commit(db)
+
+    with store.session() as db:
+        assert store.get_subscription(db, "sub_1").stripe_price_id == "price_1"
+        assert store.update_payment_by_intent(db, "pi_1", status="refunded")
+        assert not store.update_payment_by_intent(db, "pi_missing", status="refunded")
+        store.commit(db)
+
+    with store.session() as db:
+        assert store.get_payment_by_session(db, "cs_1").status == "refunded"
+
+
+def test_memory_store_enforces_unique_user():
+    store = MemoryStore()
+    store.add_customer(None, 1, "a@example.com", "cus_1")
+    with pytest.raises(ValueError):
+        store.add_customer(None, 1, "b@example.com", "cus_2")
+
+
+def test_init_pay_with_memory_store(db_setup, monkeypatch):
+    import viv_pay.middleware as middleware
+
+    engine, Base, get_db, _ = db_setup
+    store = MemoryStore()
+    app = FastAPI()
+    _, get_customer, require_subscription = init_pay(
+        app, engine, Base, get_db, app_name="TestApp", store=store
+    )
+
+    @app.get("/premium")
+    async def premium(sub=Depends(require_subscription)):
+        return {"sub": sub.stripe_subscription_id}
+
+    client = TestClient(app)
+    client.post(
+        "/pay/checkout",
+        content=json.dumps({"user_id": 9, "email": "m@example.com", "price_id": "price_x"}),
+    )
+    client.post(
+        "/pay/webhook",
+        content=json.dumps({
+            "type": "checkout.session.completed",
+            "data": {"object": {
+                "id": "cs_9",
+                "customer": "cus_dev_9",
+                "mode": "subscription",
+                "subscription": "sub_9",
+                "amount_total": 900,
+            }},
+        }),
+    )
+
+    assert get_customer(9).stripe_customer_id == "cus_dev_9"
+    assert store.subscriptions["sub_9"].status == "active"
+
+    # Exercise the real lookup path rather than the dev-mode bypass
+    monkeypatch.setattr(middleware, "is_dev_mode", lambda: False)
+    assert client.get("/premium?user_id=9").json() == {"sub": "sub_9"}
+    assert client.get("/premium?user_id=10").status_code == 403
+
+
+def test_store_rejects_duplicate_payment_intent(store):
+    with store.session() as db:
+        customer = store.add_customer(db, 1, "a@example.com", "cus_1")
+        store.add_payment(db, customer_id=customer.id, stripe_payment_intent_id="pi_1", amount_cents=100)
+        store.commit(db)
+        customer_id = customer.id
+
+    with pytest.raises(Exception):  # IntegrityError in SQL, ValueError in memory
+        with store.session() as db:
+            store.add_payment(db, customer_id=customer_id, stripe_payment_intent_id="pi_1", amount_cents=200)
+            store.commit(db)
+
+    with store.session() as db:
+        assert store.get_payment_by_intent(db, "pi_1").amount_cents == 100
+
+
+def test_pay_store_backends_must_implement_the_interface():
+    from viv_pay.storage import PayStore
+
+    class PartialStore(PayStore):
+        def session(self):
+            return None
+
+    with pytest.raises(TypeError, match="get_customer"):
+        PartialStore()
@@ -0,0 +1,69 @@
+import asyncio
+
+import stripe
+from fastapi import FastAPI
+
+from viv_pay import init_pay
+from viv_pay.config import PayConfig
+from viv_pay.storage import MemoryStore
+from viv_pay.storm import (
+    check_consistency,
+    generate_events,
+    interleave,
+    percentile,
+    run_storm,
+    seed_customers,
+    sign_payload,
+)
+
+
+def test_sign_payload_verifies_with_stripe():
+    payload = b'{"id": "evt_1", "object": "event", "type": "charge.refunded"}'
+    header = sign_payload(payload, "whsec_test")
+    event = stripe.Webhook.construct_event(payload, header, "whsec_test")
+    assert event.id == "evt_1"
+
+
+def test_generate_events_is_ordered_per_customer():
+    sequences, expected = generate_events(200, seed=1, start=1_000)
+    assert len(sequences) == len(expected) == 200
+    for events in sequences:
+        assert events[0]["type"] == "checkout.session.completed"
+        created = [e["created"] for e in events]
+        assert created == sorted(set(created))
+    statuses = {want.get("status") for want in expected.values()}
+    assert {"active", "past_due", "canceled"} <= statuses
+    assert "refunded" in {want["payment"] for want in expected.values()}
+
+    stream = interleave(sequences)
+    assert len(stream) == sum(len(events) for events in sequences)
+    assert all(e["type"] == "checkout.session.completed" for e in stream[:200])
+
+
+def test_percentile_nearest_rank():
+    values = [float(v) for v in range(1, 101)]
+    assert (percentile(values, 50), percentile(values, 99), percentile(values, 100)) == (
+        50.0, 99.0, 100.0
+    )
+    assert percentile([], 50) == 0.0
+
+
+def test_storm_against_in_process_app(db_setup):
+    engine, Base, get_db, _ = db_setup
+    store = MemoryStore()
+    app = FastAPI()
+    # Queue deep enough that nothing is shed; this checks correctness, not capacity
+    init_pay(app, engine, Base, get_db, config=PayConfig(webhook_max_queue=1000), store=store)
+
+    sequences, expected = generate_events(40, seed=2)
+    assert seed_customers(store, 40) == 40
+    assert seed_customers(store, 40) == 0
+
+    report = asyncio.run(run_storm(interleave(sequences), rate=500, app=app, arrival="poisson"))
+    assert report["sent"] == sum(len(events) for events in sequences)
+    assert report["statuses"] == {200: report["sent"]}
+    assert report["error_rate"] == 0.0
+    assert report["latency_ms"]["p50"] <= report["latency_ms"]["max"]
+
+    consistency = check_consistency(store, expected)
+    assert consistency == {"checked": 40, "mismatches": 0, "examples": []}
@@ -0,0 +1,111 @@
+import json
+
+import pytest
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+
+from viv_pay import init_pay
+from viv_pay.config import PayConfig
+from viv_pay.gateway import StripeGateway, StripeUnavailable
+from viv_pay.tracing import InMemorySpanExporter, PayTracer, server_timing_header
+
+
+@pytest.fixture
+def traced_app(db_setup):
+    engine, Base, get_db, SessionLocal = db_setup
+    exporter = InMemorySpanExporter()
+    app = FastAPI()
+    pay = init_pay(
+        app,
+        engine,
+        Base,
+        get_db,
+        config=PayConfig(server_timing=True),
+        tracer=PayTracer(exporter, otel=False),
+    )
+    return app, pay, exporter
+
+
+def test_checkout_spans_and_server_timing(traced_app):
+    app, _, exporter = traced_app
+    resp = TestClient(app).post(
+        "/pay/checkout",
+        content=json.dumps({"user_id": 7, "email": "u7@example.com", "price_id": "price_1"}),
+    )
+    assert resp.status_code == 200
+
+    phases = [part.split(";")[0] for part in resp.headers["Server-Timing"].split(", ")]
+    assert phases == ["db", "db.commit", "total"]
+
+    root = exporter.spans[-1]
+    assert root.name == "POST /pay/checkout"
+    queries = [s for s in exporter.spans if s.name == "db.query"]
+    assert queries and all(s.parent is root for s in queries)
+    assert any("INSERT INTO stripe_customers" in s.attributes["db.statement"] for s in queries)
+
+
+def test_webhook_handler_span(traced_app):
+    app, _, exporter = traced_app
+    event = {
+        "id": "evt_1",
+        "type": "checkout.session.completed",
+        "data": {"object": {"id": "cs_1", "customer": "cus_1", "mode": "payment"}},
+    }
+    resp = TestClient(app).post("/pay/webhook", content=json.dumps(event))
+    assert resp.status_code == 200
+
+    span = next(s for s in exporter.spans if s.name == "webhook._handle_checkout_completed")
+    assert span.attributes["stripe.event_type"] == "checkout.session.completed"
+    assert span.parent.name == "POST /pay/webhook"
+    assert "webhook;dur=" in resp.headers["Server-Timing"]
+
+
+def test_require_subscription_span(traced_app, monkeypatch):
+    from viv_pay import middleware
+
+    monkeypatch.setattr(middleware, "is_dev_mode", lambda: False)
+    app, pay, exporter = traced_app
+
+    @app.get("/premium")
+    async def premium(sub=Depends(pay.require_subscription)):
+        return {"ok": True}
+
+    resp = TestClient(app).get("/premium?user_id=3")
+    assert resp.status_code == 403
+
+    span = next(s for s in exporter.spans if s.name == "require_subscription")
+    assert span.attributes["user.id"] == 3
+    assert [s.parent for s in exporter.spans if s.name == "db.query"] == [span]
+
+
+def test_gateway_call_span_records_attempts_and_errors():
+    exporter = InMemorySpanExporter()
+    gateway = StripeGateway(
+        PayConfig(stripe_retry_base_delay=0.001, stripe_max_retries=1),
+        PayTracer(exporter, otel=False),
+    )
+    assert gateway.call("customer.create", lambda: "cus_1") == "cus_1"
+
+    err = ConnectionError("down")
+    err.should_retry = True
+
+    def flaky():
+        raise err
+
+    with pytest.raises(StripeUnavailable):
+        gateway.call("customer.retrieve", flaky)
+
+    ok, failed = exporter.spans
+    assert (ok.name, ok.attributes["stripe.attempts"], ok.error) == (
+        "stripe.customer.create", 1, None
+    )
+    assert (failed.name, failed.error) == ("stripe.customer.retrieve", "StripeUnavailable")
+
+
+def test_tracer_without_backends_is_a_no_op():
+    tracer = PayTracer(otel=False)
+    with tracer.span("anything", phase="x") as span:
+        assert span is None
+    assert server_timing_header([("db", 0.001), ("stripe.x", 0.01), ("db", 0.002)]) == (
+        "db;dur=3.0, stripe.x;dur=10.0"
+    )
@@ -0,0 +1,149 @@
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.dialects import mysql, postgresql
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+from viv_pay.models import create_pay_models
+from viv_pay.upsert import insert_ignore, insert_ignore_many, insert_or_get, upsert
+
+
+@pytest.fixture
+def sqlite_db():
+    engine = create_engine("sqlite:///:memory:")
+    Base = declarative_base()
+    models = create_pay_models(Base)
+    Base.metadata.create_all(bind=engine)
+    statements = []
+    event.listen(
+        engine, "before_cursor_execute", lambda *args: statements.append(args[2].split()[0])
+    )
+    db = sessionmaker(bind=engine)()
+    yield db, models, statements
+    db.close()
+
+
+def test_sqlite_upserts_are_single_statements(sqlite_db):
+    db, (StripeCustomer, Subscription, _), statements = sqlite_db
+    values = {"user_id": 1, "email": "a@example.com", "stripe_customer_id": "cus_1"}
+    customer = insert_or_get(db, StripeCustomer, values, "user_id")
+    again = insert_or_get(db, StripeCustomer, dict(values, stripe_customer_id="cus_2"), "user_id")
+    assert again is customer
+    assert (again.id, again.stripe_customer_id) == (customer.id, "cus_1")
+
+    sub = {"customer_id": customer.id, "stripe_subscription_id": "sub_1", "stripe_price_id": "p"}
+    assert insert_ignore(db, Subscription, sub, "stripe_subscription_id")
+    assert not insert_ignore(db, Subscription, sub, "stripe_subscription_id")
+    assert statements == ["INSERT"] * 4
+    assert db.query(Subscription).one().version == 1  # column defaults still apply
+
+
+def test_add_customers_is_one_statement_per_chunk(sqlite_db):
+    from viv_pay.storage import SQLAlchemyStore
+
+    db, models, statements = sqlite_db
+    store = SQLAlchemyStore(None, *models)
+
+    def chunk(user_ids):
+        return [
+            {"user_id": u, "email": f"u{u}@example.com", "stripe_customer_id": f"cus_{u}"}
+            for u in user_ids
+        ]
+
+    assert store.add_customers(db, chunk(range(500))) == 500
+    assert statements == ["INSERT"]
+    # Users 400-499 got a customer meanwhile: skipped, not an error
+    assert store.add_customers(db, chunk(range(400, 900))) == 400
+    assert store.add_customers(db, []) == 0
+    assert statements == ["INSERT"] * 2
+    assert db.query(models[0]).count() == 900
+
+
+class _RecordingSession:
+    """Just enough of a Session to capture the statements for another dialect."""
+
+    def __init__(self, dialect):
+        self.dialect = dialect
+        self.sql = []
+
+    def get_bind(self):
+        return SimpleNamespace(dialect=self.dialect)
+
+    def execute(self, stmt, params=None):
+        self.sql.append(" ".join(str(stmt.compile(dialect=self.dialect)).split()))
+        rows = params if isinstance(params, list) else [params]
+        return SimpleNamespace(rowcount=1, lastrowid=7, all=lambda: rows)
+
+    def scalars(self, stmt, execution_options=None):
+        self.execute(stmt)
+        return SimpleNamespace(one=lambda: "row")
+
+    def get(self, Model, pk):
+        return ("get", pk)
+
+
+def test_postgresql_and_mysql_statements():
+    StripeCustomer, Subscription, _ = create_pay_models(declarative_base())
+    values = {"user_id": 1, "email": "a@example.com", "stripe_customer_id": "cus_1"}
+    sub = {"customer_id": 1, "stripe_subscription_id": "sub_1", "stripe_price_id": "p"}
+
+    pg = _RecordingSession(postgresql.dialect())
+    assert insert_or_get(pg, StripeCustomer, values, "user_id") == "row"
+    assert insert_ignore(pg, Subscription, sub, "stripe_subscription_id")
+    assert "ON CONFLICT (user_id) DO UPDATE SET user_id = excluded.user_id RETURNING" in pg.sql[0]
+    assert "ON CONFLICT (stripe_subscription_id) DO NOTHING" in pg.sql[1]
+    assert insert_ignore_many(pg, StripeCustomer, [values, values], "user_id") == 2
+    assert pg.sql[2].endswith("ON CONFLICT (user_id) DO NOTHING RETURNING stripe_customers.user_id")
+
+    my = _RecordingSession(mysql.dialect())
+    assert insert_or_get(my, StripeCustomer, values, "user_id") == ("get", 7)
+    assert insert_ignore(my, Subscription, sub, "stripe_subscription_id")
+    assert my.sql[0].endswith(
+        "ON DUPLICATE KEY UPDATE id = last_insert_id(stripe_customers.id)"
+    )
+    assert my.sql[1].startswith("INSERT IGNORE INTO subscriptions")
+    assert insert_ignore_many(my, StripeCustomer, [values, values], "user_id") == 1
+    assert my.sql[2].startswith("INSERT IGNORE INTO stripe_customers")
+
+
+def test_upsert_overwrites_other_columns(sqlite_db):
+    db, (StripeCustomer, _, _), _ = sqlite_db
+    rows = [
+        {"user_id": 1, "email": "a@example.com", "stripe_customer_id": "cus_1"},
+        {"user_id": 2, "email": "b@example.com", "stripe_customer_id": "cus_2"},
+    ]
+    upsert(db, StripeCustomer, rows, "user_id")
+    upsert(db, StripeCustomer, [dict(rows[0], email="new@example.com")], "user_id")
+    emails = dict(db.query(StripeCustomer.user_id, StripeCustomer.email).all())
+    assert emails == {1: "new@example.com", 2: "b@example.com"}
+
+
+def test_upsert_newer_keeps_later_rows(sqlite_db):
+    db, (_, Subscription, _), _ = sqlite_db
+    sub = {"customer_id": 1, "stripe_subscription_id": "sub_1", "stripe_price_id": "p", "version": 5}
+    assert upsert(db, Subscription, [sub], "stripe_subscription_id", newer="version") == 1
+    stale = dict(sub, stripe_price_id="old", version=4)
+    assert upsert(db, Subscription, [stale], "stripe_subscription_id", newer="version") == 0
+    later = dict(sub, stripe_price_id="new", version=6)
+    assert upsert(db, Subscription, [later], "stripe_subscription_id", newer="version") == 1
+    assert db.query(Subscription.stripe_price_id, Subscription.version).one() == ("new", 6)
+
+
+def test_upsert_newer_statements():
+    _, Subscription, _ = create_pay_models(declarative_base())
+    sub = {"stripe_subscription_id": "sub_1", "version": 2, "stripe_price_id": "p"}
+
+    pg = _RecordingSession(postgresql.dialect())
+    upsert(pg, Subscription, [sub], "stripe_subscription_id", newer="version")
+    assert pg.sql[0].endswith("WHERE subscriptions.version <= excluded.version")
+
+    my = _RecordingSession(mysql.dialect())
+    upsert(my, Subscription, [sub], "stripe_subscription_id", newer="version")
+    # The guard column is assigned last, after the others compared against it
+    assert my.sql[0].endswith(
+        "stripe_price_id = if(subscriptions.version <= VALUES(version), "
+        "VALUES(stripe_price_id), subscriptions.stripe_price_id), "
+        "version = if(subscriptions.version <= VALUES(version), "
+        "VALUES(version), subscriptions.version)"
+    )
@@ -0,0 +1,260 @@
+import time
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from viv_pay.models import create_pay_models, create_usage_model
+from viv_pay.usage import UsageRecorder
+
+
+@pytest.fixture
+def usage_db():
+    engine = create_engine(
+        "sqlite:///:memory:",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    Base = declarative_base()
+    StripeCustomer, _, _ = create_pay_models(Base)
+    UsageRecord = create_usage_model(Base)
+    Base.metadata.create_all(bind=engine)
+    SessionLocal = sessionmaker(bind=engine)
+
+    def get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    return get_db, SessionLocal, UsageRecord, StripeCustomer
+
+
+class FakeGateway:
+    def __init__(self, fail_after=None):
+        self.calls = []
+        self.fail_after = fail_after
+
+    def call(self, op, fn, *args, **params):
+        if self.fail_after is not None and len(self.calls) >= self.fail_after:
+            raise ConnectionError("stripe down")
+        self.calls.append((op, params))
+
+
+def test_usage_flush_aggregates_per_window(usage_db):
+    get_db, SessionLocal, UsageRecord, StripeCustomer = usage_db
+    usage = UsageRecorder(get_db, UsageRecord, StripeCustomer, window=60)
+
+    for _ in range(1000):
+        usage.record(1, "api_calls", timestamp=120.5)
+    usage.record(1, "api_calls", 5, timestamp=179.9)
+    usage.record(1, "api_calls", timestamp=180.0)  # next window
+    usage.record(2, "tokens", 300, timestamp=130)
+
+    assert usage.flush() == 3
+    assert usage.flush() == 0
+    db = SessionLocal()
+    rows = {
+        (r.user_id, r.meter, r.window_start): r.quantity
+        for r in db.query(UsageRecord).all()
+    }
+    db.close()
+    assert rows == {
+        (1, "api_calls", 120): 1005,
+        (1, "api_calls", 180): 1,
+        (2, "tokens", 120): 300,
+    }
+    assert usage.stats()["recorded"] == 1003
+
+
+def test_usage_flushes_add_to_one_row_per_window(usage_db, monkeypatch):
+    monkeypatch.setattr("viv_pay.usage.is_dev_mode", lambda: False)
+    get_db, SessionLocal, UsageRecord, StripeCustomer = usage_db
+    db = SessionLocal()
+    db.add(StripeCustomer(user_id=1, email="a@example.com", stripe_customer_id="cus_1"))
+    db.commit()
+    db.close()
+
+    gateway = FakeGateway()
+    usage = UsageRecorder(get_db, UsageRecord, StripeCustomer, gateway, retention_days=0)
+    for _ in range(3):  # e.g. three one-second flushes in the same window
+        usage.record(1, "api_calls", 2, timestamp=60)
+        usage.flush()
+    db = SessionLocal()
+    assert [r.quantity for r in db.query(UsageRecord).all()] == [6]
+    db.close()
+
+    assert usage.push() == 1
+    assert gateway.calls[0][1]["payload"]["value"] == "6"
+
+    # Late usage for a window already sent opens a new row, sent on its own
+    usage.record(1, "api_calls", 1, timestamp=61)
+    usage.flush()
+    assert usage.push() == 1
+    assert gateway.calls[1][1]["payload"]["value"] == "1"
+    assert gateway.calls[1][1]["identifier"] != gateway.calls[0][1]["identifier"]
+
+    # Pushed rows past retention are pruned
+    db = SessionLocal()
+    assert db.query(UsageRecord).count() == 0
+    db.close()
+    assert usage.stats()["pruned"] == 2
+
+
+def test_usage_ring_buffer_counts_drops(usage_db):
+    get_db, _, UsageRecord, StripeCustomer = usage_db
+    usage = UsageRecorder(get_db, UsageRecord, StripeCustomer, buffer_size=10)
+    for i in range(25):
+        usage.record(1, "api_calls")
+    stats = usage.stats()
+    assert (stats["buffered"], stats["dropped"]) == (10, 15)
+
+
+def test_usage_push_sends_meter_events(usage_db, monkeypatch):
+    monkeypatch.setattr("viv_pay.usage.is_dev_mode", lambda: False)
+    get_db, SessionLocal, UsageRecord, StripeCustomer = usage_db
+    db = SessionLocal()
+    db.add(StripeCustomer(user_id=1, email="a@example.com", stripe_customer_id="cus_1"))
+    db.commit()
+    db.close()
+
+    gateway = FakeGateway()
+    usage = UsageRecorder(get_db, UsageRecord, StripeCustomer, gateway, batch_size=2)
+    for ts in (0, 60, 120):
+        usage.record(1, "api_calls", 2, timestamp=ts)
+    usage.record(2, "api_calls", timestamp=0)  # no Stripe customer yet
+    usage.flush()
+
+    assert usage.push() == 3
+    assert usage.push() == 0
+    op, params = gateway.calls[0]
+    assert op == "billing.meter_event.create"
+    assert params["event_name"] == "api_calls"
+    assert params["payload"] == {"stripe_customer_id": "cus_1", "value": "2"}
+    assert params["identifier"].startswith("viv-pay-usage-")
+    assert [p["timestamp"] for _, p in gateway.calls] == [0, 60, 120]
+
+    db = SessionLocal()
+    pending = db.query(UsageRecord).filter(UsageRecord.pushed_at.is_(None)).all()
+    db.close()
+    assert [r.user_id for r in pending] == [2]
+
+
+def test_usage_push_failure_keeps_sent_rows(usage_db, monkeypatch):
+    monkeypatch.setattr("viv_pay.usage.is_dev_mode", lambda: False)
+    get_db, SessionLocal, UsageRecord, StripeCustomer = usage_db
+    db = SessionLocal()
+    db.add(StripeCustomer(user_id=1, email="a@example.com", stripe_customer_id="cus_1"))
+    db.commit()
+    db.close()
+
+    usage = UsageRecorder(get_db, UsageRecord, StripeCustomer, FakeGateway(fail_after=2))
+    for ts in (0, 60, 120):
+        usage.record(1, "api_calls", timestamp=ts)
+    usage.flush()
+
+    with pytest.raises(ConnectionError):
+        usage.push()
+    sent = [p["identifier"] for _, p in usage.gateway.calls]
+    usage.gateway = FakeGateway()
+    assert usage.push() == 1  # only the row that failed is resent
+    assert usage.gateway.calls[0][1]["identifier"] not in sent
+
+
+def test_init_pay_record_usage_flushes_on_shutdown(db_setup):
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+
+    from viv_pay import PayConfig, init_pay
+
+    engine, Base, get_db, SessionLocal = db_setup
+    app = FastAPI()
+    pay = init_pay(app, engine, Base, get_db, config=PayConfig(usage_metering=True))
+
+    with TestClient(app):
+        pay.record_usage(1, "api_calls", 3)
+        pay.record_usage(1, "api_calls", 4)
+
+    UsageRecord = Base.metadata.tables["usage_records"]
+    db = SessionLocal()
+    rows = db.execute(UsageRecord.select()).all()
+    db.close()
+    assert [(r.user_id, r.meter, r.quantity) for r in rows] == [(1, "api_calls", 7)]
+
+
+def test_usage_metering_is_off_by_default(db_setup):
+    from fastapi import FastAPI
+
+    from viv_pay import init_pay
+
+    engine, Base, get_db, _ = db_setup
+    app = FastAPI()
+    pay = init_pay(app, engine, Base, get_db)
+    assert "usage_records" not in Base.metadata.tables
+    assert not hasattr(app.state, "pay_usage")
+    with pytest.raises(RuntimeError, match="usage_metering"):
+        pay.record_usage(1, "api_calls")
+
+
+def test_usage_requeue_after_failed_flush_counts_evictions(usage_db):
+    get_db, _, UsageRecord, StripeCustomer = usage_db
+    usage = UsageRecorder(get_db, UsageRecord, StripeCustomer, buffer_size=3)
+    for user_id in (1, 2, 3):
+        usage.record(user_id, "api_calls", timestamp=0)
+
+    def failing_get_db():
+        for db in get_db():
+            # Records arriving while the flush runs fill the buffer again
+            for user_id in (4, 5, 6):
+                usage.record(user_id, "api_calls", timestamp=0)
+            db.execute = None  # any statement fails
+            yield db
+
+    usage.get_db = failing_get_db
+    with pytest.raises(TypeError):
+        usage.flush()
+    stats = usage.stats()
+    assert stats["buffered"] == 3
+    assert stats["dropped"] == 3  # nothing vanished without being counted
+    assert stats["recorded"] - stats["dropped"] == stats["buffered"] + stats["flushed"]
+
+
+def test_usage_dev_mode_prunes_rows_that_are_never_pushed(usage_db):
+    get_db, SessionLocal, UsageRecord, StripeCustomer = usage_db
+    usage = UsageRecorder(get_db, UsageRecord, StripeCustomer, retention_days=1)
+    now = time.time()
+    usage.record(1, "api_calls", timestamp=now - 3 * 86400)
+    usage.record(1, "api_calls", timestamp=now)
+    usage.flush()
+
+    assert usage.push() == 0  # dev mode: nothing sent
+    db = SessionLocal()
+    rows = db.query(UsageRecord).all()
+    db.close()
+    assert len(rows) == 1 and rows[0].window_start > now - 86400
+    assert usage.stats()["pruned"] == 1
+
+
+def test_usage_writes_go_through_the_sqlite_writer(usage_db, monkeypatch):
+    from viv_pay.sqlite import SQLiteWriter
+
+    monkeypatch.setattr("viv_pay.usage.is_dev_mode", lambda: False)
+    get_db, SessionLocal, UsageRecord, StripeCustomer = usage_db
+    db = SessionLocal()
+    db.add(StripeCustomer(user_id=1, email="a@example.com", stripe_customer_id="cus_1"))
+    db.commit()
+    db.close()
+
+    writer = SQLiteWriter(get_db)
+    usage = UsageRecorder(get_db, UsageRecord, StripeCustomer, FakeGateway(), writer=writer)
+    usage.record(1, "api_calls", 3, timestamp=0)
+    assert usage.flush() == 1
+    assert usage.push() == 1
+    writer.close()
+    # flush, claim, mark pushed, claim (nothing left), prune
+    assert writer.stats["writes"] == 5
+    db = SessionLocal()
+    assert db.query(UsageRecord).one().pushed_at is not None
+    db.close()
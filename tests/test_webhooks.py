@@ -1,4 +1,6 @@
 import json
+import os
+import time
 
 
 def _post_webhook(client, event_type, data):
@@ -97,3 +99,222 @@ def test_webhook_unknown_event(client):
 def test_webhook_invalid_payload(client):
     resp = client.post("/pay/webhook", content=b"not json")
     assert resp.status_code == 400
+
+
+def _counting_registry_app(db_setup):
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+
+    from viv_pay import init_pay
+
+    engine, Base, get_db, _ = db_setup
+    opened = []
+
+    def counting_get_db():
+        opened.append(1)
+        yield from get_db()
+
+    app = FastAPI()
+    init_pay(app, engine, Base, counting_get_db, app_name="TestApp")
+    return app, TestClient(app), opened
+
+
+def test_webhook_unhandled_event_skips_db(db_setup):
+    app, client, opened = _counting_registry_app(db_setup)
+
+    resp = _post_webhook(client, "customer.created", {"id": "cus_x"})
+    assert resp.status_code == 200
+    assert resp.json()["received"] is True
+    assert opened == []
+
+
+def test_webhook_registry_custom_handlers(db_setup):
+    app, client, opened = _counting_registry_app(db_setup)
+    registry = app.state.pay_webhooks
+    seen = []
+    timings = []
+
+    @registry.on("invoice.paid", needs_db=False)
+    async def on_invoice_paid(db, data, event):
+        seen.append(("async", db, data["id"]))
+
+    @registry.on("invoice.paid", needs_db=False)
+    def on_invoice_paid_sync(db, data, event):
+        seen.append(("sync", db, event["type"]))
+
+    registry.add_timing_hook(
+        lambda event_type, name, seconds, error: timings.append((event_type, name, error))
+    )
+
+    resp = _post_webhook(client, "invoice.paid", {"id": "in_123"})
+    assert resp.status_code == 200
+    assert seen == [("async", None, "in_123"), ("sync", None, "invoice.paid")]
+    assert opened == []  # no handler needed a session
+    assert [t[1] for t in timings] == ["on_invoice_paid", "on_invoice_paid_sync"]
+    assert all(t[2] is None for t in timings)
+
+
+def test_webhook_handler_error_returns_500(db_setup):
+    app, client, opened = _counting_registry_app(db_setup)
+
+    @app.state.pay_webhooks.on("invoice.paid")
+    def boom(db, data, event):
+        raise RuntimeError("boom")
+
+    resp = _post_webhook(client, "invoice.paid", {"id": "in_1"})
+    assert resp.status_code == 500
+    assert opened == [1]
+
+
+def test_webhook_archive_round_trip(tmp_path):
+    from viv_pay.webhooks import WebhookArchive
+
+    archive = WebhookArchive(tmp_path, segment_bytes=2048, block_bytes=512)
+    bodies = {
+        f"evt_{i}": json.dumps({"id": f"evt_{i}", "nonce": os.urandom(64).hex()}).encode()
+        for i in range(60)
+    }
+    for event_id, body in bodies.items():
+        assert archive.append(event_id, body)
+    archive.flush()
+
+    assert len(archive.segments()) > 1  # rotated
+    assert archive.get("evt_37") == bodies["evt_37"]
+    assert archive.get("evt_missing") is None
+    assert list(archive.iter_payloads()) == list(bodies.items())
+    archive.close()
+
+    # A fresh instance rebuilds the index from the sidecars
+    reopened = WebhookArchive(tmp_path)
+    assert reopened.get("evt_0") == bodies["evt_0"]
+    reopened.close()
+
+
+def test_webhook_archive_workers_write_separate_segments(tmp_path):
+    from viv_pay.webhooks import WebhookArchive
+
+    workers = [WebhookArchive(tmp_path, block_bytes=1) for _ in range(2)]
+    for n in range(20):
+        workers[n % 2].append(f"evt_{n}", b'{"n": %d}' % n)
+    for archive in workers:
+        archive.flush()
+
+    segments = workers[0].segments()
+    assert len(segments) == 2
+    assert workers[0].stats()["segment"] != workers[1].stats()["segment"]
+    # Each index entry points at a block of its own writer's segment
+    for n in range(20):
+        assert workers[0].get(f"evt_{n}") == b'{"n": %d}' % n
+    assert sorted(event_id for event_id, _ in workers[1].iter_payloads()) == sorted(
+        f"evt_{n}" for n in range(20)
+    )
+    for archive in workers:
+        archive.close()
+
+
+def test_webhook_archive_drops_when_queue_full(tmp_path):
+    from viv_pay.webhooks import WebhookArchive
+
+    archive = WebhookArchive(tmp_path, max_queue=1)
+    archive._queue.put(("evt_blocker", b"{}"))  # may or may not be consumed yet
+    results = [archive.append(f"evt_{i}", b"{}") for i in range(50)]
+    assert not all(results)
+    assert archive.stats()["dropped"] == results.count(False)
+    archive.close()
+
+
+def test_webhook_archive_survives_write_errors(tmp_path):
+    from viv_pay.webhooks import WebhookArchive
+
+    archive = WebhookArchive(tmp_path, flush_interval=0.01)
+    failing = archive._segment
+    original = archive._write_block
+
+    def disk_full():
+        if archive._segment == failing:
+            raise OSError(28, "No space left on device")
+        original()
+
+    archive._write_block = disk_full
+    archive.append("evt_lost", b"{}")
+    deadline = time.monotonic() + 5
+    while not archive.stats()["failed"] and time.monotonic() < deadline:
+        time.sleep(0.01)  # the idle write fails and drops the block
+    assert archive._thread.is_alive()
+    assert archive.stats()["failed"] == 1
+    assert archive._segment != failing
+
+    archive.append("evt_kept", b'{"ok": true}')
+    archive.flush(timeout=5)
+    assert archive.get("evt_kept") == b'{"ok": true}'
+    assert archive.get("evt_lost") is None
+    archive.close()
+
+
+def test_webhook_archive_flush_returns_after_a_write_error(tmp_path):
+    from viv_pay.webhooks import WebhookArchive
+
+    archive = WebhookArchive(tmp_path, flush_interval=60)
+
+    def disk_full():
+        raise OSError(28, "No space left on device")
+
+    archive._write_block = disk_full
+    archive.append("evt_1", b"{}")
+    archive.flush(timeout=5)
+    assert archive.stats()["failed"] == 1
+    assert archive._block == []
+    archive.close()
+    assert not archive._thread.is_alive()
+
+
+def test_webhook_endpoint_archives_raw_body(db_setup, tmp_path):
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+
+    from viv_pay import PayConfig, init_pay
+
+    engine, Base, get_db, _ = db_setup
+    app = FastAPI()
+    init_pay(
+        app, engine, Base, get_db,
+        config=PayConfig(webhook_archive_dir=str(tmp_path)),
+    )
+    raw = b'{"id": "evt_raw",  "type": "customer.created", "data": {"object": {}}}'
+    with TestClient(app) as client:
+        resp = client.post("/pay/webhook", content=raw)
+        assert resp.status_code == 200
+    # Lifespan shutdown closed (and flushed) the archive
+    assert app.state.pay_webhook_archive.get("evt_raw") == raw
+
+
+def test_webhook_out_of_order_subscription_events(client):
+    client.post(
+        "/pay/checkout",
+        content=json.dumps({"user_id": 7, "email": "o@example.com", "price_id": "price_test"}),
+    )
+    _post_webhook(client, "checkout.session.completed", {
+        "id": "cs_order",
+        "customer": "cus_dev_7",
+        "mode": "subscription",
+        "subscription": "sub_order",
+        "amount_total": 2000,
+        "currency": "usd",
+    })
+
+    def post(created, status):
+        event = {
+            "type": "customer.subscription.updated",
+            "created": created,
+            "data": {"object": {"id": "sub_order", "status": status}},
+        }
+        return client.post("/pay/webhook", content=json.dumps(event))
+
+    assert post(200, "past_due").status_code == 200
+    assert post(100, "active").status_code == 200  # delivered late, ignored
+
+    store = client.app.state.pay_store
+    with store.session() as db:
+        sub = store.get_subscription(db, "sub_order")
+        assert sub.status == "past_due"
+        assert sub.last_event_at == 200
@@ -1,25 +1,92 @@
+import functools
 import logging
+import math
 import os
+import socket
 from pathlib import Path
 
 from fastapi import APIRouter, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, Response
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.engine import Engine
+from starlette.concurrency import run_in_threadpool
 
+from .admission import AdmissionController, Overloaded
+from .archive import PaymentArchive, create_payment_archiver
+from .catalog import CATALOG_EVENT_TYPES, InvalidPrice, PriceCatalog
 from .checkout import create_checkout_helper
 from .config import PayConfig, get_stripe_publishable_key, is_dev_mode
-from .customer import create_customer_helpers
-from .middleware import PaymentRequired, create_require_subscription
-from .models import create_pay_models
+from .customer import create_customer_helpers, default_app_id
+from .customer_cache import CustomerIdCache
+from .entitlements import FeatureMap, create_require_feature
+from .gateway import StripeGateway, StripeUnavailable
+from .health import LoopLagMonitor, StripeProbe, create_health_handlers
+from .lifespan import add_lifespan_hooks
+from .log import configure_logging
+from .middleware import (
+    PaymentRequired,
+    SubscriptionGateMiddleware,
+    create_require_subscription,
+    create_subscription_resolver,
+)
+from .models import (
+    create_catalog_models,
+    create_event_cursor_model,
+    create_job_lease_model,
+    create_pay_models,
+    create_usage_model,
+)
+from .poller import EventPoller, MemoryCursor, SQLCursor
 from .portal import create_portal_helper
-from .webhooks import create_webhook_handler
+from .provision import provision_customers
+from .scheduler import JobScheduler, SQLLease
+from .snapshot import SNAPSHOT_EVENT_TYPES, EntitlementSnapshot, SnapshotWriter
+from .sqlite import SQLiteWriter, configure_sqlite
+from .storage import MemoryStore, PayStore, SQLAlchemyStore
+from .tracing import PayTracer, create_traced_route_class, instrument_engine
+from .usage import UsageRecorder
+from .webhooks import (
+    WebhookArchive,
+    WebhookRegistry,
+    create_default_registry,
+    create_webhook_handler,
+)
 
 logger = logging.getLogger("viv-pay")
 
 TEMPLATES_DIR = Path(__file__).parent / "templates"
 
 
+class PayHandles(tuple):
+    """What init_pay returns.
+
+    Unpacks as (create_checkout, get_customer, require_subscription) like it
+    always has; additional helpers are available as attributes, e.g.
+    `pay.require_feature`.
+    """
+
+    def __new__(cls, create_checkout, get_customer, require_subscription, **extras):
+        handles = super().__new__(cls, (create_checkout, get_customer, require_subscription))
+        handles.__dict__.update(extras)
+        return handles
+
+    @property
+    def create_checkout(self):
+        return self[0]
+
+    @property
+    def get_customer(self):
+        return self[1]
+
+    @property
+    def require_subscription(self):
+        return self[2]
+
+
+def _usage_metering_off(user_id: int, meter: str, quantity: int = 1, timestamp=None):
+    raise RuntimeError("usage metering is off; set PayConfig(usage_metering=True)")
+
+
 def init_pay(
     app,
     engine: Engine,
@@ -28,13 +95,39 @@ def init_pay(
     app_name: str = "App",
     app_url: str | None = None,
     config: PayConfig | None = None,
+    store: PayStore | None = None,
+    tracer: PayTracer | None = None,
 ):
     """Initialize viv-pay on a FastAPI app.
 
-    Returns (create_checkout, get_customer, require_subscription).
+    `store` defaults to a SQLAlchemyStore over the app's get_db; pass
+    MemoryStore() for tests and dev runs. `tracer` defaults to a PayTracer
+    that reports to OpenTelemetry when it is installed.
+
+    Returns (create_checkout, get_customer, require_subscription) as a
+    PayHandles tuple, which also carries `require_feature`, `feature_map`,
+    `record_usage`, `provision_customers` and `schedule`.
     """
     config = config or PayConfig()
 
+    if config.structured_logging:
+        logging_setup = configure_logging(
+            sample_rates=config.log_sample_rates,
+            rate_limit=config.log_rate_limit,
+            start=False,
+        )
+        app.state.pay_logging = logging_setup
+
+        async def start_logging():
+            logging_setup.start()
+
+        async def stop_logging():
+            logging_setup.stop()
+
+        # Hooks added later start last and stop first, so this one covers
+        # the startup and shutdown logs of every other viv-pay hook
+        add_lifespan_hooks(app, start_logging, stop_logging)
+
     if app_url is None:
         app_url = os.environ.get("APP_URL", "http://localhost:8000")
     app_url = app_url.rstrip("/")
@@ -44,39 +137,189 @@ def init_pay(
         import stripe
 
         stripe.api_key = os.environ["STRIPE_SECRET_KEY"]
+        # StripeGateway owns retries (with budget + backoff); avoid stacking
+        # the SDK's own network retries on top of them.
+        stripe.max_network_retries = 0
+        # Upper bound for abandoned attempts; per-operation timeouts are
+        # enforced by the gateway.
+        stripe.default_http_client = stripe.new_default_http_client(
+            timeout=max(
+                [config.stripe_default_timeout, *config.stripe_timeouts.values()]
+            )
+        )
         logger.info("[viv-pay] Stripe configured (live mode)")
     else:
         logger.info("[viv-pay] DEV MODE — Stripe not configured, using mocks")
 
+    tracer = tracer or PayTracer()
+    app.state.pay_tracer = tracer
+    instrument_engine(engine, tracer)
+
     # 2. Create models
     StripeCustomer, Subscription, Payment = create_pay_models(Base)
 
     # 3. Create helpers (take db as first arg)
-    get_customer, get_or_create_customer = create_customer_helpers(StripeCustomer)
-    _create_checkout = create_checkout_helper(get_or_create_customer, config, app_url)
-    _create_portal = create_portal_helper(get_customer, app_url)
-    require_subscription = create_require_subscription(
-        get_db, StripeCustomer, Subscription, config
+    sqlite_writer = None
+    if config.sqlite_profile:
+        if engine.dialect.name == "sqlite":
+            configure_sqlite(
+                engine,
+                busy_timeout=config.sqlite_busy_timeout,
+                mmap_size=config.sqlite_mmap_size,
+            )
+            if store is None:
+                sqlite_writer = SQLiteWriter(get_db, max_batch=config.sqlite_max_batch)
+                app.state.pay_sqlite_writer = sqlite_writer
+
+                async def close_sqlite_writer():
+                    await run_in_threadpool(sqlite_writer.close)
+
+                # Registered before the hooks that write, so it stops after them
+                add_lifespan_hooks(app, on_shutdown=close_sqlite_writer)
+        else:
+            logger.warning(
+                "[viv-pay] sqlite_profile ignored for %s engine", engine.dialect.name
+            )
+
+    customer_cache = None
+    if store is None:
+        if config.customer_cache_size > 0:
+            customer_cache = CustomerIdCache(config.customer_cache_size)
+            app.state.pay_customer_cache = customer_cache
+        store = SQLAlchemyStore(
+            get_db,
+            StripeCustomer,
+            Subscription,
+            Payment,
+            customer_cache=customer_cache,
+            tracer=tracer,
+            writer=sqlite_writer,
+        )
+    app.state.pay_store = store
+    gateway = StripeGateway(config, tracer)
+    app.state.pay_gateway = gateway
+    app_id = config.app_id or default_app_id(app_name)
+    get_customer, get_or_create_customer = create_customer_helpers(store, gateway, app_id)
+    catalog = None
+    if config.price_catalog:
+        # The catalog is kept in SQL tables, also for apps with a custom store
+        catalog_store = store if isinstance(store, SQLAlchemyStore) else SQLAlchemyStore(
+            get_db, StripeCustomer, Subscription, Payment, tracer=tracer
+        )
+        catalog = PriceCatalog(
+            catalog_store,
+            *create_catalog_models(Base),
+            gateway,
+            refresh_interval=config.catalog_refresh_interval,
+            max_age=config.catalog_max_age,
+        )
+        app.state.pay_catalog = catalog
+    _create_checkout = create_checkout_helper(
+        get_or_create_customer, config, app_url, gateway, catalog
     )
+    _create_portal = create_portal_helper(get_customer, app_url, gateway)
+    feature_map = FeatureMap(config.price_features)
+    snapshot = snapshot_writer = None
+    if config.entitlement_snapshot_path:
+        snapshot = EntitlementSnapshot(
+            config.entitlement_snapshot_path,
+            check_interval=config.entitlement_snapshot_check_interval,
+            max_age=config.entitlement_snapshot_max_age,
+        )
+        snapshot_writer = SnapshotWriter(
+            config.entitlement_snapshot_path, store, config, feature_map
+        )
+        app.state.pay_snapshot = snapshot
+        app.state.pay_snapshot_writer = snapshot_writer
+    require_subscription = create_require_subscription(store, config, snapshot, tracer)
+    require_feature = create_require_feature(store, feature_map, config, snapshot)
+
+    if config.gated_prefixes:
+        app.add_middleware(
+            SubscriptionGateMiddleware,
+            resolve=create_subscription_resolver(store, config, snapshot),
+            prefixes=config.gated_prefixes,
+        )
 
     # Public wrappers that manage their own DB session
     def create_checkout(user_id, email, price_id, mode="subscription", metadata=None):
-        db = next(get_db())
-        try:
+        with store.session() as db:
             return _create_checkout(db, user_id, email, price_id, mode, metadata)
-        finally:
-            db.close()
+
+    def create_portal(user_id, return_url=None):
+        with store.session() as db:
+            return _create_portal(db, user_id, return_url)
 
     def get_customer_public(user_id):
-        db = next(get_db())
-        try:
+        with store.session() as db:
             return get_customer(db, user_id)
-        finally:
-            db.close()
+
+    # Built with the first job, so apps without jobs get no pay_job_leases
+    # table and no scheduler tasks. App jobs can still be added after init_pay.
+    scheduler = None
+
+    def schedule(name, fn, interval, **options):
+        nonlocal scheduler
+        if scheduler is None:
+            scheduler = JobScheduler(
+                SQLLease(get_db, create_job_lease_model(Base)),
+                jitter=config.scheduler_jitter,
+                lease_ttl=config.scheduler_lease_ttl,
+                shutdown_timeout=config.scheduler_shutdown_timeout,
+            )
+            app.state.pay_scheduler = scheduler
+        return scheduler.add_job(name, fn, interval, **options)
+
+    if snapshot_writer is not None:
+        # The snapshot is per host, so is the lease: one worker on each host rebuilds
+        schedule(
+            f"entitlements.snapshot@{socket.gethostname()}",
+            snapshot_writer.rebuild,
+            config.entitlement_snapshot_rebuild_interval,
+        )
+
+    if config.archive_dir:
+        archive = PaymentArchive(config.archive_dir)
+        app.state.pay_archive = archive
+        run_archive = create_payment_archiver(
+            get_db,
+            Payment,
+            archive,
+            archive_after_days=config.archive_after_days,
+            retention_days=config.archive_retention_days,
+            batch_size=config.archive_batch_size,
+        )
+        app.state.pay_run_archive = run_archive
+        schedule("payments.archive", run_archive, config.archive_interval)
+
+    record_usage = _usage_metering_off
+    if config.usage_metering:
+        usage = UsageRecorder(
+            get_db,
+            create_usage_model(Base),
+            StripeCustomer,
+            gateway,
+            buffer_size=config.usage_buffer_size,
+            window=config.usage_window,
+            flush_interval=config.usage_flush_interval,
+            # Each worker flushes its own buffer; pushing to Stripe is a cluster-wide job
+            push_interval=None,
+            batch_size=config.usage_batch_size,
+            retention_days=config.usage_retention_days,
+            writer=sqlite_writer,
+        )
+        app.state.pay_usage = usage
+        add_lifespan_hooks(app, usage.start, usage.stop)
+        schedule("usage.push", usage.push, config.usage_push_interval)
+        record_usage = usage.record
+
+    if catalog is not None:
+        add_lifespan_hooks(app, catalog.start, catalog.stop)
+        schedule("catalog.sync", catalog.sync, config.catalog_sync_interval)
 
     # 4. Mount routes
     templates = Jinja2Templates(directory=str(TEMPLATES_DIR))
-    router = APIRouter()
+    router = APIRouter(route_class=create_traced_route_class(tracer, config.server_timing))
 
     @router.post("/pay/checkout")
     async def checkout_endpoint(request: Request):
@@ -93,27 +336,94 @@ def init_pay(
                 status_code=400,
             )
 
-        db = next(get_db())
+        if not is_dev_mode():
+            gateway.raise_if_open()
+
         try:
-            url = _create_checkout(
-                db,
-                user_id=int(user_id),
-                email=email,
-                price_id=price_id,
-                mode=mode,
-                metadata=metadata,
+            # The gateway may wait for a rate-limit slot and back off between
+            # retries; keep that off the event loop
+            url = await run_in_threadpool(
+                create_checkout, int(user_id), email, price_id, mode, metadata
             )
-        finally:
-            db.close()
+        except InvalidPrice as exc:
+            return JSONResponse({"error": str(exc)}, status_code=400)
         return JSONResponse({"url": url})
 
-    webhook_handler = create_webhook_handler(
-        get_db, StripeCustomer, Subscription, Payment
+    if catalog is not None:
+
+        @router.get("/pay/prices")
+        async def prices_endpoint(request: Request):
+            body, etag = catalog.prices_response()
+            headers = {"ETag": etag, "Cache-Control": catalog.cache_control}
+            if request.headers.get("if-none-match") == etag:
+                return Response(status_code=304, headers=headers)
+            return Response(body, media_type="application/json", headers=headers)
+
+    webhook_registry = create_default_registry(store, tracer)
+    if snapshot_writer is not None:
+        # Runs after the built-in handler for each type, on the same session
+        for event_type in SNAPSHOT_EVENT_TYPES:
+            webhook_registry.register(event_type, snapshot_writer.webhook_handler)
+    if catalog is not None:
+        # The catalog writes through its store's write path, not the webhook's session
+        for event_type in CATALOG_EVENT_TYPES:
+            webhook_registry.register(event_type, catalog.webhook_handler, needs_db=False)
+    app.state.pay_webhooks = webhook_registry
+    webhook_archive = None
+    if config.webhook_archive_dir:
+        webhook_archive = WebhookArchive(
+            config.webhook_archive_dir,
+            segment_bytes=config.webhook_archive_segment_bytes,
+        )
+        app.state.pay_webhook_archive = webhook_archive
+
+        async def close_webhook_archive():
+            await run_in_threadpool(webhook_archive.close)
+
+        add_lifespan_hooks(app, on_shutdown=close_webhook_archive)
+    webhook_handler = create_webhook_handler(store, webhook_registry, webhook_archive)
+
+    if config.poll_events:
+        if isinstance(store, SQLAlchemyStore):
+            cursor = SQLCursor(get_db, create_event_cursor_model(Base))
+        else:
+            cursor = MemoryCursor()
+        poller = EventPoller(
+            store,
+            webhook_registry,
+            cursor,
+            gateway,
+            min_interval=config.poll_min_interval,
+            max_interval=config.poll_max_interval,
+            max_page_size=config.poll_page_size,
+            max_attempts=config.poll_max_attempts,
+        )
+        app.state.pay_poller = poller
+        if is_dev_mode():
+            logger.info("[viv-pay] DEV MODE — event poller not started")
+        else:
+            # A lease-held job: one worker at a time fetches and dispatches events
+            schedule("events.poll", poller.drain, config.poll_min_interval)
+
+    admission = AdmissionController(
+        max_concurrent=config.webhook_max_concurrency,
+        max_queue=config.webhook_max_queue,
+        queue_timeout=config.webhook_queue_timeout,
+        retry_after=config.webhook_retry_after,
     )
+    app.state.pay_webhook_admission = admission
 
     @router.post(config.webhook_path)
     async def webhook_endpoint(request: Request):
-        return await webhook_handler(request)
+        try:
+            async with admission.admit():
+                return await webhook_handler(request)
+        except Overloaded as exc:
+            return JSONResponse(
+                {"error": "overloaded"},
+                status_code=503,
+                headers={"Retry-After": str(exc.retry_after)},
+            )
 
     @router.post("/pay/portal")
     async def portal_endpoint(request: Request):
@@ -126,11 +436,10 @@ def init_pay(
                 {"error": "user_id is required"}, status_code=400
             )
 
-        db = next(get_db())
-        try:
-            url = _create_portal(db, user_id=int(user_id), return_url=return_url)
-        finally:
-            db.close()
+        if not is_dev_mode():
+            gateway.raise_if_open()
+
+        url = await run_in_threadpool(create_portal, int(user_id), return_url)
         if not url:
             return JSONResponse(
                 {"error": "customer not found"}, status_code=404
@@ -152,9 +461,30 @@ def init_pay(
     @router.get("/pay/config")
     async def pay_config():
         return JSONResponse(
-            {"publishable_key": get_stripe_publishable_key() or ""}
+            {
+                "publishable_key": get_stripe_publishable_key() or "",
+                # Frontends can hide purchase buttons while Stripe is down
+                "degraded": gateway.breaker.state != "closed",
+            }
         )
 
+    lag_monitor = LoopLagMonitor()
+    add_lifespan_hooks(app, lag_monitor.start, lag_monitor.stop)
+    health, health_deep = create_health_handlers(
+        engine,
+        gateway,
+        admission,
+        config,
+        lag_monitor,
+        StripeProbe(ttl=config.health_stripe_ttl),
+        customer_cache=customer_cache,
+        get_scheduler=lambda: scheduler,
+        sqlite_writer=sqlite_writer,
+        catalog=catalog,
+    )
+    router.add_api_route("/pay/health", health, methods=["GET"])
+    router.add_api_route("/pay/health/deep", health_deep, methods=["GET"])
+
     app.include_router(router)
 
     # 5. Register exception handler
@@ -172,8 +502,56 @@ def init_pay(
             status_code=403,
         )
 
+    @app.exception_handler(StripeUnavailable)
+    async def stripe_unavailable_handler(request: Request, exc: StripeUnavailable):
+        return JSONResponse(
+            {"error": str(exc)},
+            status_code=503,
+            headers={"Retry-After": str(max(1, math.ceil(exc.retry_after)))},
+        )
+
+    if customer_cache is not None and config.customer_cache_warm:
+
+        async def warm_customer_cache():
+            loaded = await run_in_threadpool(store.warm_customer_cache)
+            logger.info(
+                "[viv-pay] Customer cache warmed: %d customer(s), ~%d KiB",
+                loaded, customer_cache.stats()["approx_bytes"] // 1024,
+            )
+
+        add_lifespan_hooks(app, on_startup=warm_customer_cache)
+
+    async def start_scheduler():
+        if scheduler is None:
+            return
+        # The lease table may come from an app job added after create_all
+        lease_table = scheduler.lease.Model.__table__
+        await run_in_threadpool(lease_table.create, engine, checkfirst=True)
+        await scheduler.start()
+
+    async def stop_scheduler():
+        if scheduler is not None:
+            await scheduler.stop()
+
+    # Added after the other hooks so jobs stop before the resources they use
+    add_lifespan_hooks(app, start_scheduler, stop_scheduler)
+
     # 6. Create tables
     Base.metadata.create_all(bind=engine)
-    logger.info(f"[viv-pay] Initialized for {app_name}")
+    if snapshot_writer is not None:
+        # Also replaces a snapshot left behind by an earlier deployment
+        snapshot_writer.ensure(max_age=config.entitlement_snapshot_rebuild_interval)
+    logger.info("[viv-pay] Initialized for %s", app_name)
 
-    return create_checkout, get_customer_public, require_subscription
+    return PayHandles(
+        create_checkout,
+        get_customer_public,
+        require_subscription,
+        require_feature=require_feature,
+        feature_map=feature_map,
+        record_usage=record_usage,
+        schedule=schedule,
+        provision_customers=functools.partial(
+            provision_customers, store, gateway=gateway, app_id=app_id
+        ),
+    )
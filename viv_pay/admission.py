@@ -0,0 +1,102 @@
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger("viv-pay")
+
+
+class Overloaded(Exception):
+    """Raised when a request is shed instead of admitted."""
+
+    def __init__(self, retry_after: int):
+        super().__init__("overloaded")
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Concurrency limit with a bounded FIFO wait queue.
+
+    At most `max_concurrent` requests run at once and at most `max_queue`
+    wait for a slot, each for up to `queue_timeout` seconds. Anything beyond
+    that is shed with Overloaded so the caller can answer 503 immediately
+    instead of queueing until the client times out.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int,
+        max_queue: int,
+        queue_timeout: float,
+        retry_after: int = 30,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.admitted = 0
+        self.shed = 0
+        self._waiters: deque[asyncio.Future] = deque()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+        }
+
+    def _shed(self, reason: str):
+        self.shed += 1
+        logger.warning(
+            "[viv-pay] Webhook shed (%s): in_flight=%d queued=%d shed_total=%d",
+            reason, self.in_flight, self.queued, self.shed,
+        )
+        raise Overloaded(self.retry_after)
+
+    async def _acquire(self):
+        if self.in_flight < self.max_concurrent and not self._waiters:
+            self.in_flight += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self._shed("queue full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait({waiter}, timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release()  # slot was handed to us; pass it on
+            else:
+                self._waiters.remove(waiter)
+            raise
+        if not waiter.done():
+            self._waiters.remove(waiter)
+            waiter.cancel()
+            self._shed("queue timeout")
+        # Slot handed over by _release; in_flight already counts it
+
+    def _release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    @asynccontextmanager
+    async def admit(self):
+        await self._acquire()
+        self.admitted += 1
+        try:
+            yield
+        finally:
+            self._release()
@@ -0,0 +1,260 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import zlib
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from .models import utcnow
+
+logger = logging.getLogger("viv-pay")
+
+PAYMENT_COLUMNS = (
+    "id",
+    "customer_id",
+    "stripe_session_id",
+    "stripe_payment_intent_id",
+    "amount_cents",
+    "currency",
+    "status",
+    "mode",
+    "created_at",
+)
+LOOKUP_KEYS = ("stripe_session_id", "stripe_payment_intent_id")
+
+CHUNK_SUFFIX = ".vpa"
+KEYS_SUFFIX = ".keys"
+
+
+def _as_utc(value: datetime | None) -> datetime | None:
+    # SQLite hands back naive datetimes for timezone=True columns
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def _encode(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+class PaymentArchive:
+    """Cold storage for old `payments` rows.
+
+    Rows are stored in immutable chunk files, one per archived batch, named
+    by their id range. A chunk holds zlib-compressed JSON laid out by column
+    (all ids, then all amounts, ...), which compresses far better than
+    row-by-row JSON. Each chunk has a small `.keys` sidecar mapping Stripe ids
+    to row positions plus the chunk's created_at range, used for lookups and
+    retention without decompressing the chunk itself.
+    """
+
+    def __init__(self, directory: str | os.PathLike, compression_level: int = 9):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.compression_level = compression_level
+        self._lock = threading.Lock()
+        self._lookup: dict[str, tuple[str, int]] | None = None
+
+    def chunks(self) -> list[Path]:
+        return sorted(self.directory.glob(f"payments-*{CHUNK_SUFFIX}"))
+
+    def _write_atomic(self, path: Path, data: bytes):
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def write_chunk(self, rows: list[dict]) -> Path:
+        """Write rows (dicts keyed by PAYMENT_COLUMNS, sorted by id) as one chunk.
+
+        Idempotent for the same id range, so a batch whose hot-table delete
+        failed can simply be archived again.
+        """
+        if not rows:
+            raise ValueError("cannot archive an empty chunk")
+        name = f"payments-{rows[0]['id']:012d}-{rows[-1]['id']:012d}{CHUNK_SUFFIX}"
+        path = self.directory / name
+
+        columns = {col: [_encode(row.get(col)) for row in rows] for col in PAYMENT_COLUMNS}
+        body = json.dumps({"version": 1, "count": len(rows), "columns": columns})
+        self._write_atomic(path, zlib.compress(body.encode(), self.compression_level))
+
+        created = [_as_utc(row["created_at"]) for row in rows if row.get("created_at")]
+        keys = {
+            "min_created_at": min(created).isoformat() if created else None,
+            "max_created_at": max(created).isoformat() if created else None,
+            "keys": {
+                key: {row[key]: i for i, row in enumerate(rows) if row.get(key)}
+                for key in LOOKUP_KEYS
+            },
+        }
+        self._write_atomic(
+            path.with_suffix(KEYS_SUFFIX), zlib.compress(json.dumps(keys).encode())
+        )
+
+        with self._lock:
+            if self._lookup is not None:
+                self._index_chunk(self._lookup, path.name, keys)
+        return path
+
+    def _read_keys(self, chunk: Path) -> dict:
+        return json.loads(zlib.decompress(chunk.with_suffix(KEYS_SUFFIX).read_bytes()))
+
+    @staticmethod
+    def _index_chunk(lookup, name, keys):
+        for key in LOOKUP_KEYS:
+            for value, position in keys["keys"][key].items():
+                lookup[f"{key}:{value}"] = (name, position)
+
+    def read_chunk(self, chunk: Path) -> list[dict]:
+        data = json.loads(zlib.decompress(chunk.read_bytes()))
+        columns = data["columns"]
+        rows = []
+        for i in range(data["count"]):
+            row = {col: columns[col][i] for col in PAYMENT_COLUMNS}
+            if row["created_at"]:
+                row["created_at"] = datetime.fromisoformat(row["created_at"])
+            rows.append(row)
+        return rows
+
+    def iter_rows(self):
+        """Sequential scan over every archived row, oldest chunk first."""
+        for chunk in self.chunks():
+            yield from self.read_chunk(chunk)
+
+    def find(
+        self,
+        stripe_session_id: str | None = None,
+        stripe_payment_intent_id: str | None = None,
+    ) -> dict | None:
+        """Look up one archived payment by its Stripe session or intent id."""
+        with self._lock:
+            if self._lookup is None:
+                lookup = {}
+                for chunk in self.chunks():
+                    self._index_chunk(lookup, chunk.name, self._read_keys(chunk))
+                self._lookup = lookup
+            if stripe_session_id:
+                hit = self._lookup.get(f"stripe_session_id:{stripe_session_id}")
+            else:
+                hit = self._lookup.get(f"stripe_payment_intent_id:{stripe_payment_intent_id}")
+        if hit is None:
+            return None
+        name, position = hit
+        chunk = self.directory / name
+        if not chunk.exists():  # purged since the index was built
+            return None
+        return self.read_chunk(chunk)[position]
+
+    def purge(self, older_than: datetime) -> int:
+        """Delete chunks whose newest row is older than `older_than`."""
+        removed = 0
+        for chunk in self.chunks():
+            newest = self._read_keys(chunk)["max_created_at"]
+            if newest and datetime.fromisoformat(newest) < older_than:
+                chunk.with_suffix(KEYS_SUFFIX).unlink(missing_ok=True)
+                chunk.unlink(missing_ok=True)
+                removed += 1
+        if removed:
+            with self._lock:
+                self._lookup = None
+            logger.info("[viv-pay] Purged %d archived payment chunk(s)", removed)
+        return removed
+
+
+def create_payment_archiver(
+    get_db,
+    Payment,
+    archive: PaymentArchive,
+    archive_after_days: int = 365,
+    retention_days: int | None = None,
+    batch_size: int = 5000,
+):
+    """Factory — creates `run_archive()` which moves old payments to `archive`.
+
+    Each batch is written to a chunk before its rows are deleted from the hot
+    table, so an interrupted run never loses data; re-running rewrites the
+    same chunk. Returns the number of rows moved.
+    """
+
+    def run_archive() -> int:
+        cutoff = utcnow() - timedelta(days=archive_after_days)
+        moved = 0
+        while True:
+            db = next(get_db())
+            try:
+                batch = (
+                    db.query(Payment)
+                    .filter(Payment.created_at < cutoff)
+                    .order_by(Payment.id)
+                    .limit(batch_size)
+                    .all()
+                )
+                if not batch:
+                    break
+                rows = [{col: getattr(p, col) for col in PAYMENT_COLUMNS} for p in batch]
+                for row in rows:
+                    row["created_at"] = _as_utc(row["created_at"])
+                archive.write_chunk(rows)
+
+                ids = [row["id"] for row in rows]
+                db.query(Payment).filter(Payment.id.in_(ids)).delete(
+                    synchronize_session=False
+                )
+                db.commit()
+                moved += len(rows)
+            finally:
+                db.close()
+
+        if retention_days is not None:
+            archive.purge(utcnow() - timedelta(days=retention_days))
+        if moved:
+            logger.info("[viv-pay] Archived %d payment(s) older than %s", moved, cutoff.date())
+        return moved
+
+    return run_archive
+
+
+def main(argv=None):
+    """CLI — archive old payments: python -m viv_pay.archive --database-url ..."""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import declarative_base, sessionmaker
+
+    from .models import create_pay_models
+
+    parser = argparse.ArgumentParser(description="Move old viv-pay payments to cold storage")
+    parser.add_argument("--database-url", required=True)
+    parser.add_argument("--archive-dir", required=True)
+    parser.add_argument("--after-days", type=int, default=365)
+    parser.add_argument("--retention-days", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args(argv)
+
+    engine = create_engine(args.database_url)
+    SessionLocal = sessionmaker(bind=engine)
+    _, _, Payment = create_pay_models(declarative_base())
+
+    def get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    run_archive = create_payment_archiver(
+        get_db,
+        Payment,
+        PaymentArchive(args.archive_dir),
+        archive_after_days=args.after_days,
+        retention_days=args.retention_days,
+        batch_size=args.batch_size,
+    )
+    print(f"archived {run_archive()} payment(s)")
+
+
+if __name__ == "__main__":
+    main()
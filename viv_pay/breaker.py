@@ -0,0 +1,116 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger("viv-pay")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(Exception):
+    """Raised by CircuitBreaker instead of admitting a call."""
+
+    def __init__(self, retry_after: float):
+        super().__init__("circuit open")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker with half-open probing.
+
+    closed    — calls pass; `failure_threshold` consecutive failures open it.
+    open      — calls fail fast with CircuitOpen for `reset_timeout` seconds.
+    half_open — up to `half_open_max_calls` probes pass; a success closes
+                the circuit, a failure re-opens it.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        half_open_max_calls: int = 1,
+        clock=time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self.opened_count = 0
+        self.rejected_count = 0
+
+    def _current_state(self, now: float) -> str:
+        if self._state == OPEN and now - self._opened_at >= self.reset_timeout:
+            self._state = HALF_OPEN
+            self._probes = 0
+        return self._state
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state(self._clock())
+
+    def raise_if_open(self):
+        """Fail fast without reserving a half-open probe slot."""
+        with self._lock:
+            if self._current_state(self._clock()) == OPEN:
+                self.rejected_count += 1
+                remaining = self.reset_timeout - (self._clock() - self._opened_at)
+                raise CircuitOpen(max(remaining, 1.0))
+
+    def before_call(self):
+        """Admit a call or raise CircuitOpen."""
+        with self._lock:
+            now = self._clock()
+            state = self._current_state(now)
+            if state == CLOSED:
+                return
+            if state == HALF_OPEN and self._probes < self.half_open_max_calls:
+                self._probes += 1
+                return
+            self.rejected_count += 1
+            remaining = self.reset_timeout - (now - self._opened_at)
+            raise CircuitOpen(max(remaining, 1.0))
+
+    def release_probe(self):
+        """Return a half-open probe slot for a call that never reached Stripe."""
+        with self._lock:
+            if self._state == HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    def record_success(self):
+        with self._lock:
+            if self._state != CLOSED:
+                logger.info("[viv-pay] Stripe circuit closed")
+            self._state = CLOSED
+            self._failures = 0
+            self._probes = 0
+
+    def record_failure(self):
+        with self._lock:
+            now = self._clock()
+            state = self._current_state(now)
+            self._failures += 1
+            if state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if state != OPEN:
+                    self.opened_count += 1
+                    logger.warning(
+                        "[viv-pay] Stripe circuit opened after %d failure(s)", self._failures
+                    )
+                self._state = OPEN
+                self._opened_at = now
+                self._probes = 0
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self._failures,
+            "opened": self.opened_count,
+            "rejected": self.rejected_count,
+        }
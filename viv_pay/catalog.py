@@ -0,0 +1,313 @@
+import asyncio
+import json
+import logging
+import time
+
+from sqlalchemy import func, select, update
+from starlette.concurrency import run_in_threadpool
+
+from .config import PayConfig, is_dev_mode
+from .etag import content_etag
+from .gateway import StripeGateway
+from .models import utcnow
+from .storage import PayStore
+from .upsert import upsert
+
+logger = logging.getLogger("viv-pay")
+
+CATALOG_EVENT_TYPES = (
+    "product.created",
+    "product.updated",
+    "product.deleted",
+    "price.created",
+    "price.updated",
+    "price.deleted",
+)
+
+STRIPE_MAX_PAGE = 100
+# Ids per UPDATE when deactivating unlisted rows (SQLite allows 999 parameters before 3.32)
+DEACTIVATE_CHUNK = 500
+
+
+class InvalidPrice(ValueError):
+    """A checkout asked for a price the catalog does not offer (or not in that mode)."""
+
+
+def _product_row(data: dict, deleted: bool = False) -> dict:
+    return {
+        "stripe_product_id": data["id"],
+        "name": data.get("name") or "",
+        "description": data.get("description"),
+        "active": bool(data.get("active", True)) and not deleted,
+    }
+
+
+def _price_row(data: dict, deleted: bool = False) -> dict:
+    product = data.get("product")
+    recurring = data.get("recurring") or {}
+    return {
+        "stripe_price_id": data["id"],
+        # Unexpanded it is the product id, expanded the product object
+        "stripe_product_id": product["id"] if isinstance(product, dict) else product,
+        "active": bool(data.get("active", True)) and not deleted,
+        "currency": data.get("currency") or "usd",
+        "unit_amount": data.get("unit_amount"),
+        "type": data.get("type") or ("recurring" if recurring else "one_time"),
+        "recurring_interval": recurring.get("interval"),
+        "recurring_interval_count": recurring.get("interval_count"),
+        "nickname": data.get("nickname"),
+        "lookup_key": data.get("lookup_key"),
+    }
+
+
+class PriceCatalog:
+    """Local copy of the Stripe account's products and prices.
+
+    Rows live in `pay_products` / `pay_prices`. `sync()` pulls the full
+    catalog from Stripe (run as a scheduled job, on one worker per
+    interval) and product.* / price.* webhooks apply single changes. Each
+    worker answers from an in-memory index that `load()` rebuilds from the
+    tables: right away on the worker that handled a webhook, and on the
+    others when their refresh loop sees the tables changed.
+
+    `check()` rejects unknown or inactive prices before any Stripe call.
+    Until the first sync has stored anything it lets every price through,
+    so a fresh deployment is not locked out of checkout. `/pay/prices`
+    serves the active prices as pre-encoded JSON with a content ETag.
+
+    Reads use `store.session()` and writes go through `store.write()`, so
+    with the SQLite profile they run on the writer thread.
+    """
+
+    def __init__(
+        self,
+        store: PayStore,
+        PayProduct,
+        PayPrice,
+        gateway: StripeGateway | None = None,
+        refresh_interval: float = 30.0,
+        max_age: int = 60,
+        list_objects=None,
+    ):
+        self.store = store
+        self.PayProduct = PayProduct
+        self.PayPrice = PayPrice
+        self.gateway = gateway or StripeGateway(PayConfig())
+        self.refresh_interval = refresh_interval
+        self.cache_control = f"public, max-age={max_age}"
+        self._list_objects = list_objects or self._list_stripe
+        self._from_stripe = list_objects is None
+        # (price id -> type for offered prices, known price ids, body, etag),
+        # swapped as one tuple so readers never see a half-built index
+        self._index: tuple[dict[str, str], frozenset, bytes, str] = self._build([], {})
+        self._version = None
+        self._task: asyncio.Task | None = None
+        self.stats = {"syncs": 0, "loads": 0, "events": 0, "stale_events": 0, "rejected": 0}
+
+    # Stripe
+
+    def _list_stripe(self, kind: str) -> list[dict]:
+        """Every product or price in the account, active or not, as dicts."""
+        import stripe
+
+        if kind == "product":
+            op, fn = "product.list", stripe.Product.list
+        else:
+            op, fn = "price.list", stripe.Price.list
+        objects, params = [], {"limit": STRIPE_MAX_PAGE}
+        while True:
+            page = self.gateway.call(op, fn, **params)
+            objects.extend(obj.to_dict() for obj in page.data)
+            if not page.has_more:
+                return objects
+            params["starting_after"] = page.data[-1].id
+
+    def sync(self) -> int:
+        """Replace the stored catalog with Stripe's. Returns the number of prices."""
+        if self._from_stripe and is_dev_mode():
+            return 0
+        started = int(time.time())
+        products = [_product_row(p) for p in self._list_objects("product")]
+        prices = [_price_row(p) for p in self._list_objects("price")]
+        PayProduct, PayPrice = self.PayProduct, self.PayPrice
+        stamp = {"last_event_at": started, "updated_at": utcnow()}
+
+        def store_listing(db):
+            # Rows an event changed after the listing started keep that change
+            upsert(
+                db, PayProduct, [dict(row, **stamp) for row in products],
+                "stripe_product_id", newer="last_event_at",
+            )
+            upsert(
+                db, PayPrice, [dict(row, **stamp) for row in prices],
+                "stripe_price_id", newer="last_event_at",
+            )
+            # Not listed any more: deleted in Stripe without an event reaching us.
+            # Rows an event created after the listing started are kept. The
+            # difference is taken here and applied in chunks, so the statement
+            # stays under the driver's parameter limit however big the catalog.
+            for Model, key, rows in (
+                (PayProduct, PayProduct.stripe_product_id, products),
+                (PayPrice, PayPrice.stripe_price_id, prices),
+            ):
+                listed = {row[key.key] for row in rows}
+                stored = db.scalars(
+                    select(key).where(Model.last_event_at <= started, Model.active.is_(True))
+                )
+                gone = [object_id for object_id in stored if object_id not in listed]
+                for i in range(0, len(gone), DEACTIVATE_CHUNK):
+                    db.execute(
+                        update(Model)
+                        .where(
+                            key.in_(gone[i : i + DEACTIVATE_CHUNK]),
+                            Model.last_event_at <= started,
+                        )
+                        .values(active=False, updated_at=utcnow())
+                    )
+            self.store.commit(db)
+
+        with self.store.session() as db:
+            self.store.write(db, store_listing)
+        self.stats["syncs"] += 1
+        logger.info(
+            "[viv-pay] Catalog synced: %d product(s), %d price(s)", len(products), len(prices)
+        )
+        self.load()
+        return len(prices)
+
+    # Webhooks
+
+    def apply_event(self, event_type: str, data: dict, created: int | None = None) -> bool:
+        """Store one product.* / price.* change. False if a newer one was applied."""
+        kind, _, action = event_type.partition(".")
+        deleted = action == "deleted"
+        if kind == "product":
+            Model, key, row = self.PayProduct, "stripe_product_id", _product_row(data, deleted)
+        else:
+            Model, key, row = self.PayPrice, "stripe_price_id", _price_row(data, deleted)
+        row.update(last_event_at=created or int(time.time()), updated_at=utcnow())
+
+        def store_change(db):
+            # One statement: an event applied concurrently with a later
+            # timestamp is not overwritten
+            written = upsert(db, Model, [row], key, newer="last_event_at")
+            self.store.commit(db)
+            return written
+
+        with self.store.session() as db:
+            written = self.store.write(db, store_change)
+        if not written:
+            self.stats["stale_events"] += 1
+            return False
+        self.stats["events"] += 1
+        self.load()
+        return True
+
+    def webhook_handler(self, db, data, event):
+        """WebhookRegistry handler for CATALOG_EVENT_TYPES (register with needs_db=False)."""
+        self.apply_event(event["type"], data, event.get("created"))
+
+    # Index
+
+    def _build(self, prices, products) -> tuple:
+        offered, entries = {}, []
+        for price in prices:
+            product = products.get(price.stripe_product_id)
+            if not price.active or (product is not None and not product.active):
+                continue
+            offered[price.stripe_price_id] = price.type
+            entries.append({
+                "id": price.stripe_price_id,
+                "product": {
+                    "id": price.stripe_product_id,
+                    "name": product.name if product is not None else None,
+                    "description": product.description if product is not None else None,
+                },
+                "currency": price.currency,
+                "unit_amount": price.unit_amount,
+                "type": price.type,
+                "interval": price.recurring_interval,
+                "interval_count": price.recurring_interval_count,
+                "nickname": price.nickname,
+                "lookup_key": price.lookup_key,
+            })
+        entries.sort(
+            key=lambda e: (e["product"]["name"] or "", e["unit_amount"] or 0, e["id"])
+        )
+        body = json.dumps({"prices": entries}, separators=(",", ":")).encode()
+        known = frozenset(price.stripe_price_id for price in prices)
+        return offered, known, body, content_etag(body).decode()
+
+    def _current_version(self, db) -> tuple:
+        return tuple(
+            tuple(db.execute(select(func.count(), func.max(Model.updated_at))).one())
+            for Model in (self.PayProduct, self.PayPrice)
+        )
+
+    def load(self, if_changed: bool = False) -> int:
+        """Rebuild the in-memory index from the tables. Returns the number of prices offered.
+
+        With `if_changed`, one aggregate query decides whether anything
+        changed since the last load, and nothing else is read if not.
+        """
+        with self.store.session() as db:
+            version = self._current_version(db)
+            if if_changed and version == self._version:
+                return len(self._index[0])
+            products = {p.stripe_product_id: p for p in db.query(self.PayProduct)}
+            prices = db.query(self.PayPrice).all()
+            index = self._build(prices, products)
+        self._index, self._version = index, version
+        self.stats["loads"] += 1
+        return len(index[0])
+
+    def check(self, price_id: str, mode: str = "subscription"):
+        """Raise InvalidPrice unless `price_id` is offered and fits the checkout `mode`."""
+        offered, known, _, _ = self._index
+        if not known:
+            return  # nothing synced yet: leave it to Stripe
+        kind = offered.get(price_id)
+        if kind is None:
+            self.stats["rejected"] += 1
+            state = "inactive" if price_id in known else "unknown"
+            raise InvalidPrice(f"{state} price {price_id!r}")
+        if mode in ("subscription", "payment") and (mode == "subscription") != (kind == "recurring"):
+            self.stats["rejected"] += 1
+            raise InvalidPrice(f"price {price_id!r} is {kind} and cannot be used in {mode} mode")
+
+    def stats_snapshot(self) -> dict:
+        offered, known, _, etag = self._index
+        return dict(self.stats, prices=len(known), offered=len(offered), etag=etag)
+
+    def prices_response(self) -> tuple[bytes, str]:
+        """(JSON body, ETag) for the active prices."""
+        _, _, body, etag = self._index
+        return body, etag
+
+    # Lifespan
+
+    async def run(self):
+        try:
+            await run_in_threadpool(self.load)
+            if not self._index[1] and self._from_stripe and not is_dev_mode():
+                await run_in_threadpool(self.sync)  # first start: nothing stored yet
+        except Exception:
+            logger.exception("[viv-pay] Initial catalog load failed")
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await run_in_threadpool(self.load, True)
+            except Exception:
+                logger.exception("[viv-pay] Catalog refresh failed")
+
+    async def start(self):
+        self._task = asyncio.create_task(self.run(), name="viv-pay-catalog")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
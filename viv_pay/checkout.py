@@ -1,12 +1,24 @@
 import logging
 
 from .config import PayConfig, is_dev_mode
+from .gateway import StripeGateway
 
 logger = logging.getLogger("viv-pay")
 
 
-def create_checkout_helper(get_or_create_customer, config: PayConfig, app_url: str):
-    """Factory — creates checkout session helper."""
+def create_checkout_helper(
+    get_or_create_customer,
+    config: PayConfig,
+    app_url: str,
+    gateway: StripeGateway | None = None,
+    catalog=None,
+):
+    """Factory — creates checkout session helper.
+
+    With a `catalog` (PriceCatalog), prices it does not offer raise
+    InvalidPrice before any customer lookup or Stripe call.
+    """
+    gateway = gateway or StripeGateway(config)
 
     def create_checkout(
         db,
@@ -17,24 +29,30 @@ def create_checkout_helper(get_or_create_customer, config: PayConfig, app_url: s
         metadata: dict | None = None,
     ) -> str:
         """Create a Stripe Checkout Session. Returns the checkout URL."""
+        if catalog is not None:
+            catalog.check(price_id, mode)
         customer = get_or_create_customer(db, user_id, email)
 
         if is_dev_mode():
             fake_url = f"{app_url}{config.success_path}?session_id=cs_dev_{user_id}"
             logger.info(
-                f"[viv-pay] DEV MODE — mock checkout for user {user_id}, "
-                f"price {price_id}, mode {mode}"
+                "[viv-pay] DEV MODE — mock checkout for user %s, price %s, mode %s: %s",
+                user_id, price_id, mode, fake_url,
+                extra={"user_id": user_id, "price_id": price_id},
             )
-            logger.info(f"[viv-pay] DEV MODE — checkout URL: {fake_url}")
             return fake_url
 
         import stripe
 
-        session_metadata = {"user_id": str(user_id)}
+        # price_id lets the webhook record which plan the subscription is on
+        session_metadata = {"user_id": str(user_id), "price_id": price_id}
         if metadata:
             session_metadata.update(metadata)
 
-        session = stripe.checkout.Session.create(
+        session = gateway.call(
+            "checkout.session.create",
+            stripe.checkout.Session.create,
+            idempotent=True,
             customer=customer.stripe_customer_id,
             mode=mode,
             line_items=[{"price": price_id, "quantity": 1}],
@@ -44,7 +62,8 @@ def create_checkout_helper(get_or_create_customer, config: PayConfig, app_url: s
         )
 
         logger.info(
-            f"[viv-pay] Created checkout session {session.id} for user {user_id}"
+            "[viv-pay] Created checkout session %s for user %s", session.id, user_id,
+            extra={"user_id": user_id, "price_id": price_id},
         )
         return session.url
 
@@ -8,9 +8,128 @@ class PayConfig:
     cancel_path: str = "/pay/cancel"
     webhook_path: str = "/pay/webhook"
     auto_create_customer: bool = True
+    # Namespace for the idempotency keys viv-pay sends to Stripe, which are
+    # account-wide: apps sharing a Stripe account need distinct ids. Unset,
+    # init_pay uses app_name as a slug ("My SaaS" -> "my-saas").
+    app_id: str | None = None
     allowed_statuses: list[str] = field(
         default_factory=lambda: ["active", "trialing"]
     )
+    # Feature entitlements: stripe_price_id -> feature names, for require_feature
+    price_features: dict[str, set[str]] = field(default_factory=dict)
+    # Host-wide shared entitlement snapshot (memory-mapped file). When set,
+    # require_subscription / require_feature answer from it without the DB.
+    entitlement_snapshot_path: str | None = None
+    entitlement_snapshot_check_interval: float = 1.0
+    # Each host rebuilds its snapshot from the DB this often. Past max_age
+    # without a rebuild, readers stop trusting it and query the DB.
+    entitlement_snapshot_rebuild_interval: float = 300.0
+    entitlement_snapshot_max_age: float = 900.0
+    # Path prefixes gated by SubscriptionGateMiddleware (e.g. ["/api/pro"])
+    gated_prefixes: list[str] = field(default_factory=list)
+    # Outbound Stripe limits as (requests/sec, burst). Per-operation entries
+    # are keyed like "customer.create"; the global bucket is account-wide.
+    stripe_global_rate: tuple[float, int] = (25.0, 25)
+    stripe_default_rate: tuple[float, int] = (20.0, 20)
+    stripe_rate_limits: dict[str, tuple[float, int]] = field(default_factory=dict)
+    stripe_max_queue_wait: float = 5.0
+    stripe_max_retries: int = 3
+    stripe_retry_base_delay: float = 0.25
+    stripe_retry_max_delay: float = 4.0
+    stripe_retry_budget: float = 0.2
+    # Per-attempt timeouts (seconds) keyed by operation, and a deadline for
+    # a whole gateway call including queue wait and retries.
+    stripe_timeouts: dict[str, float] = field(default_factory=dict)
+    stripe_default_timeout: float = 10.0
+    stripe_request_deadline: float = 15.0
+    stripe_max_concurrency: int = 32
+    # Circuit breaker: open after N consecutive failures, probe after reset.
+    stripe_breaker_threshold: int = 5
+    stripe_breaker_reset: float = 30.0
+    stripe_breaker_probes: int = 1
+    # Webhook admission control: beyond max concurrency + queue, /pay/webhook
+    # answers 503 with Retry-After and Stripe redelivers later.
+    webhook_max_concurrency: int = 8
+    webhook_max_queue: int = 64
+    webhook_queue_timeout: float = 5.0
+    webhook_retry_after: int = 30
+    # Raw webhook body archive (compressed segment files); off unless set.
+    webhook_archive_dir: str | None = None
+    webhook_archive_segment_bytes: int = 64 * 1024 * 1024
+    # Cold archive for old payments; disabled unless archive_dir is set.
+    archive_dir: str | None = None
+    archive_after_days: int = 365
+    archive_retention_days: int | None = None
+    archive_batch_size: int = 5000
+    # In-process user_id <-> Stripe customer id cache for SQLAlchemyStore,
+    # off by default (0). When on, customer lookups return CachedCustomer
+    # instead of StripeCustomer rows. With warm, it is preloaded at startup.
+    customer_cache_size: int = 0
+    customer_cache_warm: bool = False
+    # /pay/health: Stripe reachability is checked at most once per TTL;
+    # loop lag above health_max_loop_lag (seconds) reports "degraded".
+    health_stripe_ttl: float = 30.0
+    health_max_loop_lag: float = 0.25
+    # Usage metering (record_usage). Off by default: when on, viv-pay creates
+    # the usage_records table, flushes on every worker and pushes to Stripe.
+    usage_metering: bool = False
+    # Ring buffer size, aggregation window (seconds), and how often totals
+    # are written locally / sent to Stripe.
+    usage_buffer_size: int = 100_000
+    usage_window: int = 60
+    usage_flush_interval: float = 1.0
+    usage_push_interval: float = 60.0
+    usage_batch_size: int = 500
+    # Rows already sent to Stripe are deleted after this many days.
+    usage_retention_days: float = 7
+    # Background jobs (usage push, payment archiving, app jobs added with
+    # pay.schedule) run on one worker per interval, coordinated through
+    # lease rows in pay_job_leases. Intervals get +/- jitter (a fraction).
+    scheduler_jitter: float = 0.1
+    scheduler_lease_ttl: float = 300.0
+    scheduler_shutdown_timeout: float = 10.0
+    archive_interval: float = 86400.0
+    # Standalone entitlement service (python -m viv_pay.service): answers are
+    # cached per user for entitlement_cache_ttl seconds; a lookup that takes
+    # longer than entitlement_budget seconds gets a stale answer or a 503.
+    entitlement_cache_ttl: float = 2.0
+    entitlement_cache_size: int = 100_000
+    entitlement_budget: float = 0.25
+    entitlement_max_batch: int = 1000
+    # SQLite production profile (opt-in, SQLite engines only): WAL,
+    # synchronous=NORMAL, busy timeout (seconds) and mmap on each connection;
+    # viv-pay's own writes go through one writer thread that commits up to
+    # sqlite_max_batch queued writes at a time.
+    sqlite_profile: bool = False
+    sqlite_busy_timeout: float = 5.0
+    sqlite_mmap_size: int = 256 * 1024 * 1024
+    sqlite_max_batch: int = 64
+    # Local copy of the Stripe products/prices (pay_products, pay_prices):
+    # checkout rejects prices it does not offer without calling Stripe, and
+    # GET /pay/prices serves the active ones from memory. Synced from Stripe
+    # every catalog_sync_interval (one worker) and kept current by product.*
+    # and price.* webhooks; workers reload their index when the tables change.
+    price_catalog: bool = False
+    catalog_sync_interval: float = 3600.0
+    catalog_refresh_interval: float = 30.0
+    catalog_max_age: int = 60
+    # Queue-based logging for the "viv-pay" logger (JSON lines, sampled and
+    # rate-limited per message type below WARNING). Off: plain stdlib logging.
+    structured_logging: bool = False
+    log_sample_rates: dict[str, float] = field(default_factory=dict)
+    log_rate_limit: tuple[float, int] | None = (10.0, 20)
+    # Add a Server-Timing header (per-phase durations: db, stripe.<op>, ...)
+    # to viv-pay route responses. Exposes backend timings to clients.
+    server_timing: bool = False
+    # Pull events from Stripe's Events API instead of (or alongside) webhooks,
+    # for deployments Stripe cannot reach. Runs in the app's lifespan.
+    poll_events: bool = False
+    poll_min_interval: float = 5.0
+    poll_max_interval: float = 60.0
+    poll_page_size: int = 100
+    # A polled event that fails this many polls in a row is logged at ERROR
+    # and skipped, so it cannot stall the poller.
+    poll_max_attempts: int = 5
 
 
 def get_stripe_secret_key() -> str | None:
@@ -1,58 +1,106 @@
 import logging
+import re
 
-from .config import is_dev_mode
+from .config import PayConfig, is_dev_mode
+from .gateway import StripeGateway
+from .storage import PayStore
 
 logger = logging.getLogger("viv-pay")
 
 
-def create_customer_helpers(StripeCustomer):
+def default_app_id(app_name: str) -> str:
+    """PayConfig.app_id when unset: app_name as a slug ("My SaaS" -> "my-saas")."""
+    return re.sub(r"[^a-z0-9]+", "-", app_name.lower()).strip("-") or "app"
+
+
+def customer_idempotency_key(app_id: str, user_id: int) -> str:
+    """One key per app and user, shared by lazy creation and bulk provisioning, so a
+    user created by both (within Stripe's 24h key window) gets one customer.
+
+    Keys are scoped to the whole Stripe account; the app id keeps apps that
+    share an account from answering each other's requests.
+    """
+    return f"viv-pay-{app_id}-customer-{user_id}"
+
+
+def create_stripe_customer(gateway: StripeGateway, app_id: str, user_id: int, email: str):
+    """Create the user's Stripe customer under their idempotency key.
+
+    Stripe rejects a key reused with other parameters (IdempotencyError),
+    e.g. when the email changed since an attempt earlier that day. That
+    attempt created the customer, so it is looked up by metadata instead;
+    if search has not indexed it yet, the error is raised and a later
+    attempt finds it.
+    """
+    import stripe
+
+    try:
+        return gateway.call(
+            "customer.create",
+            stripe.Customer.create,
+            idempotent=True,
+            idempotency_key=customer_idempotency_key(app_id, user_id),
+            email=email,
+            metadata={"user_id": str(user_id), "viv_pay_app": app_id},
+        )
+    except stripe.error.IdempotencyError:
+        found = gateway.call(
+            "customer.search",
+            stripe.Customer.search,
+            query=f"metadata['viv_pay_app']:'{app_id}' AND metadata['user_id']:'{user_id}'",
+            limit=1,
+        )
+        if not found.data:
+            raise
+        logger.warning(
+            "[viv-pay] Customer key for user %s was reused with other parameters; "
+            "using existing customer %s", user_id, found.data[0].id,
+            extra={"user_id": user_id},
+        )
+        return found.data[0]
+
+
+def create_customer_helpers(
+    store: PayStore, gateway: StripeGateway | None = None, app_id: str = "app"
+):
     """Factory — creates customer CRUD helpers."""
+    gateway = gateway or StripeGateway(PayConfig())
 
     def get_customer(db, user_id: int):
         """Look up a StripeCustomer by user_id."""
-        return (
-            db.query(StripeCustomer)
-            .filter(StripeCustomer.user_id == user_id)
-            .first()
-        )
+        return store.get_customer(db, user_id)
 
     def get_or_create_customer(db, user_id: int, email: str):
         """Get existing or create new StripeCustomer."""
-        customer = (
-            db.query(StripeCustomer)
-            .filter(StripeCustomer.user_id == user_id)
-            .first()
-        )
+        customer = store.get_customer(db, user_id)
         if customer:
             return customer
 
         if is_dev_mode():
             stripe_customer_id = f"cus_dev_{user_id}"
             logger.info(
-                f"[viv-pay] DEV MODE — created mock customer "
-                f"{stripe_customer_id} for user {user_id}"
+                "[viv-pay] DEV MODE — created mock customer %s for user %s",
+                stripe_customer_id, user_id,
+                extra={"user_id": user_id},
             )
         else:
-            import stripe
-
-            stripe_cust = stripe.Customer.create(
-                email=email,
-                metadata={"user_id": str(user_id)},
-            )
+            stripe_cust = create_stripe_customer(gateway, app_id, user_id, email)
             stripe_customer_id = stripe_cust.id
             logger.info(
-                f"[viv-pay] Created Stripe customer "
-                f"{stripe_customer_id} for user {user_id}"
+                "[viv-pay] Created Stripe customer %s for user %s",
+                stripe_customer_id, user_id,
+                extra={"user_id": user_id},
             )
 
-        customer = StripeCustomer(
-            user_id=user_id,
-            email=email,
-            stripe_customer_id=stripe_customer_id,
-        )
-        db.add(customer)
-        db.commit()
-        db.refresh(customer)
+        def insert(db):
+            # A concurrent first checkout for the same user may have won the
+            # insert; both then use its row (same Stripe customer, same key)
+            customer = store.get_or_add_customer(db, user_id, email, stripe_customer_id)
+            store.commit(db)
+            return customer
+
+        customer = store.write(db, insert)
+        store.remember_customer(customer)
         return customer
 
     return get_customer, get_or_create_customer
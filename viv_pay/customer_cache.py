@@ -0,0 +1,123 @@
+import sys
+import threading
+
+
+class CachedCustomer:
+    """Identity of a StripeCustomer row, as served from the cache.
+
+    `email` is the address the customer was created with.
+    """
+
+    __slots__ = ("id", "user_id", "stripe_customer_id", "email")
+
+    def __init__(self, id: int, user_id: int, stripe_customer_id: str, email: str):
+        self.id = id
+        self.user_id = user_id
+        self.stripe_customer_id = stripe_customer_id
+        self.email = email
+
+    def __repr__(self):
+        return f"CachedCustomer(id={self.id}, user_id={self.user_id}, stripe_customer_id={self.stripe_customer_id!r})"
+
+
+class CustomerIdCache:
+    """Process-wide user_id <-> stripe_customer_id <-> customer.id map.
+
+    viv-pay never changes or deletes a customer once it exists, so entries
+    need no invalidation by viv-pay itself; apps that delete or re-point
+    `stripe_customers` rows call `forget()` on every worker. Three dicts share one CachedCustomer per customer; reads
+    are plain dict lookups without a lock. At `max_entries` the oldest
+    entries are evicted first. `stats()` reports an estimate of the memory
+    held (dicts plus entries and their strings).
+    """
+
+    def __init__(self, max_entries: int = 100_000):
+        self.max_entries = max_entries
+        self._by_user: dict[int, CachedCustomer] = {}
+        self._by_stripe_id: dict[str, CachedCustomer] = {}
+        self._by_id: dict[int, CachedCustomer] = {}
+        self._lock = threading.Lock()
+        self._entry_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._by_user)
+
+    @property
+    def full(self) -> bool:
+        return len(self._by_user) >= self.max_entries
+
+    @staticmethod
+    def _sizeof(entry: CachedCustomer) -> int:
+        return (
+            sys.getsizeof(entry)
+            + sys.getsizeof(entry.stripe_customer_id)
+            + sys.getsizeof(entry.email)
+        )
+
+    def put(self, id: int, user_id: int, stripe_customer_id: str, email: str) -> CachedCustomer:
+        entry = CachedCustomer(id, user_id, stripe_customer_id, email)
+        with self._lock:
+            existing = self._by_user.get(user_id)
+            if existing is not None:
+                return existing
+            while self._by_user and len(self._by_user) >= self.max_entries:
+                oldest = self._by_user.pop(next(iter(self._by_user)))
+                self._by_stripe_id.pop(oldest.stripe_customer_id, None)
+                self._by_id.pop(oldest.id, None)
+                self._entry_bytes -= self._sizeof(oldest)
+                self.evictions += 1
+            if self.max_entries <= 0:
+                return entry
+            self._by_user[user_id] = entry
+            self._by_stripe_id[stripe_customer_id] = entry
+            self._by_id[id] = entry
+            self._entry_bytes += self._sizeof(entry)
+        return entry
+
+    def forget(self, user_id: int) -> bool:
+        """Drop the user's entry. Returns whether there was one."""
+        with self._lock:
+            entry = self._by_user.pop(user_id, None)
+            if entry is None:
+                return False
+            self._by_stripe_id.pop(entry.stripe_customer_id, None)
+            self._by_id.pop(entry.id, None)
+            self._entry_bytes -= self._sizeof(entry)
+        return True
+
+    def remember(self, customer) -> CachedCustomer:
+        """Cache any object with the StripeCustomer attributes."""
+        return self.put(customer.id, customer.user_id, customer.stripe_customer_id, customer.email)
+
+    def _get(self, index: dict, key):
+        entry = index.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def by_user_id(self, user_id: int) -> CachedCustomer | None:
+        return self._get(self._by_user, user_id)
+
+    def by_stripe_id(self, stripe_customer_id: str) -> CachedCustomer | None:
+        return self._get(self._by_stripe_id, stripe_customer_id)
+
+    def by_id(self, customer_id: int) -> CachedCustomer | None:
+        return self._get(self._by_id, customer_id)
+
+    def stats(self) -> dict:
+        dict_bytes = sum(
+            sys.getsizeof(d) for d in (self._by_user, self._by_stripe_id, self._by_id)
+        )
+        return {
+            "entries": len(self),
+            "max_entries": self.max_entries,
+            "approx_bytes": dict_bytes + self._entry_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
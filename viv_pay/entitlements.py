@@ -0,0 +1,84 @@
+import logging
+
+from fastapi import Request
+
+from .config import PayConfig, is_dev_mode
+from .middleware import PaymentRequired, _check_api_token, _request_user_id
+from .storage import PayStore
+
+logger = logging.getLogger("viv-pay")
+
+
+class FeatureMap:
+    """PayConfig.price_features compiled into integer bitmasks.
+
+    Every feature name gets one bit; every price id gets the OR of its
+    features' bits. A user's entitlement is the OR of the masks of all their
+    active prices, so a feature check is a single `mask & bit`.
+    """
+
+    def __init__(self, price_features: dict[str, set[str]]):
+        names = sorted({f for features in price_features.values() for f in features})
+        self.bits: dict[str, int] = {name: 1 << i for i, name in enumerate(names)}
+        self.price_masks: dict[str, int] = {}
+        for price_id, features in price_features.items():
+            mask = 0
+            for name in features:
+                mask |= self.bits[name]
+            self.price_masks[price_id] = mask
+        self.all_features = (1 << len(names)) - 1
+
+    def bit(self, feature: str) -> int:
+        try:
+            return self.bits[feature]
+        except KeyError:
+            raise ValueError(f"unknown feature {feature!r}; add it to PayConfig.price_features")
+
+    def mask_for_prices(self, price_ids) -> int:
+        mask = 0
+        for price_id in price_ids:
+            mask |= self.price_masks.get(price_id, 0)
+        return mask
+
+    def features(self, mask: int) -> set[str]:
+        return {name for name, bit in self.bits.items() if mask & bit}
+
+
+def create_require_feature(
+    store: PayStore, feature_map: FeatureMap, config: PayConfig, snapshot=None
+):
+    """Factory — `require_feature(name)` builds a FastAPI dependency for one feature.
+
+    The dependency returns the user's full feature mask so handlers can check
+    further features with `feature_map.features(mask)`.
+    """
+
+    def require_feature(feature: str):
+        # Resolved once at route definition; unknown names fail at startup
+        bit = feature_map.bit(feature)
+
+        async def feature_dependency(request: Request, user_id: int | None = None) -> int:
+            if _check_api_token(request):
+                return feature_map.all_features
+
+            user_id = _request_user_id(request, user_id)
+
+            if is_dev_mode():
+                return feature_map.all_features
+
+            if snapshot is not None and snapshot.available():
+                # Masks are precomputed into the snapshot by SnapshotWriter
+                entry = snapshot.lookup(user_id)
+                mask = entry[1] if entry else 0
+            else:
+                with store.session() as db:
+                    price_ids = store.get_active_price_ids(db, user_id, config.allowed_statuses)
+                mask = feature_map.mask_for_prices(price_ids)
+            if not mask & bit:
+                raise PaymentRequired()
+            return mask
+
+        feature_dependency.__name__ = f"require_feature_{feature}"
+        return feature_dependency
+
+    return require_feature
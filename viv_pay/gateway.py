@@ -0,0 +1,268 @@
+import logging
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures import wait
+
+from .breaker import CircuitBreaker, CircuitOpen
+from .config import PayConfig
+from .ratelimit import FairLimiter, RetryBudget
+from .tracing import PayTracer
+
+logger = logging.getLogger("viv-pay")
+
+
+class StripeUnavailable(Exception):
+    """Raised when a Stripe call cannot be completed right now.
+
+    Mapped to a 503 with Retry-After by init_pay.
+    """
+
+    def __init__(self, message: str = "Stripe temporarily unavailable", retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class StripeTimeout(Exception):
+    """A single Stripe attempt exceeded its per-operation timeout."""
+
+    should_retry = True
+
+    def __init__(self, message: str, future=None):
+        super().__init__(message)
+        # The abandoned attempt, which may still reach Stripe
+        self.future = future
+
+
+def _key_in_use(exc: Exception) -> bool:
+    """Stripe's 409 for a request whose idempotency key is still being processed.
+
+    Happens when a retry follows an attempt abandoned at its timeout that
+    is still in flight; once that one finishes, a retry gets its result.
+    """
+    return getattr(exc, "http_status", None) == 409 and (
+        getattr(exc, "code", None) == "idempotency_key_in_use"
+    )
+
+
+def _is_retryable(exc: Exception) -> bool:
+    status = getattr(exc, "http_status", None)
+    if status is not None:
+        return status == 429 or status >= 500 or _key_in_use(exc)
+    # APIConnectionError flags transient network failures itself
+    return bool(getattr(exc, "should_retry", False))
+
+
+def _retry_after_hint(exc: Exception) -> float | None:
+    headers = getattr(exc, "headers", None) or {}
+    for key in ("Retry-After", "retry-after"):
+        value = headers.get(key)
+        if value is not None:
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                return None
+    return None
+
+
+class StripeGateway:
+    """Single path for every outbound Stripe call made by viv-pay.
+
+    Applies the per-operation fair rate limiter, retries 429/5xx (and the
+    409 for an idempotency key still in use by an abandoned attempt) with
+    jittered exponential backoff (bounded by a retry budget) and keeps
+    per-operation metrics. Each attempt runs under a per-operation timeout and the whole
+    call under a request deadline; a circuit breaker fails calls fast while
+    Stripe is down. Operations are named like "customer.create"; each call
+    is traced as a "stripe.<op>" span covering queueing and retries.
+    """
+
+    def __init__(self, config: PayConfig, tracer: PayTracer | None = None):
+        self.config = config
+        self.tracer = tracer or PayTracer()
+        self.breaker = CircuitBreaker(
+            failure_threshold=config.stripe_breaker_threshold,
+            reset_timeout=config.stripe_breaker_reset,
+            half_open_max_calls=config.stripe_breaker_probes,
+        )
+        # Attempts run here so a hung request can be abandoned at its timeout;
+        # the SDK's own HTTP timeout (set in init_pay) eventually frees it.
+        self._executor = ThreadPoolExecutor(
+            max_workers=config.stripe_max_concurrency,
+            thread_name_prefix="viv-pay-stripe",
+        )
+        self.limiter = FairLimiter(
+            config.stripe_global_rate,
+            config.stripe_default_rate,
+            config.stripe_rate_limits,
+        )
+        self.budget = RetryBudget(config.stripe_retry_budget)
+        self._stats: dict[str, dict] = {}
+        self._stats_lock = threading.Lock()
+
+    def _record(self, op: str, **deltas):
+        with self._stats_lock:
+            stats = self._stats.get(op)
+            if stats is None:
+                stats = self._stats[op] = {
+                    "calls": 0,
+                    "throttled": 0,
+                    "queue_wait_seconds": 0.0,
+                    "max_queue_wait_seconds": 0.0,
+                    "retries": 0,
+                    "timeouts": 0,
+                    "failures": 0,
+                    "rejected": 0,
+                }
+            for key, value in deltas.items():
+                if key == "max_queue_wait_seconds":
+                    stats[key] = max(stats[key], value)
+                else:
+                    stats[key] += value
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            ops = {op: dict(s) for op, s in self._stats.items()}
+        return {
+            "operations": ops,
+            "queued": self.limiter.queued(),
+            "retry_budget": round(self.budget.balance, 2),
+            "circuit": self.breaker.stats(),
+        }
+
+    def timeout_for(self, op: str) -> float:
+        return self.config.stripe_timeouts.get(op, self.config.stripe_default_timeout)
+
+    def raise_if_open(self):
+        """Fail fast (503) before doing any local work for a Stripe-bound route."""
+        try:
+            self.breaker.raise_if_open()
+        except CircuitOpen as exc:
+            raise StripeUnavailable(
+                "Stripe temporarily unavailable (circuit open)", exc.retry_after
+            )
+
+    def _attempt(self, op: str, fn, args, params, timeout: float):
+        future = self._executor.submit(fn, *args, **params)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeout:
+            future.cancel()
+            self._record(op, timeouts=1)
+            raise StripeTimeout(f"Stripe {op} timed out after {timeout:.1f}s", future)
+
+    def _backoff(self, attempt: int, exc: Exception) -> float:
+        hint = _retry_after_hint(exc)
+        if hint is not None:
+            return min(hint, self.config.stripe_retry_max_delay)
+        ceiling = min(
+            self.config.stripe_retry_max_delay,
+            self.config.stripe_retry_base_delay * (2 ** attempt),
+        )
+        return random.uniform(0, ceiling)  # full jitter
+
+    def call(self, op: str, fn, *args, idempotent: bool = False, **params):
+        """Call `fn(*args, **params)` through the limiter with retries.
+
+        With `idempotent=True` an idempotency key is generated once (unless
+        the caller passed one), so retried creates never duplicate objects.
+        Raises StripeUnavailable when the circuit is open, the deadline runs
+        out or retries are exhausted.
+        """
+        if idempotent and "idempotency_key" not in params:
+            params["idempotency_key"] = f"viv-pay-{uuid.uuid4().hex}"
+        with self.tracer.span(f"stripe.{op}", phase=f"stripe.{op}", **{"stripe.op": op}) as span:
+            return self._call(op, fn, args, params, span)
+
+    def _call(self, op: str, fn, args, params, span):
+        deadline = time.monotonic() + self.config.stripe_request_deadline
+        self.budget.deposit()
+
+        attempt = 0
+        abandoned = None
+        while True:
+            try:
+                self.breaker.before_call()
+            except CircuitOpen as exc:
+                self._record(op, rejected=1)
+                raise StripeUnavailable(
+                    "Stripe temporarily unavailable (circuit open)", exc.retry_after
+                )
+
+            remaining = deadline - time.monotonic()
+            try:
+                waited = self.limiter.acquire(
+                    op, timeout=min(self.config.stripe_max_queue_wait, remaining)
+                )
+            except TimeoutError:
+                # Never reached Stripe; release a half-open probe slot unharmed
+                self.breaker.release_probe()
+                self._record(op, rejected=1)
+                logger.warning(
+                    "[viv-pay] Stripe %s rejected — rate limiter queue full", op,
+                    extra={"stripe_op": op},
+                )
+                raise StripeUnavailable(
+                    "Stripe rate limit reached", retry_after=self.config.stripe_max_queue_wait
+                )
+            self._record(
+                op,
+                calls=1,
+                throttled=1 if waited > 0 else 0,
+                queue_wait_seconds=waited,
+                max_queue_wait_seconds=waited,
+            )
+
+            remaining = deadline - time.monotonic()
+            try:
+                result = self._attempt(
+                    op, fn, args, params, max(min(self.timeout_for(op), remaining), 0.001)
+                )
+            except Exception as exc:
+                if isinstance(exc, StripeTimeout):
+                    abandoned = exc.future
+                elif _key_in_use(exc) and abandoned is not None:
+                    # Retrying before the abandoned attempt finishes only
+                    # gets the same 409; wait for it within the deadline
+                    wait([abandoned], timeout=max(deadline - time.monotonic(), 0))
+                if not _is_retryable(exc):
+                    # Stripe answered (e.g. 4xx) — it is up
+                    self.breaker.record_success()
+                    raise
+                if getattr(exc, "http_status", None) == 429 or _key_in_use(exc):
+                    # Throttled or busy with our own earlier attempt, not
+                    # down — leave breaker accounting alone
+                    self.breaker.release_probe()
+                else:
+                    self.breaker.record_failure()
+                delay = self._backoff(attempt, exc)
+                out_of_time = time.monotonic() + delay >= deadline
+                if (
+                    attempt >= self.config.stripe_max_retries
+                    or out_of_time
+                    or not self.budget.withdraw()
+                ):
+                    self._record(op, failures=1)
+                    logger.warning(
+                        "[viv-pay] Stripe %s failed after %d attempt(s): %s", op, attempt + 1, exc,
+                        extra={"stripe_op": op},
+                    )
+                    raise StripeUnavailable(
+                        retry_after=_retry_after_hint(exc) or self.config.stripe_retry_max_delay
+                    ) from exc
+                attempt += 1
+                self._record(op, retries=1)
+                logger.info(
+                    "[viv-pay] Stripe %s retry %d in %.2fs (%s)",
+                    op, attempt, delay, exc.__class__.__name__,
+                    extra={"stripe_op": op},
+                )
+                time.sleep(delay)
+            else:
+                self.breaker.record_success()
+                if span is not None:
+                    span.set_attribute("stripe.attempts", attempt + 1)
+                return result
@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import threading
+import time
+
+from fastapi.responses import JSONResponse
+from sqlalchemy import text
+from starlette.concurrency import run_in_threadpool
+
+from .config import PayConfig, is_dev_mode
+
+logger = logging.getLogger("viv-pay")
+
+
+class LoopLagMonitor:
+    """Measures event-loop lag as the overshoot of a periodic sleep.
+
+    A blocked loop wakes the sleeper late; the overshoot is how long other
+    coroutines would also have waited. Runs as a task started from the app
+    lifespan.
+    """
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self._task: asyncio.Task | None = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, time.perf_counter() - start - self.interval)
+            self.max_lag = max(self.max_lag, self.lag)
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def sample(self) -> float:
+        """Current lag; measured on the spot if the monitor task is not running."""
+        if self.running:
+            return self.lag
+        start = time.perf_counter()
+        await asyncio.sleep(0)
+        return time.perf_counter() - start
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run(), name="viv-pay-loop-lag")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class StripeProbe:
+    """Cached Stripe reachability check.
+
+    At most one request to Stripe per `ttl` seconds however often the health
+    endpoint is hit. Only one caller refreshes an expired result; the others
+    get the cached one meanwhile instead of waiting on Stripe, and only the
+    very first check is waited for. Goes to the SDK directly rather than through StripeGateway so probes neither use
+    rate-limit tokens nor move the circuit breaker.
+    """
+
+    def __init__(self, ttl: float = 30.0, check=None):
+        self.ttl = ttl
+        self._check = check or self._retrieve_balance
+        self._lock = threading.Lock()
+        self._result: dict | None = None
+        self._checked_at = 0.0
+
+    @staticmethod
+    def _retrieve_balance():
+        import stripe
+
+        stripe.Balance.retrieve()
+
+    def _cached(self) -> dict:
+        result, checked_at = self._result, self._checked_at
+        return dict(result, age_seconds=round(time.monotonic() - checked_at, 1))
+
+    def _expired(self) -> bool:
+        return self._result is None or time.monotonic() - self._checked_at >= self.ttl
+
+    def status(self) -> dict:
+        if not self._expired():
+            return self._cached()
+        if not self._lock.acquire(blocking=self._result is None):
+            return self._cached()  # another caller is refreshing
+        try:
+            if self._expired():
+                start = time.perf_counter()
+                try:
+                    self._check()
+                    result = {"reachable": True}
+                except Exception as exc:
+                    logger.warning("[viv-pay] Stripe health probe failed: %s", exc)
+                    result = {"reachable": False, "error": type(exc).__name__}
+                result["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+                self._result, self._checked_at = result, time.monotonic()
+        finally:
+            self._lock.release()
+        return self._cached()
+
+
+def pool_stats(engine) -> dict:
+    """Connection pool counters; pools without them (e.g. StaticPool) report None."""
+    pool = engine.pool
+
+    def counter(name):
+        method = getattr(pool, name, None)
+        return method() if callable(method) else None
+
+    return {
+        "class": type(pool).__name__,
+        "size": counter("size"),
+        "checked_out": counter("checkedout"),
+        "checked_in": counter("checkedin"),
+        "overflow": counter("overflow"),
+    }
+
+
+def ping_db(engine) -> dict:
+    start = time.perf_counter()
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+        result = {"ok": True}
+    except Exception as exc:
+        logger.warning("[viv-pay] DB health ping failed: %s", exc)
+        result = {"ok": False, "error": type(exc).__name__}
+    result["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    return result
+
+
+def create_health_handlers(
+    engine,
+    gateway,
+    admission,
+    config: PayConfig,
+    lag_monitor: LoopLagMonitor,
+    stripe_probe: StripeProbe,
+    customer_cache=None,
+    get_scheduler=None,
+    sqlite_writer=None,
+    catalog=None,
+):
+    """Factory — (health, health_deep) endpoint handlers.
+
+    `health` touches neither the DB nor Stripe and is meant for frequent
+    liveness/readiness probes. `health_deep` also pings the DB and reports
+    the cached Stripe check; it answers 503 if either is unreachable, so do
+    not use it as a liveness probe.
+    """
+
+    async def basics() -> dict:
+        lag = await lag_monitor.sample()
+        return {
+            "mode": "dev" if is_dev_mode() else "live",
+            "loop_lag_ms": round(lag * 1000, 1),
+            "loop_lag_max_ms": round(lag_monitor.max_lag * 1000, 1),
+            "pool": pool_stats(engine),
+            "stripe_circuit": gateway.breaker.state,
+        }
+
+    async def health():
+        body = await basics()
+        degraded = (
+            body["stripe_circuit"] != "closed"
+            or body["loop_lag_ms"] > config.health_max_loop_lag * 1000
+        )
+        body["status"] = "degraded" if degraded else "ok"
+        return JSONResponse(body)
+
+    async def health_deep():
+        body = await basics()
+        body["db"] = await run_in_threadpool(ping_db, engine)
+        if is_dev_mode():
+            body["stripe"] = {"reachable": None}
+        else:
+            body["stripe"] = await run_in_threadpool(stripe_probe.status)
+        body["gateway"] = gateway.stats()
+        body["webhook_admission"] = admission.stats()
+        if customer_cache is not None:
+            body["customer_cache"] = customer_cache.stats()
+        scheduler = get_scheduler() if get_scheduler is not None else None
+        if scheduler is not None:
+            body["jobs"] = scheduler.stats()["jobs"]
+        if sqlite_writer is not None:
+            body["sqlite_writer"] = dict(sqlite_writer.stats)
+        if catalog is not None:
+            body["catalog"] = catalog.stats_snapshot()
+
+        if not body["db"]["ok"] or body["stripe"]["reachable"] is False:
+            body["status"] = "down"
+            return JSONResponse(body, status_code=503)
+        degraded = (
+            body["stripe_circuit"] != "closed"
+            or body["loop_lag_ms"] > config.health_max_loop_lag * 1000
+        )
+        body["status"] = "degraded" if degraded else "ok"
+        return JSONResponse(body)
+
+    return health, health_deep
@@ -0,0 +1,23 @@
+from contextlib import asynccontextmanager
+
+
+def add_lifespan_hooks(app, on_startup=None, on_shutdown=None):
+    """Run `await on_startup()` / `await on_shutdown()` around the app's lifespan.
+
+    Wraps whatever lifespan the app already has, so viv-pay's background
+    tasks start after the app's own startup and stop before its shutdown.
+    """
+    inner = app.router.lifespan_context
+
+    @asynccontextmanager
+    async def lifespan(app_):
+        async with inner(app_) as state:
+            if on_startup is not None:
+                await on_startup()
+            try:
+                yield state
+            finally:
+                if on_shutdown is not None:
+                    await on_shutdown()
+
+    app.router.lifespan_context = lifespan
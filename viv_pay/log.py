@@ -0,0 +1,203 @@
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+
+from .ratelimit import TokenBucket
+
+LOGGER_NAME = "viv-pay"
+
+# Attributes every LogRecord has; anything else came in through `extra=`
+_RECORD_ATTRS = frozenset(
+    vars(logging.LogRecord("", 0, "", 0, "", (), None)).keys() | {"message", "asctime"}
+)
+
+
+class SamplingFilter(logging.Filter):
+    """Per-message-type sampling and rate limiting.
+
+    The message type is the unformatted template (`record.msg`), so all
+    "Subscription %s updated" lines share one budget whatever the arguments.
+    `sample_rates` maps a template prefix to the fraction kept; every type
+    is also limited to `rate_limit` = (records/sec, burst). Records at
+    `exempt_level` or above always pass. Dropped records are counted per
+    type in `suppressed`.
+    """
+
+    def __init__(
+        self,
+        sample_rates: dict[str, float] | None = None,
+        rate_limit: tuple[float, int] | None = (10.0, 20),
+        exempt_level: int = logging.WARNING,
+    ):
+        super().__init__()
+        self.sample_rates = dict(sample_rates or {})
+        self.rate_limit = rate_limit
+        self.exempt_level = exempt_level
+        self.suppressed: dict[str, int] = {}
+        self._buckets: dict[str, TokenBucket] = {}
+        self._rates: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _sample_rate(self, key: str) -> float:
+        rate = self._rates.get(key)
+        if rate is None:
+            rate = 1.0
+            for prefix, value in self.sample_rates.items():
+                if key.startswith(prefix):
+                    rate = value
+                    break
+            self._rates[key] = rate
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= self.exempt_level:
+            return True
+        key = str(record.msg)
+        rate = self._sample_rate(key)
+        keep = rate >= 1.0 or random.random() < rate
+        if keep and self.rate_limit is not None:
+            with self._lock:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._buckets[key] = TokenBucket(*self.rate_limit)
+                keep = bucket.wait_time() == 0.0
+                if keep:
+                    bucket.take()
+        if not keep:
+            self.suppressed[key] = self.suppressed.get(key, 0) + 1
+        return keep
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; `extra=` fields become top-level keys."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRS and not name.startswith("_"):
+                entry[name] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops (and counts) records when the queue is full.
+
+    Records are passed through unformatted; the listener thread does all
+    formatting and I/O.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LoggingSetup:
+    """Handles for a configure_logging() call.
+
+    `start()` attaches the queue handler to the logger and starts the
+    listener thread; `stop()` flushes, detaches and puts back the logger's
+    previous level, handlers and propagation.
+    """
+
+    def __init__(self, logger, handler, listener, sampling, level):
+        self.logger = logger
+        self.handler = handler
+        self.listener = listener
+        self.sampling = sampling
+        self.level = level
+        self._saved = None
+
+    def stats(self) -> dict:
+        return {
+            "dropped": self.handler.dropped,
+            "suppressed": dict(self.sampling.suppressed) if self.sampling else {},
+        }
+
+    def start(self):
+        if self._saved is not None:
+            return
+        logger = self.logger
+        self._saved = (logger.level, list(logger.handlers), logger.propagate)
+        self.listener.start()
+        for handler in self._saved[1]:
+            logger.removeHandler(handler)
+        logger.setLevel(self.level)
+        logger.addHandler(self.handler)
+        logger.propagate = False
+
+    def stop(self):
+        if self._saved is None:
+            return
+        level, handlers, propagate = self._saved
+        self._saved = None
+        logger = self.logger
+        logger.removeHandler(self.handler)
+        self.listener.stop()
+        logger.setLevel(level)
+        for handler in handlers:
+            logger.addHandler(handler)
+        logger.propagate = propagate
+
+
+def configure_logging(
+    level: int = logging.INFO,
+    json_format: bool = True,
+    sample_rates: dict[str, float] | None = None,
+    rate_limit: tuple[float, int] | None = (10.0, 20),
+    target: logging.Handler | None = None,
+    max_queue: int = 10000,
+    start: bool = True,
+) -> LoggingSetup:
+    """Route the "viv-pay" logger through a queue to `target` (stderr by default).
+
+    Callers only pay for the level check, sampling and a put_nowait; a
+    QueueListener thread formats and writes. While active, `level` applies
+    and viv-pay records go only to the queue: the logger's own handlers are
+    detached and records stop propagating to the root logger. With
+    start=False nothing changes until `start()` (init_pay calls it from the
+    app lifespan).
+    """
+    if target is None:
+        target = logging.StreamHandler(sys.stderr)
+    if json_format:
+        target.setFormatter(JsonFormatter())
+
+    log_queue: queue.Queue = queue.Queue(maxsize=max_queue)
+    handler = NonBlockingQueueHandler(log_queue)
+    sampling = None
+    if sample_rates or rate_limit:
+        sampling = SamplingFilter(sample_rates, rate_limit)
+        handler.addFilter(sampling)
+    listener = logging.handlers.QueueListener(log_queue, target, respect_handler_level=True)
+    setup = LoggingSetup(logging.getLogger(LOGGER_NAME), handler, listener, sampling, level)
+    if start:
+        setup.start()
+    return setup
+
+
+def log_duration(logger, level, msg, *args, start: float, **extra):
+    """Log `msg` with a `duration_ms` field measured from `start` (perf_counter)."""
+    if logger.isEnabledFor(level):
+        extra["duration_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        logger.log(level, msg, *args, extra=extra)
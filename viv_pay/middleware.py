@@ -1,9 +1,15 @@
+import functools
 import logging
 import os
+from urllib.parse import parse_qs
 
-from fastapi import Request
+from fastapi import HTTPException, Request
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import cookie_parser
 
 from .config import PayConfig, is_dev_mode
+from .storage import Entitlement, PayStore
+from .tracing import PayTracer
 
 logger = logging.getLogger("viv-pay")
 
@@ -14,86 +20,228 @@ class PaymentRequired(Exception):
     pass
 
 
-class MockSubscription:
-    """Returned in dev mode or API token auth when no real subscription exists."""
+class MockSubscription(Entitlement):
+    """Entitlement returned in dev mode or API token auth when no real subscription exists."""
+
+    __slots__ = ()
 
     def __init__(self, user_id: int):
-        self.id = 0
-        self.customer_id = 0
-        self.stripe_subscription_id = f"sub_dev_{user_id}"
-        self.stripe_price_id = "price_dev"
-        self.status = "active"
-        self.current_period_start = None
-        self.current_period_end = None
-        self.cancel_at = None
+        super().__init__(0, 0, f"sub_dev_{user_id}", "price_dev", "active", None, None, None)
 
 
-def _check_api_token(request: Request) -> bool:
-    """Check if request has a valid GDEV_API_TOKEN Bearer token."""
+@functools.lru_cache(maxsize=4096)
+def dev_entitlement(user_id: int) -> Entitlement:
+    """MockSubscription for `user_id`, cached: each user id maps to one shared instance."""
+    return MockSubscription(user_id)
+
+
+def _token_matches(auth_header: str) -> bool:
     token = os.environ.get("GDEV_API_TOKEN")
     if not token:
         return False
-    auth_header = request.headers.get("authorization", "")
     if auth_header.startswith("Bearer "):
         return auth_header[7:] == token
     return False
 
 
+def _check_api_token(request: Request) -> bool:
+    """Check if request has a valid GDEV_API_TOKEN Bearer token."""
+    return _token_matches(request.headers.get("authorization", ""))
+
+
+def _parse_user_id(value: str) -> int:
+    """Decimal user id; ValueError for anything else (int() also takes "+4", " 4", "4_2")."""
+    if not (value.isascii() and value.isdigit()):
+        raise ValueError(f"invalid user_id {value!r}")
+    return int(value)
+
+
+def _request_user_id(request: Request, user_id) -> int:
+    """user_id from the argument, query param, header or cookie.
+
+    PaymentRequired if there is none, a 400 if it is not a number.
+    """
+    if user_id is None:
+        user_id = request.query_params.get("user_id")
+    if user_id is None:
+        user_id = request.headers.get("x-user-id")
+    if user_id is None:
+        user_id = request.cookies.get("user_id")
+
+    if user_id is None:
+        raise PaymentRequired()
+    if isinstance(user_id, int):
+        return user_id
+    try:
+        return _parse_user_id(user_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid user_id") from None
+
+
 def create_require_subscription(
-    get_db, StripeCustomer, Subscription, config: PayConfig
+    store: PayStore, config: PayConfig, snapshot=None, tracer: PayTracer | None = None
 ):
-    """Factory — creates FastAPI dependency that checks for active subscription."""
+    """Factory — creates FastAPI dependency that checks for active subscription.
+
+    With an EntitlementSnapshot the check is a binary search over the shared
+    snapshot instead of a DB query, while the snapshot is available. Lookups are traced as
+    "require_subscription" spans.
+    """
+    tracer = tracer or PayTracer()
 
     async def require_subscription(
         request: Request, user_id: int | None = None
     ):
+        # Already resolved by SubscriptionGateMiddleware for this request
+        gated = request.scope.get("state", {}).get("subscription")
+        if gated is not None:
+            return gated
+
         # API token auth — bypass subscription check entirely
         if _check_api_token(request):
-            logger.info("[viv-pay] API token auth — subscription check bypassed")
-            return MockSubscription(user_id or 0)
-
-        # Try to get user_id from query param, header, or cookie
-        if user_id is None:
-            user_id = request.query_params.get("user_id")
-        if user_id is None:
-            user_id = request.headers.get("x-user-id")
-        if user_id is None:
-            user_id = request.cookies.get("user_id")
-
-        if user_id is None:
-            raise PaymentRequired()
+            logger.debug("[viv-pay] API token auth — subscription check bypassed")
+            return dev_entitlement(user_id or 0)
 
-        user_id = int(user_id)
+        user_id = _request_user_id(request, user_id)
 
         if is_dev_mode():
-            logger.info(
-                f"[viv-pay] DEV MODE — subscription check passed for user {user_id}"
+            logger.debug(
+                "[viv-pay] DEV MODE — subscription check passed for user %s", user_id,
+                extra={"user_id": user_id},
             )
-            return MockSubscription(user_id)
+            return dev_entitlement(user_id)
+
+        with tracer.span("require_subscription", phase="subscription", **{"user.id": user_id}):
+            if snapshot is not None and snapshot.available():
+                sub = snapshot.entitlement(user_id)
+            else:
+                with store.session() as db:
+                    sub = store.get_entitlement(db, user_id, config.allowed_statuses)
+        if not sub:
+            raise PaymentRequired()
+        return sub
 
-        db = next(get_db())
-        try:
-            customer = (
-                db.query(StripeCustomer)
-                .filter(StripeCustomer.user_id == user_id)
-                .first()
-            )
-            if not customer:
-                raise PaymentRequired()
-
-            sub = (
-                db.query(Subscription)
-                .filter(
-                    Subscription.customer_id == customer.id,
-                    Subscription.status.in_(config.allowed_statuses),
-                )
-                .first()
-            )
-            if not sub:
-                raise PaymentRequired()
+    return require_subscription
 
-            return sub
-        finally:
-            db.close()
 
-    return require_subscription
+def _precomputed_response(body: bytes, content_type: bytes, status: int = 403):
+    start = {
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", content_type),
+            (b"content-length", str(len(body)).encode()),
+        ],
+    }
+    return start, {"type": "http.response.body", "body": body}
+
+
+# Same bodies as the PaymentRequired exception handler in init_pay
+_DENY_JSON = _precomputed_response(
+    b'{"detail":"Subscription required"}', b"application/json"
+)
+_DENY_HTML = _precomputed_response(
+    b'<html><body><script>window.location.href="/pricing";</script>'
+    b"<p>Redirecting to pricing...</p></body></html>",
+    b"text/html; charset=utf-8",
+)
+# Same body as the HTTPException require_subscription raises
+_BAD_USER_ID = _precomputed_response(
+    b'{"detail":"Invalid user_id"}', b"application/json", status=400
+)
+
+
+def _user_id_from_scope(scope) -> str | None:
+    """Pull user_id from query string, x-user-id header or cookie, in that order."""
+    query = scope.get("query_string", b"")
+    if query:
+        # Last value wins, as with request.query_params
+        values = parse_qs(query.decode("latin-1"), keep_blank_values=True).get("user_id")
+        if values:
+            return values[-1]
+
+    cookie = None
+    for name, value in scope.get("headers", ()):
+        if name == b"x-user-id":
+            return value.decode("latin-1")
+        if name == b"cookie":
+            cookie = value
+    if cookie:
+        # Same parsing (quotes, escapes) as request.cookies in require_subscription
+        return cookie_parser(cookie.decode("latin-1")).get("user_id")
+    return None
+
+
+def _authorization(scope) -> str:
+    for name, value in scope.get("headers", ()):
+        if name == b"authorization":
+            return value.decode("latin-1")
+    return ""
+
+
+def create_subscription_resolver(store: PayStore, config: PayConfig, snapshot=None):
+    """Factory — resolves a user_id to its active subscription, or None.
+
+    Blocking (DB); SubscriptionGateMiddleware runs it in the threadpool.
+    """
+
+    def resolve(user_id: int):
+        if snapshot is not None and snapshot.available():
+            return snapshot.entitlement(user_id)
+        with store.session() as db:
+            return store.get_entitlement(db, user_id, config.allowed_statuses)
+
+    return resolve
+
+
+class SubscriptionGateMiddleware:
+    """Raw ASGI variant of require_subscription for whole path prefixes.
+
+    Requests under `prefixes` are checked before routing: no Request object,
+    no dependency resolution and no exception handler on denial — the 403
+    is sent from precomputed bytes (JSON under `api_prefix`, HTML redirect
+    otherwise). The resolved subscription is stored in the ASGI scope state,
+    so handlers read it as `request.state.subscription`.
+    """
+
+    def __init__(self, app, resolve, prefixes, api_prefix: str = "/api"):
+        self.app = app
+        self.resolve = resolve
+        self.prefixes = tuple(prefix.rstrip("/") for prefix in prefixes)
+        self.api_prefix = api_prefix.rstrip("/")
+        # "/api/pro" gates "/api/pro" and "/api/pro/...", not "/api/professional"
+        self._subtrees = tuple(prefix + "/" for prefix in self.prefixes)
+
+    async def __call__(self, scope, receive, send):
+        path = scope["path"] if scope["type"] == "http" else None
+        if path is None or not (path in self.prefixes or path.startswith(self._subtrees)):
+            await self.app(scope, receive, send)
+            return
+
+        raw_user_id = _user_id_from_scope(scope)
+        try:
+            user_id = _parse_user_id(raw_user_id) if raw_user_id is not None else None
+        except ValueError:
+            start, body = _BAD_USER_ID
+            await send(start)
+            await send(body)
+            return
+
+        if _token_matches(_authorization(scope)):
+            sub = dev_entitlement(user_id or 0)
+        elif user_id is None:
+            sub = None
+        elif is_dev_mode():
+            sub = dev_entitlement(user_id)
+        else:
+            sub = await run_in_threadpool(self.resolve, user_id)
+
+        if sub is None:
+            api = path == self.api_prefix or path.startswith(self.api_prefix + "/")
+            start, body = _DENY_JSON if api else _DENY_HTML
+            await send(start)
+            await send(body)
+            return
+
+        scope.setdefault("state", {})["subscription"] = sub
+        await self.app(scope, receive, send)
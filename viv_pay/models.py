@@ -1,6 +1,15 @@
 from datetime import datetime, timezone
 
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String
+from sqlalchemy import (
+    Boolean,
+    Column,
+    DateTime,
+    Float,
+    ForeignKey,
+    Integer,
+    String,
+    UniqueConstraint,
+)
 
 
 def utcnow():
@@ -36,6 +45,10 @@ def create_pay_models(Base):
         current_period_start = Column(DateTime(timezone=True), nullable=True)
         current_period_end = Column(DateTime(timezone=True), nullable=True)
         cancel_at = Column(DateTime(timezone=True), nullable=True)
+        # Optimistic concurrency: bumped by every conditional update
+        version = Column(Integer, nullable=False, default=1, server_default="1")
+        # `created` (unix seconds) of the newest Stripe event applied
+        last_event_at = Column(Integer, nullable=True)
         created_at = Column(DateTime(timezone=True), default=utcnow)
         updated_at = Column(
             DateTime(timezone=True), default=utcnow, onupdate=utcnow
@@ -59,3 +72,98 @@ def create_pay_models(Base):
         created_at = Column(DateTime(timezone=True), default=utcnow)
 
     return StripeCustomer, Subscription, Payment
+
+
+def create_event_cursor_model(Base):
+    """Factory — persisted cursors for the Stripe Events API poller."""
+
+    class PayEventCursor(Base):
+        __tablename__ = "pay_event_cursors"
+
+        name = Column(String, primary_key=True)
+        event_id = Column(String, nullable=True)
+        updated_at = Column(
+            DateTime(timezone=True), default=utcnow, onupdate=utcnow
+        )
+
+    return PayEventCursor
+
+
+def create_usage_model(Base):
+    """Factory — aggregated usage totals awaiting (or sent to) Stripe meters."""
+
+    class UsageRecord(Base):
+        __tablename__ = "usage_records"
+
+        id = Column(Integer, primary_key=True)
+        user_id = Column(Integer, nullable=False, index=True)
+        meter = Column(String, nullable=False)
+        # Start of the aggregation window, unix seconds
+        window_start = Column(Integer, nullable=False)
+        quantity = Column(Integer, nullable=False)
+        # 0 while flushes still add to the row; set to the row id once a push
+        # claims it, after which its quantity no longer changes
+        push_key = Column(Integer, nullable=False, default=0, server_default="0")
+        created_at = Column(DateTime(timezone=True), default=utcnow)
+        pushed_at = Column(DateTime(timezone=True), nullable=True, index=True)
+
+        # One open row per (user, meter, window); claimed rows keep their own
+        # key. Ids are meter event identifiers, so SQLite must not reuse the
+        # ids of pruned rows.
+        __table_args__ = (
+            UniqueConstraint("user_id", "meter", "window_start", "push_key"),
+            {"sqlite_autoincrement": True},
+        )
+
+    return UsageRecord
+
+
+def create_job_lease_model(Base):
+    """Factory — one lease row per scheduled job, shared by all workers."""
+
+    class PayJobLease(Base):
+        __tablename__ = "pay_job_leases"
+
+        name = Column(String, primary_key=True)
+        owner = Column(String, nullable=False)
+        # Unix seconds; nobody else may run the job before this
+        expires_at = Column(Float, nullable=False)
+        last_started_at = Column(Float, nullable=True)
+        last_finished_at = Column(Float, nullable=True)
+
+    return PayJobLease
+
+
+def create_catalog_models(Base):
+    """Factory — local copy of the Stripe account's products and prices."""
+
+    class PayProduct(Base):
+        __tablename__ = "pay_products"
+
+        stripe_product_id = Column(String, primary_key=True)
+        name = Column(String, nullable=False)
+        description = Column(String, nullable=True)
+        active = Column(Boolean, nullable=False, default=True)
+        # `created` of the newest event applied, or the start of the last sync
+        last_event_at = Column(Integer, nullable=True)
+        updated_at = Column(DateTime(timezone=True), default=utcnow, onupdate=utcnow)
+
+    class PayPrice(Base):
+        __tablename__ = "pay_prices"
+
+        stripe_price_id = Column(String, primary_key=True)
+        stripe_product_id = Column(String, nullable=False, index=True)
+        active = Column(Boolean, nullable=False, default=True)
+        currency = Column(String(3), nullable=False)
+        # None for tiered and customer-chosen prices
+        unit_amount = Column(Integer, nullable=True)
+        # "recurring" or "one_time"
+        type = Column(String, nullable=False)
+        recurring_interval = Column(String, nullable=True)
+        recurring_interval_count = Column(Integer, nullable=True)
+        nickname = Column(String, nullable=True)
+        lookup_key = Column(String, nullable=True)
+        last_event_at = Column(Integer, nullable=True)
+        updated_at = Column(DateTime(timezone=True), default=utcnow, onupdate=utcnow)
+
+    return PayProduct, PayPrice
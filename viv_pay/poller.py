@@ -0,0 +1,307 @@
+import argparse
+import asyncio
+import logging
+import os
+
+from sqlalchemy import insert, update
+from sqlalchemy.exc import IntegrityError
+from starlette.concurrency import run_in_threadpool
+
+from .config import PayConfig
+from .gateway import StripeGateway
+from .storage import PayStore
+from .webhooks import WebhookRegistry, event_to_dict
+
+logger = logging.getLogger("viv-pay")
+
+STRIPE_MAX_PAGE = 100
+
+
+class SQLCursor:
+    """Poller cursor persisted in the `pay_event_cursors` table.
+
+    `save` is a compare-and-set on the previous event id, so a poller that
+    lost a race (or its lease) cannot move the cursor backwards.
+    """
+
+    def __init__(self, get_db, PayEventCursor, name: str = "events"):
+        self.get_db = get_db
+        self.Model = PayEventCursor
+        self.name = name
+
+    def load(self) -> str | None:
+        db = next(self.get_db())
+        try:
+            row = db.get(self.Model, self.name)
+            return row.event_id if row else None
+        finally:
+            db.close()
+
+    def save(self, event_id: str, previous: str | None = None) -> bool:
+        """Move the cursor from `previous` to `event_id`; False if it was elsewhere."""
+        Model = self.Model
+        db = next(self.get_db())
+        try:
+            if previous is None:
+                try:
+                    db.execute(insert(Model).values(name=self.name, event_id=event_id))
+                except IntegrityError:
+                    db.rollback()
+                    return False
+            else:
+                result = db.execute(
+                    update(Model)
+                    .where(Model.name == self.name, Model.event_id == previous)
+                    .values(event_id=event_id)
+                )
+                if result.rowcount != 1:
+                    db.rollback()
+                    return False
+            db.commit()
+            return True
+        finally:
+            db.close()
+
+
+class MemoryCursor:
+    def __init__(self, event_id: str | None = None):
+        self.event_id = event_id
+
+    def load(self) -> str | None:
+        return self.event_id
+
+    def save(self, event_id: str, previous: str | None = None) -> bool:
+        if self.event_id != previous:
+            return False
+        self.event_id = event_id
+        return True
+
+
+class EventPoller:
+    """Pulls events from Stripe's Events API and runs them through the webhook registry.
+
+    Each page of events is one batch. Events are handled oldest first and the
+    cursor (the newest handled event id) is saved after the batch, so delivery
+    is at-least-once. When a page comes back full, the next poll runs at once
+    with a larger page; when idle, the interval backs off toward
+    `max_interval` and the page size shrinks again.
+
+    With no saved cursor the poller starts from the newest existing event
+    rather than replaying Stripe's whole retention window.
+
+    In an app, `drain()` runs as a scheduler job so only the lease holder
+    polls; `run()` is the loop of the standalone poller. Either way the
+    cursor only moves forward from the id the batch started at.
+
+    An event that fails `max_attempts` polls in a row is logged at ERROR,
+    counted in `stats["skipped"]` and stepped over, so one poison event
+    cannot stall the poller. Attempts are counted per process.
+    """
+
+    def __init__(
+        self,
+        store: PayStore,
+        registry: WebhookRegistry,
+        cursor,
+        gateway: StripeGateway | None = None,
+        min_interval: float = 5.0,
+        max_interval: float = 60.0,
+        min_page_size: int = 10,
+        max_page_size: int = STRIPE_MAX_PAGE,
+        max_attempts: int = 5,
+        list_events=None,
+    ):
+        self.store = store
+        self.registry = registry
+        self.cursor = cursor
+        self.gateway = gateway or StripeGateway(PayConfig())
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.min_page_size = min_page_size
+        self.max_page_size = min(max_page_size, STRIPE_MAX_PAGE)
+        self.interval = min_interval
+        self.page_size = min_page_size
+        self.max_attempts = max_attempts
+        self._failures: dict[str, int] = {}
+        self._list_events = list_events or self._list_stripe_events
+        self._task: asyncio.Task | None = None
+        self.stats = {
+            "polls": 0, "events": 0, "handled": 0, "errors": 0, "conflicts": 0, "skipped": 0,
+        }
+
+    def _list_stripe_events(self, ending_before: str | None, limit: int):
+        """Returns (events oldest-first as dicts, has_more)."""
+        import stripe
+
+        params = {"limit": limit}
+        if ending_before:
+            params["ending_before"] = ending_before
+        page = self.gateway.call("event.list", stripe.Event.list, **params)
+        events = [event_to_dict(e) for e in page.data]
+        events.reverse()  # Stripe lists newest first
+        return events, page.has_more
+
+    def _adapt(self, fetched: int, has_more: bool):
+        if has_more:
+            self.page_size = min(self.page_size * 2, self.max_page_size)
+            self.interval = 0
+        elif fetched:
+            self.interval = self.min_interval
+        else:
+            self.page_size = max(self.page_size // 2, self.min_page_size)
+            self.interval = min(max(self.interval, self.min_interval) * 2, self.max_interval)
+
+    async def poll_once(self) -> int:
+        """Fetch and handle one page. Returns the number of events processed.
+
+        Events the cursor moved past count, except skipped poison events.
+        """
+        self.stats["polls"] += 1
+        cursor_id = await run_in_threadpool(self.cursor.load)
+        if cursor_id is None:
+            newest, _ = await run_in_threadpool(self._list_events, None, 1)
+            if newest and await run_in_threadpool(self.cursor.save, newest[-1]["id"]):
+                logger.info("[viv-pay] Event poller starting after %s", newest[-1]["id"])
+            self._adapt(0, False)
+            return 0
+
+        events, has_more = await run_in_threadpool(
+            self._list_events, cursor_id, self.page_size
+        )
+        self.stats["events"] += len(events)
+
+        last_id = None
+        processed = 0
+        for event in events:
+            event_id, event_type = event["id"], event.get("type", "")
+            try:
+                if await self.registry.dispatch(
+                    self.store, event_type, event.get("data", {}).get("object", {}), event
+                ):
+                    self.stats["handled"] += 1
+            except Exception:
+                self.stats["errors"] += 1
+                attempts = self._failures.get(event_id, 0) + 1
+                if attempts < self.max_attempts:
+                    # Stop here; the next poll retries from the last good event
+                    self._failures = {event_id: attempts}
+                    logger.exception(
+                        "[viv-pay] Polled event %s (%s) failed (attempt %d of %d)",
+                        event_id, event_type, attempts, self.max_attempts,
+                        extra={"event_type": event_type},
+                    )
+                    has_more = False
+                    break
+                self._failures = {}
+                self.stats["skipped"] += 1
+                logger.exception(
+                    "[viv-pay] Polled event %s (%s) failed %d times; skipping it",
+                    event_id, event_type, attempts,
+                    extra={"event_type": event_type},
+                )
+            else:
+                self._failures.pop(event_id, None)
+                processed += 1
+            last_id = event_id
+
+        if last_id and not await run_in_threadpool(self.cursor.save, last_id, cursor_id):
+            # Another poller moved the cursor meanwhile; start from its position
+            self.stats["conflicts"] += 1
+            logger.warning(
+                "[viv-pay] Event cursor moved by another poller; not saving %s", last_id
+            )
+            has_more = True
+        self._adapt(len(events), has_more)
+        return processed if last_id else 0
+
+    async def drain(self) -> int:
+        """Poll until caught up. Returns the number of events handled."""
+        handled = await self.poll_once()
+        while self.interval == 0:
+            handled += await self.poll_once()
+        return handled
+
+    async def run(self):
+        while True:
+            try:
+                await self.poll_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.stats["errors"] += 1
+                logger.exception("[viv-pay] Event poll failed")
+                self.interval = min(max(self.interval, self.min_interval) * 2, self.max_interval)
+            await asyncio.sleep(self.interval)
+
+    async def start(self):
+        self._task = asyncio.create_task(self.run(), name="viv-pay-event-poller")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+def main(argv=None):
+    """CLI — poll Stripe events into the DB: python -m viv_pay.poller --database-url ..."""
+    import stripe
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import declarative_base, sessionmaker
+
+    from .models import create_event_cursor_model, create_pay_models
+    from .storage import SQLAlchemyStore
+    from .webhooks import create_default_registry
+
+    parser = argparse.ArgumentParser(description="Poll Stripe's Events API into viv-pay")
+    parser.add_argument("--database-url", required=True)
+    parser.add_argument("--once", action="store_true", help="drain the backlog, then exit")
+    parser.add_argument("--since-event", help="start after this event id if no cursor is saved")
+    parser.add_argument("--min-interval", type=float, default=5.0)
+    parser.add_argument("--max-interval", type=float, default=60.0)
+    parser.add_argument("--max-attempts", type=int, default=5,
+                        help="skip an event after it failed this many polls in a row")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    stripe.api_key = os.environ["STRIPE_SECRET_KEY"]
+
+    engine = create_engine(args.database_url)
+    SessionLocal = sessionmaker(bind=engine)
+    Base = declarative_base()
+    models = create_pay_models(Base)
+    PayEventCursor = create_event_cursor_model(Base)
+    Base.metadata.create_all(bind=engine)
+
+    def get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    store = SQLAlchemyStore(get_db, *models)
+    cursor = SQLCursor(get_db, PayEventCursor)
+    if args.since_event and cursor.load() is None:
+        cursor.save(args.since_event)
+    poller = EventPoller(
+        store,
+        create_default_registry(store),
+        cursor,
+        min_interval=args.min_interval,
+        max_interval=args.max_interval,
+        max_attempts=args.max_attempts,
+    )
+
+    async def drain():
+        while await poller.poll_once() or poller.interval == 0:
+            pass
+
+    asyncio.run(drain() if args.once else poller.run())
+
+
+if __name__ == "__main__":
+    main()
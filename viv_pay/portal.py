@@ -1,12 +1,16 @@
 import logging
 
-from .config import is_dev_mode
+from .config import PayConfig, is_dev_mode
+from .gateway import StripeGateway
 
 logger = logging.getLogger("viv-pay")
 
 
-def create_portal_helper(get_customer, app_url: str):
+def create_portal_helper(
+    get_customer, app_url: str, gateway: StripeGateway | None = None
+):
     """Factory — creates customer portal session helper."""
+    gateway = gateway or StripeGateway(PayConfig())
 
     def create_portal_session(
         db,
@@ -16,7 +20,10 @@ def create_portal_helper(get_customer, app_url: str):
         """Create a Stripe Customer Portal session. Returns the portal URL."""
         customer = get_customer(db, user_id)
         if not customer:
-            logger.warning(f"[viv-pay] Portal requested for unknown user {user_id}")
+            logger.warning(
+                "[viv-pay] Portal requested for unknown user %s", user_id,
+                extra={"user_id": user_id},
+            )
             return None
 
         effective_return_url = return_url or app_url
@@ -24,18 +31,25 @@ def create_portal_helper(get_customer, app_url: str):
         if is_dev_mode():
             fake_url = f"{app_url}/pay/portal-dev?customer={customer.stripe_customer_id}"
             logger.info(
-                f"[viv-pay] DEV MODE — mock portal for user {user_id}: {fake_url}"
+                "[viv-pay] DEV MODE — mock portal for user %s: %s", user_id, fake_url,
+                extra={"user_id": user_id},
             )
             return fake_url
 
         import stripe
 
-        session = stripe.billing_portal.Session.create(
+        session = gateway.call(
+            "billing_portal.session.create",
+            stripe.billing_portal.Session.create,
+            idempotent=True,
             customer=customer.stripe_customer_id,
             return_url=effective_return_url,
         )
 
-        logger.info(f"[viv-pay] Portal session created for user {user_id}")
+        logger.info(
+            "[viv-pay] Portal session created for user %s", user_id,
+            extra={"user_id": user_id},
+        )
         return session.url
 
     return create_portal_session
@@ -0,0 +1,178 @@
+import argparse
+import asyncio
+import csv
+import logging
+import os
+import sys
+
+from .config import PayConfig, is_dev_mode
+from .customer import create_stripe_customer
+from .gateway import StripeGateway
+from .storage import PayStore
+
+logger = logging.getLogger("viv-pay")
+
+
+async def _chunks(users, size: int):
+    """Chunk a sync or async iterable of (user_id, email) pairs."""
+    chunk = []
+    if hasattr(users, "__aiter__"):
+        async for user in users:
+            chunk.append(user)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+    else:
+        for user in users:
+            chunk.append(user)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+async def provision_customers(
+    store: PayStore,
+    users,
+    gateway: StripeGateway | None = None,
+    concurrency: int = 16,
+    chunk_size: int = 500,
+    app_id: str = "app",
+) -> dict:
+    """Create Stripe customers ahead of time for (user_id, email) pairs.
+
+    `users` may be any sync or async iterable and is consumed in chunks of
+    `chunk_size`, so it can be a DB cursor or a file stream. Per chunk,
+    users that already have a customer are skipped, the rest are created in
+    Stripe with at most `concurrency` calls in flight, and the new rows are
+    bulk-inserted and committed. Re-running after an interruption resumes
+    where it stopped. Each user's idempotency key is derived from `app_id`
+    (the app's PayConfig.app_id) and the user id, so a chunk that reached Stripe but not the DB does not create
+    duplicate customers when retried within Stripe's 24h key window. Users
+    whose first checkout inserted their customer meanwhile are skipped.
+
+    Returns counts: created, skipped, failed.
+    """
+    gateway = gateway or StripeGateway(PayConfig())
+    semaphore = asyncio.Semaphore(concurrency)
+    stats = {"created": 0, "skipped": 0, "failed": 0}
+    dev = is_dev_mode()
+
+    async def create(user_id: int, email: str):
+        if dev:
+            return {"user_id": user_id, "email": email, "stripe_customer_id": f"cus_dev_{user_id}"}
+        async with semaphore:
+            try:
+                customer = await asyncio.to_thread(
+                    create_stripe_customer, gateway, app_id, user_id, email
+                )
+            except Exception as exc:
+                logger.warning(
+                    "[viv-pay] Provisioning user %s failed: %s", user_id, exc,
+                    extra={"user_id": user_id},
+                )
+                return None
+        return {"user_id": user_id, "email": email, "stripe_customer_id": customer.id}
+
+    async for chunk in _chunks(users, chunk_size):
+        # Last occurrence wins if a user appears twice in one chunk
+        pending = {int(user_id): email for user_id, email in chunk}
+        with store.session() as db:
+            existing = store.get_customer_user_ids(db, pending)
+        stats["skipped"] += len(existing)
+        results = await asyncio.gather(
+            *(create(user_id, email) for user_id, email in pending.items() if user_id not in existing)
+        )
+        rows = [row for row in results if row is not None]
+        stats["failed"] += len(results) - len(rows)
+        if rows:
+            def insert(db):
+                added = store.add_customers(db, rows)
+                store.commit(db)
+                return added
+
+            with store.session() as db:
+                added = store.write(db, insert)
+            stats["created"] += added
+            stats["skipped"] += len(rows) - added
+        logger.info(
+            "[viv-pay] Provisioned %d customer(s) (%d existing, %d failed)",
+            stats["created"], stats["skipped"], stats["failed"],
+        )
+    return stats
+
+
+def _read_csv(path: str):
+    f = sys.stdin if path == "-" else open(path, newline="")
+    try:
+        for row in csv.DictReader(f):
+            yield int(row["user_id"]), row["email"]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def main(argv=None):
+    """CLI — pre-create Stripe customers: python -m viv_pay.provision --database-url ..."""
+    import stripe
+    from sqlalchemy import create_engine, text
+    from sqlalchemy.orm import declarative_base, sessionmaker
+
+    from .models import create_pay_models
+    from .storage import SQLAlchemyStore
+
+    parser = argparse.ArgumentParser(description="Bulk-create Stripe customers for existing users")
+    parser.add_argument("--database-url", required=True)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--csv", help="CSV file with user_id,email columns ('-' for stdin)")
+    source.add_argument("--query", help="SQL returning (user_id, email) rows, e.g. from your users table")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument(
+        "--app-id", default="app",
+        help="the app's PayConfig.app_id (default: app_name as a slug), so keys match lazy creation",
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if not is_dev_mode():
+        stripe.api_key = os.environ["STRIPE_SECRET_KEY"]
+        stripe.max_network_retries = 0
+
+    engine = create_engine(args.database_url)
+    SessionLocal = sessionmaker(bind=engine)
+    Base = declarative_base()
+    models = create_pay_models(Base)
+    Base.metadata.create_all(bind=engine)
+
+    def get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def query_users():
+        # Separate connection, streamed so 200k users are never all in memory
+        with engine.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(text(args.query))
+            for user_id, email in result:
+                yield user_id, email
+
+    users = _read_csv(args.csv) if args.csv else query_users()
+    stats = asyncio.run(
+        provision_customers(
+            SQLAlchemyStore(get_db, *models),
+            users,
+            concurrency=args.concurrency,
+            chunk_size=args.chunk_size,
+            app_id=args.app_id,
+        )
+    )
+    print(stats)
+    return 0 if not stats["failed"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
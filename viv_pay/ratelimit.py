@@ -0,0 +1,144 @@
+import threading
+import time
+from collections import deque
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` tokens/sec up to `burst`.
+
+    Not thread-safe on its own — FairLimiter guards its buckets with one lock.
+    """
+
+    def __init__(self, rate: float, burst: int, clock=time.monotonic):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = float(rate)
+        self.capacity = float(max(burst, 1))
+        self.tokens = self.capacity
+        self._clock = clock
+        self._updated = clock()
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self._updated = now
+
+    def wait_time(self, now: float | None = None) -> float:
+        """Seconds until one token is available (0.0 if one is available now)."""
+        self._refill(self._clock() if now is None else now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class FairLimiter:
+    """Per-operation token buckets behind one shared, account-wide bucket.
+
+    Callers queue per operation. When the shared bucket has a token it goes to
+    the least-recently-served operation whose own bucket is ready, so a burst
+    of one operation (e.g. customer.create) cannot starve the others.
+    """
+
+    def __init__(
+        self,
+        global_rate: tuple[float, int],
+        default_rate: tuple[float, int],
+        rates: dict[str, tuple[float, int]] | None = None,
+    ):
+        self._cond = threading.Condition()
+        self._global = TokenBucket(*global_rate)
+        self._default_rate = default_rate
+        self._rates = dict(rates or {})
+        self._buckets: dict[str, TokenBucket] = {}
+        self._queues: dict[str, deque] = {}
+        self._last_served: dict[str, float] = {}
+
+    def _bucket(self, op: str) -> TokenBucket:
+        bucket = self._buckets.get(op)
+        if bucket is None:
+            rate, burst = self._rates.get(op, self._default_rate)
+            bucket = self._buckets[op] = TokenBucket(rate, burst)
+        return bucket
+
+    def _next_op(self, now: float) -> str | None:
+        ready = [
+            op
+            for op, queue in self._queues.items()
+            if queue and self._bucket(op).wait_time(now) == 0
+        ]
+        if not ready:
+            return None
+        return min(ready, key=lambda op: self._last_served.get(op, float("-inf")))
+
+    def queued(self) -> dict[str, int]:
+        with self._cond:
+            return {op: len(q) for op, q in self._queues.items() if q}
+
+    def acquire(self, op: str, timeout: float | None = None) -> float:
+        """Block until `op` may call Stripe. Returns seconds spent waiting.
+
+        Raises TimeoutError if no slot was granted within `timeout` seconds.
+        """
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        ticket = object()
+        with self._cond:
+            queue = self._queues.setdefault(op, deque())
+            queue.append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = None
+                    if queue[0] is ticket:
+                        own_wait = self._bucket(op).wait_time(now)
+                        global_wait = self._global.wait_time(now)
+                        if (
+                            own_wait == 0
+                            and global_wait == 0
+                            and self._next_op(now) == op
+                        ):
+                            self._global.take()
+                            self._bucket(op).take()
+                            self._last_served[op] = now
+                            return now - start
+                        # Another operation may be chosen first; re-check soon.
+                        wait = max(own_wait, global_wait, 0.001)
+                    if deadline is not None:
+                        remaining = deadline - now
+                        if remaining <= 0:
+                            raise TimeoutError(f"rate limiter queue wait exceeded for {op}")
+                        wait = remaining if wait is None else min(wait, remaining)
+                    self._cond.wait(wait)
+            finally:
+                queue.remove(ticket)
+                self._cond.notify_all()
+
+
+class RetryBudget:
+    """Limits retries to a fraction of recent calls.
+
+    Every call deposits `ratio` tokens and every retry withdraws one, so under
+    a sustained outage retries add at most `ratio` extra load on Stripe.
+    `min_reserve` allows a few retries when traffic is low.
+    """
+
+    def __init__(self, ratio: float = 0.2, min_reserve: int = 10):
+        self.ratio = ratio
+        self.cap = float(max(min_reserve, 1))
+        self.balance = self.cap
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.balance = min(self.cap, self.balance + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self.balance < 1:
+                return False
+            self.balance -= 1
+            return True
@@ -0,0 +1,304 @@
+import asyncio
+import inspect
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+
+from sqlalchemy import insert, update
+from sqlalchemy.exc import IntegrityError
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger("viv-pay")
+
+
+def default_owner() -> str:
+    """Lease owner id for this process: host, pid and a random suffix."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class SQLLease:
+    """Job leases in the `pay_job_leases` table.
+
+    A lease is taken by a conditional UPDATE (expired, or already ours) or,
+    for a job's first run, an INSERT that loses on the primary key if
+    another worker got there first. Works the same on every dialect, and
+    unlike a Postgres advisory lock it also records when the job may next
+    run, so workers whose timers fire a moment apart do not run it twice.
+    Expiry uses wall-clock time, so hosts need roughly synced clocks.
+    """
+
+    def __init__(self, get_db, PayJobLease):
+        self.get_db = get_db
+        self.Model = PayJobLease
+
+    def acquire(
+        self, name: str, owner: str, until: float, renew: bool = False, now: float | None = None
+    ) -> bool:
+        """Take the expired lease on `name` until `until`; False if it is held.
+
+        With `renew`, extend a lease `owner` already holds instead.
+        """
+        now = time.time() if now is None else now
+        Model = self.Model
+        held = Model.owner == owner if renew else Model.expires_at <= now
+        db = next(self.get_db())
+        try:
+            result = db.execute(
+                update(Model).where(Model.name == name, held).values(owner=owner, expires_at=until)
+            )
+            if result.rowcount == 1 or renew:
+                db.commit()
+                return result.rowcount == 1
+            try:
+                db.execute(insert(Model).values(name=name, owner=owner, expires_at=until))
+                db.commit()
+                return True
+            except IntegrityError:
+                db.rollback()
+                return False
+        finally:
+            db.close()
+
+    def finish(self, name: str, owner: str, started: float, finished: float, hold_until: float):
+        """Record a completed run and keep the lease until the next run is due."""
+        Model = self.Model
+        db = next(self.get_db())
+        try:
+            db.execute(
+                update(Model)
+                .where(Model.name == name, Model.owner == owner)
+                .values(
+                    expires_at=hold_until,
+                    last_started_at=started,
+                    last_finished_at=finished,
+                )
+            )
+            db.commit()
+        finally:
+            db.close()
+
+
+class MemoryLease:
+    """Single-process lease store, for tests."""
+
+    def __init__(self):
+        self.leases: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def acquire(
+        self, name: str, owner: str, until: float, renew: bool = False, now: float | None = None
+    ) -> bool:
+        now = time.time() if now is None else now
+        with self._lock:
+            lease = self.leases.get(name)
+            if renew:
+                if lease is None or lease["owner"] != owner:
+                    return False
+            elif lease is not None and lease["expires_at"] > now:
+                return False
+            self.leases[name] = dict(lease or {}, owner=owner, expires_at=until)
+            return True
+
+    def finish(self, name: str, owner: str, started: float, finished: float, hold_until: float):
+        with self._lock:
+            lease = self.leases.get(name)
+            if lease is not None and lease["owner"] == owner:
+                lease.update(
+                    expires_at=hold_until, last_started_at=started, last_finished_at=finished
+                )
+
+
+class Job:
+    """A periodic job and its run metrics."""
+
+    def __init__(self, name: str, fn, interval: float, lease_ttl: float, jitter: float):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.lease_ttl = lease_ttl
+        self.jitter = jitter
+        self.running = False
+        self.stats = {
+            "runs": 0,
+            "failures": 0,
+            # Due but the lease was held by another worker
+            "skipped": 0,
+            "last_duration": None,
+            "max_duration": 0.0,
+            "total_duration": 0.0,
+            "last_run_at": None,
+        }
+
+    def next_delay(self) -> float:
+        spread = self.interval * self.jitter
+        return max(0.0, self.interval + random.uniform(-spread, spread))
+
+
+class JobScheduler:
+    """Runs periodic jobs on exactly one worker of the cluster.
+
+    Each worker keeps a timer per job (interval +/- jitter). When it fires,
+    the worker tries to take the job's lease; the winner runs the job,
+    renews the lease every `lease_ttl / 3` while it runs and afterwards
+    holds it until the next run is due. The first timer fires at a random
+    point within the first interval, so workers started together do not all
+    contend at once.
+
+    `stop()` lets runs in progress finish for up to `shutdown_timeout`
+    seconds before cancelling them.
+    """
+
+    def __init__(
+        self,
+        lease,
+        owner: str | None = None,
+        jitter: float = 0.1,
+        lease_ttl: float = 300.0,
+        shutdown_timeout: float = 10.0,
+    ):
+        self.lease = lease
+        self.owner = owner or default_owner()
+        self.jitter = jitter
+        self.lease_ttl = lease_ttl
+        self.shutdown_timeout = shutdown_timeout
+        self.jobs: dict[str, Job] = {}
+        self._tasks: list[asyncio.Task] = []
+        self._stopping: asyncio.Event | None = None
+
+    def add_job(
+        self,
+        name: str,
+        fn,
+        interval: float,
+        lease_ttl: float | None = None,
+        jitter: float | None = None,
+    ) -> Job:
+        """Schedule `fn()` every `interval` seconds; sync functions run in the threadpool.
+
+        Jobs added after `start()` begin with the next start.
+        """
+        if name in self.jobs:
+            raise ValueError(f"job {name!r} already scheduled")
+        job = Job(
+            name,
+            fn,
+            interval,
+            self.lease_ttl if lease_ttl is None else lease_ttl,
+            self.jitter if jitter is None else jitter,
+        )
+        self.jobs[name] = job
+        return job
+
+    async def _call(self, job: Job):
+        if inspect.iscoroutinefunction(job.fn):
+            await job.fn()
+        else:
+            result = await run_in_threadpool(job.fn)
+            if inspect.isawaitable(result):
+                await result
+
+    async def _renew(self, job: Job):
+        while True:
+            await asyncio.sleep(job.lease_ttl / 3)
+            until = time.time() + job.lease_ttl
+            if not await run_in_threadpool(
+                self.lease.acquire, job.name, self.owner, until, True
+            ):
+                logger.warning("[viv-pay] Lost lease on job %s while running", job.name)
+                return
+
+    async def run_job(self, job: Job) -> bool:
+        """Run `job` now if this worker can take its lease. Returns whether it ran."""
+        started = time.time()
+        acquired = await run_in_threadpool(
+            self.lease.acquire, job.name, self.owner, started + job.lease_ttl
+        )
+        if not acquired:
+            job.stats["skipped"] += 1
+            return False
+
+        job.running = True
+        renew = asyncio.create_task(self._renew(job))
+        start = time.perf_counter()
+        try:
+            await self._call(job)
+        except Exception:
+            job.stats["failures"] += 1
+            logger.exception("[viv-pay] Job %s failed", job.name)
+        finally:
+            renew.cancel()
+            job.running = False
+            duration = time.perf_counter() - start
+            stats = job.stats
+            stats["runs"] += 1
+            stats["last_duration"] = round(duration, 3)
+            stats["max_duration"] = round(max(stats["max_duration"], duration), 3)
+            stats["total_duration"] = round(stats["total_duration"] + duration, 3)
+            stats["last_run_at"] = started
+        finished = time.time()
+        # Hold the lease until the next run is due, so no other worker repeats it
+        await run_in_threadpool(
+            self.lease.finish,
+            job.name,
+            self.owner,
+            started,
+            finished,
+            max(started + job.interval, finished),
+        )
+        logger.debug(
+            "[viv-pay] Job %s ran in %.3fs", job.name, duration, extra={"job": job.name}
+        )
+        return True
+
+    async def _wait(self, delay: float) -> bool:
+        """Sleep `delay` seconds; True if stop() was called meanwhile."""
+        try:
+            await asyncio.wait_for(self._stopping.wait(), timeout=delay)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _loop(self, job: Job):
+        if await self._wait(random.uniform(0, job.interval)):
+            return
+        while True:
+            try:
+                await self.run_job(job)
+            except Exception:
+                # Lease store unreachable; try again at the next tick
+                logger.exception("[viv-pay] Job %s could not be scheduled", job.name)
+            if await self._wait(job.next_delay()):
+                return
+
+    async def start(self):
+        self._stopping = asyncio.Event()
+        self._tasks = [
+            asyncio.create_task(self._loop(job), name=f"viv-pay-job-{job.name}")
+            for job in self.jobs.values()
+        ]
+
+    async def stop(self):
+        if self._stopping is None:
+            return
+        self._stopping.set()
+        tasks, self._tasks = self._tasks, []
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=self.shutdown_timeout)
+        for task in pending:
+            logger.warning("[viv-pay] Cancelling %s at shutdown", task.get_name())
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "owner": self.owner,
+            "jobs": {
+                name: dict(job.stats, interval=job.interval, running=job.running)
+                for name, job in self.jobs.items()
+            },
+        }
@@ -0,0 +1,392 @@
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import sys
+import time
+
+from starlette.concurrency import run_in_threadpool
+
+from .config import PayConfig
+from .entitlements import FeatureMap
+from .etag import content_etag
+from .snapshot import NO_EXPIRY, _aggregate
+from .storage import PayStore
+
+logger = logging.getLogger("viv-pay")
+
+MAX_BODY_BYTES = 64 * 1024
+
+
+def _headers(content_type: bytes, extra=()):
+    return [(b"content-type", content_type), *extra]
+
+
+async def _respond(send, status: int, body: bytes, headers):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [*headers, (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def _error(message: str) -> bytes:
+    return json.dumps({"error": message}).encode()
+
+
+class EntitlementService:
+    """Standalone ASGI app answering "is this user entitled?" for other services.
+
+    Routes:
+
+    - `GET /entitlements/{user_id}` -> `{"user_id", "entitled", "expires_at", "features"}`
+    - `POST /entitlements` with `{"user_ids": [...]}` -> `{"entitlements": [...]}`
+    - `GET /healthz`
+
+    Answers use the same rules as require_subscription (allowed statuses,
+    the entitlement snapshot when given) and the same aggregation
+    as SnapshotWriter (latest period end, OR of feature masks). Each user's
+    answer is cached as encoded JSON with its ETag for `cache_ttl` seconds,
+    so a repeat lookup is a dict hit and batch bodies are joined from the
+    cached bytes; `If-None-Match` with a current ETag gets a 304.
+    Concurrent misses for one user share one query; DB lookups are limited
+    to `max_concurrency` and must finish within `budget` seconds, else the
+    stale answer (if any) or a 503 is returned.
+
+    With `dev`, every user is entitled to every feature, for local runs.
+    It is off unless asked for: unlike the app, this service runs without
+    STRIPE_SECRET_KEY, so a missing key does not imply dev mode here.
+
+    No framework routing or request objects: the hot path is plain ASGI.
+    """
+
+    def __init__(
+        self,
+        store: PayStore,
+        config: PayConfig | None = None,
+        snapshot=None,
+        feature_map: FeatureMap | None = None,
+        max_concurrency: int = 16,
+        dev: bool = False,
+    ):
+        self.store = store
+        self.dev = dev
+        self.config = config = config or PayConfig()
+        self.snapshot = snapshot
+        self.feature_map = feature_map or FeatureMap(config.price_features)
+        self.cache_ttl = config.entitlement_cache_ttl
+        self.cache_size = config.entitlement_cache_size
+        self.budget = config.entitlement_budget
+        self.max_batch = config.entitlement_max_batch
+        self._cache_control = f"private, max-age={int(self.cache_ttl)}".encode()
+        # user_id -> (fresh_until, body, etag)
+        self._cache: dict[int, tuple[float, bytes, bytes]] = {}
+        self._inflight: dict[int, asyncio.Future] = {}
+        self._semaphore: asyncio.Semaphore | None = None
+        self._max_concurrency = max_concurrency
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "timeouts": 0, "not_modified": 0}
+
+    # Resolution
+
+    def _use_snapshot(self) -> bool:
+        return self.snapshot is not None and self.snapshot.available()
+
+    def _entry(self, user_id: int, expiry: int | None, mask: int) -> dict:
+        # Like require_subscription, a past period end alone does not revoke:
+        # the renewal webhook may simply not have arrived yet
+        entitled = expiry is not None
+        return {
+            "user_id": user_id,
+            "entitled": entitled,
+            "expires_at": expiry if entitled and expiry != NO_EXPIRY else None,
+            "features": sorted(self.feature_map.features(mask)) if entitled else [],
+        }
+
+    def resolve(self, user_ids: list[int]) -> dict[int, dict]:
+        """Uncached answers for `user_ids`; one query for the whole list. Blocking."""
+        if self.dev:
+            everything = self.feature_map.all_features
+            return {u: self._entry(u, NO_EXPIRY, everything) for u in user_ids}
+        if self._use_snapshot():
+            found = {u: self.snapshot.lookup(u) for u in user_ids}
+        else:
+            with self.store.session() as db:
+                rows = self.store.iter_entitlement_rows(
+                    db, self.config.allowed_statuses, user_ids=user_ids
+                )
+                found = _aggregate(rows, self.feature_map)
+        return {u: self._entry(u, *(found.get(u) or (None, 0))) for u in user_ids}
+
+    def _store(self, entries: dict[int, dict]) -> dict[int, tuple[bytes, bytes]]:
+        """Encode and cache `entries`; returns {user_id: (body, etag)}."""
+        fresh_until = time.monotonic() + self.cache_ttl
+        cache = self._cache
+        encoded = {}
+        for user_id, entry in entries.items():
+            body = json.dumps(entry, separators=(",", ":")).encode()
+            encoded[user_id] = (body, content_etag(body))
+            if user_id not in cache and len(cache) >= self.cache_size:
+                cache.pop(next(iter(cache)))  # oldest first
+            cache[user_id] = (fresh_until, *encoded[user_id])
+        return encoded
+
+    async def _fetch(self, user_ids: list[int]) -> dict[int, tuple[bytes, bytes]]:
+        if self._use_snapshot() or self.dev:
+            # Memory-only lookups; not worth a thread hop
+            entries = self.resolve(user_ids)
+        else:
+            if self._semaphore is None:
+                self._semaphore = asyncio.Semaphore(self._max_concurrency)
+            async with self._semaphore:
+                entries = await run_in_threadpool(self.resolve, user_ids)
+        return self._store(entries)
+
+    async def lookup(self, user_ids: list[int]) -> dict[int, tuple[bytes, bytes]] | None:
+        """{user_id: (body, etag)}; None if the budget ran out with nothing stale to serve."""
+        now = time.monotonic()
+        result: dict[int, tuple[bytes, bytes]] = {}
+        missing = []
+        waiting = []
+        for user_id in dict.fromkeys(user_ids):
+            cached = self._cache.get(user_id)
+            if cached is not None and cached[0] > now:
+                self.stats["hits"] += 1
+                result[user_id] = cached[1:]
+            elif user_id in self._inflight:
+                waiting.append(user_id)
+            else:
+                missing.append(user_id)
+        if not missing and not waiting:
+            return result
+
+        self.stats["misses"] += len(missing) + len(waiting)
+        future = None
+        if missing:
+            future = asyncio.ensure_future(self._fetch(missing))
+            for user_id in missing:
+                self._inflight[user_id] = future
+            future.add_done_callback(functools.partial(self._clear_inflight, missing))
+        pending = {self._inflight[u] for u in waiting}
+        if future is not None:
+            pending.add(future)
+        try:
+            done = await asyncio.wait_for(
+                asyncio.gather(*(asyncio.shield(f) for f in pending)), self.budget
+            )
+        except Exception as exc:
+            if isinstance(exc, asyncio.TimeoutError):
+                self.stats["timeouts"] += 1
+            else:
+                logger.warning("[viv-pay] Entitlement lookup failed: %s", exc)
+            for user_id in (*missing, *waiting):
+                cached = self._cache.get(user_id)
+                if cached is None:
+                    return None
+                self.stats["stale"] += 1
+                result[user_id] = cached[1:]
+            return result
+        for entries in done:
+            result.update(entries)
+        return result
+
+    def _clear_inflight(self, user_ids, future):
+        for user_id in user_ids:
+            if self._inflight.get(user_id) is future:
+                del self._inflight[user_id]
+
+    # HTTP
+
+    async def _reply(self, scope, send, body: bytes, etag: bytes):
+        headers = _headers(
+            b"application/json", ((b"etag", etag), (b"cache-control", self._cache_control))
+        )
+        for name, value in scope["headers"]:
+            if name == b"if-none-match":
+                if etag in [tag.strip() for tag in value.split(b",")]:
+                    self.stats["not_modified"] += 1
+                    await _respond(send, 304, b"", headers[1:])
+                    return
+                break
+        await _respond(send, 200, body, headers)
+
+    async def _unavailable(self, send):
+        await _respond(
+            send,
+            503,
+            _error("entitlement lookup timed out"),
+            _headers(b"application/json", ((b"retry-after", b"1"),)),
+        )
+
+    async def _read_body(self, receive) -> bytes | None:
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > MAX_BODY_BYTES:
+                return None
+            chunks.append(chunk)
+            if not message.get("more_body"):
+                return b"".join(chunks)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+
+        path = scope["path"]
+        method = scope["method"]
+        json_headers = _headers(b"application/json")
+
+        if path.startswith("/entitlements/") and method == "GET":
+            try:
+                user_id = int(path[14:])
+            except ValueError:
+                await _respond(send, 400, _error("user_id must be an integer"), json_headers)
+                return
+            entries = await self.lookup([user_id])
+            if entries is None:
+                await self._unavailable(send)
+                return
+            await self._reply(scope, send, *entries[user_id])
+        elif path == "/entitlements" and method == "POST":
+            body = await self._read_body(receive)
+            if body is None:
+                await _respond(send, 413, _error("request body too large"), json_headers)
+                return
+            try:
+                user_ids = [int(u) for u in json.loads(body)["user_ids"]]
+            except (ValueError, KeyError, TypeError):
+                await _respond(
+                    send, 400, _error('expected {"user_ids": [int, ...]}'), json_headers
+                )
+                return
+            if len(user_ids) > self.max_batch:
+                message = f"at most {self.max_batch} user_ids per request"
+                await _respond(send, 413, _error(message), json_headers)
+                return
+            entries = await self.lookup(user_ids)
+            if entries is None:
+                await self._unavailable(send)
+                return
+            body = b'{"entitlements":[%s]}' % b",".join(entries[u][0] for u in user_ids)
+            await self._reply(scope, send, body, content_etag(body))
+        elif path == "/healthz":
+            await _respond(send, 200, b'{"status":"ok"}', json_headers)
+        elif path == "/entitlements" or path.startswith("/entitlements/"):
+            await _respond(send, 405, _error("method not allowed"), json_headers)
+        else:
+            await _respond(send, 404, _error("not found"), json_headers)
+
+
+async def bench(app, user_ids: list[int], requests: int) -> dict:
+    """Drive `app` in process (no sockets) with GETs; returns requests/sec.
+
+    Measures the service's own per-request cost on one core, i.e. the
+    ceiling before HTTP server and network overhead.
+    """
+    statuses: dict[int, int] = {}
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            statuses[message["status"]] = statuses.get(message["status"], 0) + 1
+
+    scopes = [
+        {
+            "type": "http",
+            "method": "GET",
+            "path": f"/entitlements/{user_id}",
+            "headers": [],
+        }
+        for user_id in user_ids
+    ]
+    start = time.perf_counter()
+    for i in range(requests):
+        await app(scopes[i % len(scopes)], receive, send)
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": requests,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(requests / elapsed),
+        "statuses": statuses,
+    }
+
+
+def main(argv=None):
+    """CLI — run the entitlement service: python -m viv_pay.service --database-url ...
+
+    Read-only: the viv-pay tables must already exist (init_pay creates them).
+    """
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import declarative_base, sessionmaker
+
+    from .models import create_pay_models
+    from .snapshot import EntitlementSnapshot
+    from .storage import SQLAlchemyStore
+
+    parser = argparse.ArgumentParser(description="Standalone viv-pay entitlement service")
+    parser.add_argument("--database-url", required=True)
+    parser.add_argument("--snapshot", help="Entitlement snapshot file, instead of DB queries")
+    parser.add_argument(
+        "--price-features", default="{}", help='JSON, e.g. {"price_pro": ["export", "api"]}'
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--cache-ttl", type=float, default=PayConfig.entitlement_cache_ttl)
+    parser.add_argument(
+        "--dev", action="store_true", help="Entitle every user to every feature (local runs only)"
+    )
+    parser.add_argument(
+        "--bench", type=int, metavar="N", help="Serve N in-process requests and report req/s"
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    config = PayConfig(
+        price_features={k: set(v) for k, v in json.loads(args.price_features).items()},
+        entitlement_cache_ttl=args.cache_ttl,
+    )
+    engine = create_engine(args.database_url)
+    SessionLocal = sessionmaker(bind=engine)
+    Base = declarative_base()
+    models = create_pay_models(Base)
+
+    def get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    snapshot = None
+    if args.snapshot:
+        snapshot = EntitlementSnapshot(args.snapshot, max_age=config.entitlement_snapshot_max_age)
+    service = EntitlementService(
+        SQLAlchemyStore(get_db, *models), config, snapshot, dev=args.dev
+    )
+
+    if args.bench:
+        print(json.dumps(asyncio.run(bench(service, list(range(1, 1001)), args.bench))))
+        return 0
+
+    import uvicorn
+
+    uvicorn.run(service, host=args.host, port=args.port, log_level="warning")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,408 @@
+import bisect
+import functools
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+from .storage import Entitlement
+
+logger = logging.getLogger("viv-pay")
+
+MAGIC = b"VPSNAP02"
+# magic, count, generation, stamp. The stamp of the base file is the unix
+# time of the full rebuild it descends from; that of the delta file is the
+# generation of the base file it applies to.
+HEADER = struct.Struct("<8sQQq")
+NO_EXPIRY = 2**63 - 1
+# Expiry of a delta entry for a user who is no longer entitled
+REVOKED = -1
+
+
+def _to_arrays(entries: dict[int, tuple[int, int]]):
+    user_ids = sorted(entries)
+    return (
+        array("q", user_ids),
+        array("q", (entries[u][0] for u in user_ids)),
+        array("q", (entries[u][1] for u in user_ids)),
+    )
+
+
+def _decode_arrays(buf):
+    """(generation, stamp, user_ids, expiries, masks) over `buf`, without copying."""
+    if len(buf) < HEADER.size:
+        raise ValueError("truncated entitlement snapshot")
+    magic, count, generation, stamp = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ValueError("not a viv-pay entitlement snapshot (or an older format)")
+    body = memoryview(buf)[HEADER.size:]
+    width = count * 8
+    user_ids = body[:width].cast("q")
+    expiries = body[width : 2 * width].cast("q")
+    masks = body[2 * width : 3 * width].cast("q")
+    return generation, stamp, (user_ids, expiries, masks)
+
+
+def _map(path: Path):
+    """(inode, generation, stamp, arrays) of a snapshot file mapped read-only, or None."""
+    try:
+        with open(path, "rb") as f:
+            inode = os.fstat(f.fileno()).st_ino
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):  # missing, or empty
+        return None
+    try:
+        return inode, *_decode_arrays(mapped)
+    except ValueError as exc:
+        logger.warning("[viv-pay] Ignoring entitlement snapshot %s: %s", path, exc)
+        return None
+
+
+def _find(arrays, user_id: int) -> int | None:
+    user_ids = arrays[0]
+    i = bisect.bisect_left(user_ids, user_id)
+    if i < len(user_ids) and user_ids[i] == user_id:
+        return i
+    return None
+
+
+def _inode(path: Path):
+    try:
+        return os.stat(path).st_ino
+    except FileNotFoundError:
+        return None
+
+
+class EntitlementSnapshot:
+    """Read-only, memory-mapped view of entitled users shared by all workers.
+
+    The base file holds three parallel int64 arrays sorted by user_id: user
+    ids, expiry (unix seconds, NO_EXPIRY when open-ended) and feature mask.
+    A small delta file next to it, in the same format, holds the changes
+    since the base was written and is consulted first. A lookup is a binary
+    search over the mapped pages, which the OS shares between every process
+    on the host. Writers replace files atomically; readers notice a new
+    inode at most every `check_interval` seconds and remap.
+
+    The snapshot is only `available()` while its last full rebuild from the
+    DB is at most `max_age` seconds old. Callers query the DB otherwise, so
+    a host whose rebuilds stopped (or a file left by an earlier deployment)
+    cannot keep serving old answers.
+    """
+
+    def __init__(
+        self,
+        path: str | os.PathLike,
+        check_interval: float = 1.0,
+        max_age: float | None = None,
+    ):
+        self.path = Path(path)
+        self.delta_path = self.path.with_name(self.path.name + ".delta")
+        self.check_interval = check_interval
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._inodes = (None, None)
+        self._checked_at = None
+        # Arrays to search, delta first; swapped as one tuple
+        self._layers: tuple = ()
+        self._maps = ()
+        self.built_at = None
+        self.generation = 0
+
+    def _maybe_remap(self):
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            self._checked_at = now
+            # Delta first: compaction replaces the base before removing the delta
+            if (_inode(self.path), _inode(self.delta_path)) == self._inodes:
+                return
+            delta = _map(self.delta_path)
+            base = _map(self.path)
+            if base is None:
+                self._layers, self._maps, self._inodes = (), (), (None, None)
+                self.built_at = None
+                return
+            base_inode, generation, built_at, base_arrays = base
+            layers, maps = (base_arrays,), (base,)
+            delta_inode = None
+            if delta is not None:
+                delta_inode, delta_generation, applies_to, delta_arrays = delta
+                # A delta on an older base was merged into this one already
+                if applies_to == generation:
+                    layers, maps = (delta_arrays, base_arrays), (delta, base)
+                    generation = delta_generation
+            # Old mappings stay valid for in-flight lookups until collected
+            self._layers, self._maps = layers, maps
+            self._inodes = (base_inode, delta_inode)
+            self.built_at = built_at
+            self.generation = generation
+
+    def available(self) -> bool:
+        """Whether a snapshot is mapped and its last full rebuild is recent enough."""
+        self._maybe_remap()
+        if not self._layers:
+            return False
+        return self.max_age is None or time.time() - self.built_at <= self.max_age
+
+    def __len__(self) -> int:
+        self._maybe_remap()
+        layers = self._layers
+        if not layers:
+            return 0
+        base = layers[-1]
+        count = len(base[0])
+        if len(layers) == 2:
+            delta = layers[0]
+            for user_id, expiry in zip(*delta[:2]):
+                in_base = _find(base, user_id) is not None
+                count += (expiry != REVOKED) - in_base
+        return count
+
+    def lookup(self, user_id: int) -> tuple[int, int] | None:
+        """(expiry, feature_mask) for user_id, or None if not entitled."""
+        self._maybe_remap()
+        for arrays in self._layers:
+            i = _find(arrays, user_id)
+            if i is not None:
+                _, expiries, masks = arrays
+                if expiries[i] == REVOKED:
+                    return None
+                return expiries[i], masks[i]
+        return None
+
+    def entitlement(self, user_id: int) -> Entitlement | None:
+        """The user's entitlement, or None.
+
+        Only status and current_period_end are known here; see Entitlement.
+        Like the DB path, the period end is not checked: a renewal moves it
+        forward only when its webhook arrives, and until then the user is
+        still subscribed.
+        """
+        entry = self.lookup(user_id)
+        if entry is None:
+            return None
+        expiry = entry[0]
+        period_end = None if expiry == NO_EXPIRY else datetime.fromtimestamp(expiry, timezone.utc)
+        return Entitlement(None, None, None, None, "active", None, period_end, None)
+
+
+def _aggregate(rows, feature_map) -> dict[int, tuple[int, int]]:
+    """rows of (user_id, current_period_end, price_id) -> {user_id: (expiry, mask)}."""
+    entries: dict[int, tuple[int, int]] = {}
+    for user_id, period_end, price_id in rows:
+        if period_end is not None and period_end.tzinfo is None:
+            period_end = period_end.replace(tzinfo=timezone.utc)  # SQLite drops tz
+        expiry = int(period_end.timestamp()) if period_end else NO_EXPIRY
+        mask = feature_map.mask_for_prices([price_id]) if feature_map else 0
+        prev = entries.get(user_id)
+        if prev:
+            expiry, mask = max(prev[0], expiry), prev[1] | mask
+        entries[user_id] = (expiry, mask)
+    return entries
+
+
+def _merge(base, delta):
+    """Base arrays with the delta entries applied, as new arrays."""
+    merged = (array("q"), array("q"), array("q"))
+    base_ids, delta_ids = base[0], delta[0]
+    i = j = 0
+    while i < len(base_ids) or j < len(delta_ids):
+        if j == len(delta_ids) or (i < len(base_ids) and base_ids[i] < delta_ids[j]):
+            row = base_ids[i], base[1][i], base[2][i]
+            i += 1
+        else:
+            if i < len(base_ids) and base_ids[i] == delta_ids[j]:
+                i += 1
+            row = delta_ids[j], delta[1][j], delta[2][j]
+            j += 1
+            if row[1] == REVOKED:
+                continue
+        for target, value in zip(merged, row):
+            target.append(value)
+    return merged
+
+
+class SnapshotWriter:
+    """Builds and incrementally updates the snapshot files.
+
+    Writers on different workers serialize on an fcntl lock next to the
+    snapshot (POSIX only; `fcntl` is imported when a writer first locks, so
+    readers and apps without a snapshot import fine elsewhere); every write
+    goes to a temp file that is renamed over the target, so readers never
+    see a partial file. `rebuild()` writes the
+    base from the DB and drops the delta. `refresh_user()` only rewrites
+    the delta, so a webhook costs I/O proportional to the changes since the
+    last rebuild; once the delta exceeds `max_delta` users it is merged
+    into a new base.
+    """
+
+    def __init__(
+        self,
+        path: str | os.PathLike,
+        store,
+        config,
+        feature_map=None,
+        max_delta: int = 1024,
+    ):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.delta_path = self.path.with_name(self.path.name + ".delta")
+        # Exists while a rebuild scans the DB: user ids refreshed meanwhile
+        self.dirty_path = self.path.with_name(self.path.name + ".dirty")
+        self.store = store
+        self.config = config
+        self.feature_map = feature_map
+        self.max_delta = max_delta
+
+    @contextmanager
+    def _locked(self):
+        import fcntl  # POSIX only; readers and apps without a snapshot never need it
+
+        with open(self.path.with_name(self.path.name + ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write(self, path: Path, generation: int, stamp: int, user_ids, expiries, masks):
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(HEADER.pack(MAGIC, len(user_ids), generation, stamp))
+            for arr in (user_ids, expiries, masks):
+                f.write(arr.tobytes())
+        os.replace(tmp, path)
+
+    def _delta(self, base_generation: int):
+        """(generation, arrays) of the delta on the given base; empty if none."""
+        delta = _map(self.delta_path)
+        if delta is not None and delta[2] == base_generation:
+            return delta[1], tuple(array("q", view) for view in delta[3])
+        return base_generation, (array("q"), array("q"), array("q"))
+
+    def built_at(self) -> int | None:
+        """Unix time of the last full rebuild, or None without a readable snapshot."""
+        base = _map(self.path)
+        return None if base is None else base[2]
+
+    def rebuild(self) -> int:
+        """Full rebuild from the store. Returns the number of entitled users.
+
+        The DB scan runs without the lock, so readers and refresh_user()
+        are not held up by it. Users refreshed during the scan are noted in
+        the dirty file and re-read under the lock before the swap, so their
+        changes are not lost with the old delta.
+        """
+        with self._locked():
+            self.dirty_path.write_bytes(b"")
+        with self.store.session() as db:
+            rows = list(self.store.iter_entitlement_rows(db, self.config.allowed_statuses))
+        entries = _aggregate(rows, self.feature_map)
+        with self._locked():
+            dirty = array("q")
+            try:
+                dirty.frombytes(self.dirty_path.read_bytes())
+            except FileNotFoundError:
+                pass
+            if dirty:
+                user_ids = set(dirty)
+                with self.store.session() as db:
+                    rows = self.store.iter_entitlement_rows(
+                        db, self.config.allowed_statuses, user_ids=user_ids
+                    )
+                    fresh = _aggregate(rows, self.feature_map)
+                for user_id in user_ids:
+                    if user_id in fresh:
+                        entries[user_id] = fresh[user_id]
+                    else:
+                        entries.pop(user_id, None)
+            base = _map(self.path)
+            generation = 0 if base is None else self._delta(base[1])[0]
+            self._write(self.path, generation + 1, int(time.time()), *_to_arrays(entries))
+            self.delta_path.unlink(missing_ok=True)
+            self.dirty_path.unlink(missing_ok=True)
+        logger.info("[viv-pay] Entitlement snapshot rebuilt: %d user(s)", len(entries))
+        return len(entries)
+
+    def ensure(self, max_age: float | None = None):
+        """Rebuild unless a readable snapshot exists (rebuilt within `max_age` seconds)."""
+        built_at = self.built_at()
+        if built_at is None or (max_age is not None and time.time() - built_at > max_age):
+            self.rebuild()
+
+    def refresh_user(self, db, user_id: int):
+        """Re-read one user's subscriptions and swap in an updated delta."""
+        rows = self.store.iter_entitlement_rows(db, self.config.allowed_statuses, user_id=user_id)
+        entry = _aggregate(rows, self.feature_map).get(user_id)
+        with self._locked():
+            if self.dirty_path.exists():
+                with open(self.dirty_path, "ab") as dirty:
+                    dirty.write(array("q", (user_id,)).tobytes())
+            base = _map(self.path)
+            if base is None:
+                return  # nothing to patch; the next rebuild reads the DB anyway
+            _, base_generation, built_at, base_arrays = base
+            generation, delta = self._delta(base_generation)
+
+            i = _find(base_arrays, user_id)
+            stored = None if i is None else (base_arrays[1][i], base_arrays[2][i])
+            j = _find(delta, user_id)
+            current = stored if j is None else (delta[1][j], delta[2][j])
+            if current == entry or (entry is None and current[0] == REVOKED):
+                return
+            # The delta only records differences from the base
+            if entry == stored:
+                for arr in delta:
+                    del arr[j]
+            else:
+                row = entry or (REVOKED, 0)
+                if j is None:
+                    j = bisect.bisect_left(delta[0], user_id)
+                    for arr, value in zip(delta, (user_id, *row)):
+                        arr.insert(j, value)
+                else:
+                    delta[1][j], delta[2][j] = row
+
+            if len(delta[0]) > self.max_delta:
+                self._write(
+                    self.path, generation + 1, built_at, *_merge(base_arrays, delta)
+                )
+                self.delta_path.unlink(missing_ok=True)
+            else:
+                self._write(self.delta_path, generation + 1, base_generation, *delta)
+
+    def webhook_handler(self, db, data, event):
+        """Registry handler keeping the snapshot in step with subscription changes."""
+        customer = None
+        if data.get("customer"):
+            customer = self.store.get_customer_by_stripe_id(db, data["customer"])
+        if customer is None:
+            sub_id = data.get("subscription") or data.get("id")
+            sub = self.store.get_subscription(db, sub_id) if sub_id else None
+            if sub is not None:
+                customer = self.store.get_customer_by_id(db, sub.customer_id)
+        if customer is not None:
+            # With a store writer the event's changes are only flushed here;
+            # publishing them before the batch commits could grant access
+            # the database never recorded
+            self.store.after_commit(db, functools.partial(self._refresh_committed, customer.user_id))
+
+    def _refresh_committed(self, user_id: int):
+        with self.store.session() as db:
+            self.refresh_user(db, user_id)
+
+
+SNAPSHOT_EVENT_TYPES = (
+    "checkout.session.completed",
+    "customer.subscription.updated",
+    "customer.subscription.deleted",
+    "invoice.payment_failed",
+)
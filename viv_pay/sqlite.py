@@ -0,0 +1,172 @@
+import contextvars
+import logging
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from sqlalchemy import event
+
+logger = logging.getLogger("viv-pay")
+
+# Session.info key marking the writer's session; store.commit() only flushes on it
+GROUP_COMMIT = "viv_pay.group_commit"
+# Session.info key of the writer session's (context, fn) callbacks, run once
+# the batch has committed; see PayStore.after_commit
+AFTER_COMMIT = "viv_pay.after_commit"
+
+
+def configure_sqlite(engine, busy_timeout: float = 5.0, mmap_size: int = 256 * 1024 * 1024):
+    """Apply the production pragmas to every new connection of a SQLite engine.
+
+    WAL lets readers run alongside the single writer, synchronous=NORMAL
+    only syncs at checkpoints (durable across crashes of the app, not of
+    the OS), and the busy timeout makes a connection wait for the write
+    lock instead of failing with "database is locked". Connections the
+    engine already opened keep their settings, so call this before the
+    first query.
+    """
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout * 1000)}")
+            cursor.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+        finally:
+            cursor.close()
+
+    return set_pragmas
+
+
+class SQLiteWriter:
+    """Runs writes one at a time on a dedicated thread, with group commit.
+
+    SQLite allows one writer, and a transaction that read before writing
+    fails outright (busy timeout or not) if another connection wrote in
+    between. Funnelling writes through one connection removes both the
+    lock waits and those failures. Queued writes are taken up to
+    `max_batch` at a time and share one transaction and one commit; each
+    runs in its own SAVEPOINT, so a write that raises is rolled back alone
+    and its caller gets the exception. Callers are only answered after the
+    commit, so a returned write is durable. Callbacks a write registers
+    with store.after_commit() are handed, in order, to a separate thread
+    once the callers are answered, so slow ones (such as a snapshot
+    refresh) never hold up the queue; those of a write that rolled back
+    are dropped.
+
+    Write functions get the writer's session and must not block on
+    anything but the database: while one runs, every other write waits.
+    """
+
+    def __init__(self, get_db, max_batch: int = 64):
+        self.get_db = get_db
+        self.max_batch = max_batch
+        self.stats = {"writes": 0, "failures": 0, "commits": 0, "max_batch": 0}
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._closed = False
+        self._db = None
+        # One thread, so callbacks run in commit order
+        self._callbacks = ThreadPoolExecutor(1, thread_name_prefix="viv-pay-after-commit")
+        self._thread = threading.Thread(target=self._run, name="viv-pay-sqlite-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, fn) -> Future:
+        """Queue `fn(db)`; the future resolves to its result once committed."""
+        if self._closed:
+            raise RuntimeError("SQLite writer is closed")
+        future = Future()
+        # Run in the caller's context, so spans and log fields carry over
+        self._queue.put((fn, contextvars.copy_context(), future))
+        return future
+
+    def write(self, fn):
+        """Run `fn(db)` on the writer and wait for its commit."""
+        if threading.current_thread() is self._thread:
+            return fn(self._db)  # nested write: already inside the batch
+        return self.submit(fn).result()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stop = False
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self._commit(batch)
+            if stop:
+                return
+
+    def _commit(self, batch):
+        results = []
+        callbacks = []
+        try:
+            db = self._db = next(self.get_db())
+        except Exception as exc:
+            # Fail this batch, not the thread: a dead writer would leave
+            # every later write() waiting forever
+            logger.exception("[viv-pay] SQLite writer could not open a session")
+            db = self._db = None
+            results = [(future, None, exc) for _, _, future in batch]
+        if db is not None:
+            db.info[GROUP_COMMIT] = True
+            db.info[AFTER_COMMIT] = callbacks
+            # Results are handed to other threads after the session is closed
+            db.expire_on_commit = False
+            try:
+                for fn, context, future in batch:
+                    registered = len(callbacks)
+                    try:
+                        with db.begin_nested():
+                            results.append((future, context.run(fn, db), None))
+                    except Exception as exc:
+                        del callbacks[registered:]  # rolled back with the write
+                        results.append((future, None, exc))
+                db.commit()
+            except Exception as exc:
+                logger.exception("[viv-pay] SQLite group commit of %d write(s) failed", len(batch))
+                db.rollback()
+                callbacks.clear()
+                results = [(future, None, error or exc) for future, _, error in results]
+                results += [(future, None, exc) for _, _, future in batch[len(results):]]
+            finally:
+                self._db = None
+                db.close()
+
+        stats = self.stats
+        stats["commits"] += 1
+        stats["writes"] += len(batch)
+        stats["max_batch"] = max(stats["max_batch"], len(batch))
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                stats["failures"] += 1
+                future.set_exception(error)
+        for context, callback in callbacks:
+            self._callbacks.submit(self._run_callback, context, callback)
+
+    @staticmethod
+    def _run_callback(context, callback):
+        try:
+            context.run(callback)
+        except Exception:
+            logger.exception("[viv-pay] After-commit callback failed")
+
+    def close(self):
+        """Commit the writes already queued, run their callbacks and stop the threads."""
+        self._closed = True
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._callbacks.shutdown(wait=True)
@@ -0,0 +1,730 @@
+import contextvars
+import itertools
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from sqlalchemy import update
+from sqlalchemy.orm.attributes import set_committed_value
+
+from .models import utcnow
+from .sqlite import AFTER_COMMIT, GROUP_COMMIT
+from .upsert import insert_ignore, insert_ignore_many, insert_or_get
+
+MAX_VERSION_RETRIES = 5
+
+
+class ConcurrentUpdateError(Exception):
+    """A conditional update kept losing to concurrent writers."""
+
+
+class PayStore(ABC):
+    """Repository interface for viv-pay's customers, subscriptions and payments.
+
+    Every method takes the handle yielded by `session()` as its first
+    argument. Write methods stage changes on that handle; `commit(db)` makes
+    them durable. Records expose the same attributes as the ORM models.
+
+    Abstract methods are what a backend must implement; the others have
+    defaults built on them, which backends may override with faster ones.
+    """
+
+    # SQLiteWriter that serializes this store's writes, if any
+    writer = None
+
+    @abstractmethod
+    def session(self):
+        ...
+
+    @abstractmethod
+    def commit(self, db):
+        ...
+
+    def write(self, db, fn):
+        """Run the unit of work `fn(db)`, which commits with `commit()` as usual.
+
+        With a writer, `fn` runs on the writer's session instead of `db` and
+        is committed together with other queued writes.
+        """
+        if self.writer is not None:
+            return self.writer.write(fn)
+        return fn(db)
+
+    def after_commit(self, db, fn):
+        """Run `fn()` once the work done on `db` so far is committed.
+
+        Call it after `commit()`. That is right away, except on a writer's
+        session, where the batch commits later: `fn` then runs after that
+        commit and not at all if the write is rolled back.
+        """
+        fn()
+
+    # Customers
+    @abstractmethod
+    def get_customer(self, db, user_id: int):
+        ...
+
+    @abstractmethod
+    def get_customer_by_stripe_id(self, db, stripe_customer_id: str):
+        ...
+
+    @abstractmethod
+    def get_customer_by_id(self, db, customer_id: int):
+        ...
+
+    @abstractmethod
+    def add_customer(self, db, user_id: int, email: str, stripe_customer_id: str):
+        ...
+
+    def get_or_add_customer(self, db, user_id: int, email: str, stripe_customer_id: str):
+        """The user's customer, adding this one if they have none.
+
+        Concurrent calls for a new user all get the same row, where
+        add_customer would fail for all but one.
+        """
+        customer = self.get_customer(db, user_id)
+        return customer or self.add_customer(db, user_id, email, stripe_customer_id)
+
+    @abstractmethod
+    def get_customer_user_ids(self, db, user_ids) -> set[int]:
+        """The subset of `user_ids` that already have a customer."""
+
+    @abstractmethod
+    def add_customers(self, db, rows: list[dict]) -> int:
+        """Bulk insert of {user_id, email, stripe_customer_id} dicts.
+
+        Rows for users that already have a customer (e.g. from a concurrent
+        first checkout) are skipped. Returns the number of rows inserted.
+        """
+
+    def remember_customer(self, customer):
+        """Hint that `customer` is committed; stores with an id cache keep it."""
+
+    def warm_customer_cache(self, chunk_size: int = 10000) -> int:
+        """Preload the id cache, if any. Returns the number of entries loaded."""
+        return 0
+
+    # Subscriptions
+    @abstractmethod
+    def get_subscription(self, db, stripe_subscription_id: str):
+        ...
+
+    @abstractmethod
+    def get_active_subscription(self, db, user_id: int, statuses):
+        """The user's first subscription whose status is in `statuses`, or None."""
+
+    def get_entitlement(self, db, user_id: int, statuses) -> "Entitlement | None":
+        """Like get_active_subscription, as an immutable Entitlement value."""
+        sub = self.get_active_subscription(db, user_id, statuses)
+        return Entitlement.from_subscription(sub) if sub is not None else None
+
+    @abstractmethod
+    def get_active_price_ids(self, db, user_id: int, statuses) -> list[str]:
+        """Price ids of all the user's subscriptions whose status is in `statuses`."""
+
+    @abstractmethod
+    def iter_entitlement_rows(self, db, statuses, user_id: int | None = None, user_ids=None):
+        """(user_id, current_period_end, stripe_price_id) per qualifying subscription.
+
+        Limited to one user with `user_id`, or to a collection of `user_ids`.
+        """
+
+    @abstractmethod
+    def add_subscription(
+        self, db, customer_id: int, stripe_subscription_id: str, stripe_price_id: str, status: str
+    ):
+        ...
+
+    def add_subscription_if_new(
+        self, db, customer_id: int, stripe_subscription_id: str, stripe_price_id: str, status: str
+    ) -> bool:
+        """Add the subscription unless its Stripe id is stored. Returns whether it was added."""
+        if self.get_subscription(db, stripe_subscription_id) is not None:
+            return False
+        self.add_subscription(db, customer_id, stripe_subscription_id, stripe_price_id, status)
+        return True
+
+    @abstractmethod
+    def update_subscription(self, db, sub, event_at: int | None = None, **fields) -> bool:
+        """Conditionally write `fields` to `sub`.
+
+        The write only lands if the row's version is still the one `sub` was
+        read at; on conflict the row is re-read and the write retried, up to
+        MAX_VERSION_RETRIES times (then ConcurrentUpdateError). With
+        `event_at` (the Stripe event's `created`), the update is skipped and
+        False returned if a newer event was already applied.
+        """
+
+    # Payments
+    @abstractmethod
+    def get_payment_by_session(self, db, stripe_session_id: str):
+        ...
+
+    @abstractmethod
+    def get_payment_by_intent(self, db, stripe_payment_intent_id: str):
+        ...
+
+    @abstractmethod
+    def add_payment(self, db, **fields):
+        ...
+
+    def add_payment_if_new(self, db, **fields) -> bool:
+        """Add the payment unless its `stripe_session_id` is stored. Returns whether it was added."""
+        session_id = fields.get("stripe_session_id")
+        if session_id and self.get_payment_by_session(db, session_id) is not None:
+            return False
+        self.add_payment(db, **fields)
+        return True
+
+    @abstractmethod
+    def update_payment(self, db, payment, **fields):
+        ...
+
+    def update_payment_by_intent(self, db, stripe_payment_intent_id: str, **fields) -> bool:
+        """Write `fields` to the payment with this intent id. False if there is none."""
+        payment = self.get_payment_by_intent(db, stripe_payment_intent_id)
+        if payment is None:
+            return False
+        self.update_payment(db, payment, **fields)
+        return True
+
+
+class SQLAlchemyStore(PayStore):
+    """PayStore over the ORM models from create_pay_models and the app's get_db.
+
+    With a `customer_cache` (CustomerIdCache), customer lookups by user id,
+    Stripe id or row id are answered from memory once a customer has been
+    seen, and return CachedCustomer objects instead of ORM rows. With a
+    `tracer`, commits are traced as "db.commit" spans. With a `writer`
+    (SQLiteWriter), `write()` units of work run on the writer thread.
+    """
+
+    def __init__(
+        self,
+        get_db,
+        StripeCustomer,
+        Subscription,
+        Payment,
+        customer_cache=None,
+        tracer=None,
+        writer=None,
+    ):
+        self.get_db = get_db
+        self.StripeCustomer = StripeCustomer
+        self.Subscription = Subscription
+        self.Payment = Payment
+        self.customer_cache = customer_cache
+        self.tracer = tracer
+        self.writer = writer
+
+    @contextmanager
+    def session(self):
+        db = next(self.get_db())
+        try:
+            yield db
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def commit(self, db):
+        if db.info.get(GROUP_COMMIT):
+            db.flush()  # the writer commits the whole batch
+            return
+        with self.tracer.span("db.commit", phase="db.commit") if self.tracer else nullcontext():
+            db.commit()
+
+    def after_commit(self, db, fn):
+        callbacks = db.info.get(AFTER_COMMIT)
+        if callbacks is None:
+            fn()
+            return
+        # Keep the write's context, so spans and log fields carry over
+        callbacks.append((contextvars.copy_context(), fn))
+
+    def _cached_lookup(self, lookup: str, key, query):
+        cache = self.customer_cache
+        if cache is None:
+            return query()
+        cached = getattr(cache, lookup)(key)
+        if cached is not None:
+            return cached
+        customer = query()
+        if customer is not None:
+            cache.remember(customer)
+        return customer
+
+    def get_customer(self, db, user_id):
+        return self._cached_lookup(
+            "by_user_id",
+            user_id,
+            lambda: db.query(self.StripeCustomer)
+            .filter(self.StripeCustomer.user_id == user_id)
+            .first(),
+        )
+
+    def get_customer_by_stripe_id(self, db, stripe_customer_id):
+        return self._cached_lookup(
+            "by_stripe_id",
+            stripe_customer_id,
+            lambda: db.query(self.StripeCustomer)
+            .filter(self.StripeCustomer.stripe_customer_id == stripe_customer_id)
+            .first(),
+        )
+
+    def get_customer_by_id(self, db, customer_id):
+        return self._cached_lookup(
+            "by_id",
+            customer_id,
+            lambda: db.get(self.StripeCustomer, customer_id),
+        )
+
+    def remember_customer(self, customer):
+        if self.customer_cache is not None:
+            self.customer_cache.remember(customer)
+
+    def warm_customer_cache(self, chunk_size=10000):
+        cache = self.customer_cache
+        if cache is None:
+            return 0
+        StripeCustomer = self.StripeCustomer
+        loaded = 0
+        last_id = 0
+        with self.session() as db:
+            # Keyset pagination: each chunk is an index range scan
+            while not cache.full:
+                rows = (
+                    db.query(
+                        StripeCustomer.id,
+                        StripeCustomer.user_id,
+                        StripeCustomer.stripe_customer_id,
+                        StripeCustomer.email,
+                    )
+                    .filter(StripeCustomer.id > last_id)
+                    .order_by(StripeCustomer.id)
+                    .limit(min(chunk_size, cache.max_entries - len(cache)))
+                    .all()
+                )
+                if not rows:
+                    break
+                for row in rows:
+                    cache.put(*row)
+                loaded += len(rows)
+                last_id = rows[-1][0]
+        return loaded
+
+    def add_customer(self, db, user_id, email, stripe_customer_id):
+        customer = self.StripeCustomer(
+            user_id=user_id,
+            email=email,
+            stripe_customer_id=stripe_customer_id,
+        )
+        db.add(customer)
+        db.flush()
+        return customer
+
+    def get_or_add_customer(self, db, user_id, email, stripe_customer_id):
+        values = {"user_id": user_id, "email": email, "stripe_customer_id": stripe_customer_id}
+        return insert_or_get(db, self.StripeCustomer, values, "user_id")
+
+    def get_customer_user_ids(self, db, user_ids):
+        rows = (
+            db.query(self.StripeCustomer.user_id)
+            .filter(self.StripeCustomer.user_id.in_(list(user_ids)))
+            .all()
+        )
+        return {row[0] for row in rows}
+
+    def add_customers(self, db, rows):
+        return insert_ignore_many(db, self.StripeCustomer, rows, "user_id")
+
+    def get_subscription(self, db, stripe_subscription_id):
+        return (
+            db.query(self.Subscription)
+            .filter(self.Subscription.stripe_subscription_id == stripe_subscription_id)
+            .first()
+        )
+
+    def get_active_subscription(self, db, user_id, statuses):
+        # One round trip instead of customer lookup + subscription lookup
+        return (
+            db.query(self.Subscription)
+            .join(self.StripeCustomer, self.Subscription.customer_id == self.StripeCustomer.id)
+            .filter(
+                self.StripeCustomer.user_id == user_id,
+                self.Subscription.status.in_(statuses),
+            )
+            .first()
+        )
+
+    def get_entitlement(self, db, user_id, statuses):
+        # Plain column tuple: no identity map, no instrumented instance
+        row = (
+            db.query(*(getattr(self.Subscription, name) for name in Entitlement.__slots__))
+            .join(self.StripeCustomer, self.Subscription.customer_id == self.StripeCustomer.id)
+            .filter(
+                self.StripeCustomer.user_id == user_id,
+                self.Subscription.status.in_(statuses),
+            )
+            .first()
+        )
+        return Entitlement(*row) if row is not None else None
+
+    def get_active_price_ids(self, db, user_id, statuses):
+        rows = (
+            db.query(self.Subscription.stripe_price_id)
+            .join(self.StripeCustomer, self.Subscription.customer_id == self.StripeCustomer.id)
+            .filter(
+                self.StripeCustomer.user_id == user_id,
+                self.Subscription.status.in_(statuses),
+            )
+            .all()
+        )
+        return [row[0] for row in rows]
+
+    def iter_entitlement_rows(self, db, statuses, user_id=None, user_ids=None):
+        query = (
+            db.query(
+                self.StripeCustomer.user_id,
+                self.Subscription.current_period_end,
+                self.Subscription.stripe_price_id,
+            )
+            .join(self.StripeCustomer, self.Subscription.customer_id == self.StripeCustomer.id)
+            .filter(self.Subscription.status.in_(statuses))
+        )
+        if user_id is not None:
+            query = query.filter(self.StripeCustomer.user_id == user_id)
+        if user_ids is not None:
+            query = query.filter(self.StripeCustomer.user_id.in_(list(user_ids)))
+        return (tuple(row) for row in query.yield_per(1000))
+
+    def add_subscription(self, db, customer_id, stripe_subscription_id, stripe_price_id, status):
+        sub = self.Subscription(
+            customer_id=customer_id,
+            stripe_subscription_id=stripe_subscription_id,
+            stripe_price_id=stripe_price_id,
+            status=status,
+        )
+        db.add(sub)
+        return sub
+
+    def add_subscription_if_new(
+        self, db, customer_id, stripe_subscription_id, stripe_price_id, status
+    ):
+        values = {
+            "customer_id": customer_id,
+            "stripe_subscription_id": stripe_subscription_id,
+            "stripe_price_id": stripe_price_id,
+            "status": status,
+        }
+        return insert_ignore(db, self.Subscription, values, "stripe_subscription_id")
+
+    def update_subscription(self, db, sub, event_at=None, **fields):
+        Subscription = self.Subscription
+        if sub.id is None or sub.version is None:
+            db.flush()  # new row: get its id and initial version
+        for _ in range(MAX_VERSION_RETRIES):
+            if event_at is not None and sub.last_event_at is not None and event_at < sub.last_event_at:
+                return False
+            values = dict(fields, version=sub.version + 1, updated_at=utcnow())
+            if event_at is not None:
+                values["last_event_at"] = event_at
+            result = db.execute(
+                update(Subscription)
+                .where(Subscription.id == sub.id, Subscription.version == sub.version)
+                .values(**values)
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount == 1:
+                # Mirror the write on the loaded object without dirtying it
+                for name, value in values.items():
+                    set_committed_value(sub, name, value)
+                return True
+            db.refresh(sub)  # lost the race; re-read and re-check
+        raise ConcurrentUpdateError(f"subscription {sub.stripe_subscription_id}")
+
+    def get_payment_by_session(self, db, stripe_session_id):
+        return (
+            db.query(self.Payment)
+            .filter(self.Payment.stripe_session_id == stripe_session_id)
+            .first()
+        )
+
+    def get_payment_by_intent(self, db, stripe_payment_intent_id):
+        return (
+            db.query(self.Payment)
+            .filter(self.Payment.stripe_payment_intent_id == stripe_payment_intent_id)
+            .first()
+        )
+
+    def add_payment(self, db, **fields):
+        payment = self.Payment(**fields)
+        db.add(payment)
+        return payment
+
+    def add_payment_if_new(self, db, **fields):
+        if not fields.get("stripe_session_id"):
+            self.add_payment(db, **fields)
+            return True
+        return insert_ignore(db, self.Payment, fields, "stripe_session_id")
+
+    def update_payment(self, db, payment, **fields):
+        for name, value in fields.items():
+            setattr(payment, name, value)
+        return payment
+
+    def update_payment_by_intent(self, db, stripe_payment_intent_id, **fields):
+        Payment = self.Payment
+        result = db.execute(
+            update(Payment)
+            .where(Payment.stripe_payment_intent_id == stripe_payment_intent_id)
+            .values(**fields)
+            .execution_options(synchronize_session=False)
+        )
+        return result.rowcount == 1
+
+
+@dataclass(frozen=True)
+class Entitlement:
+    """Immutable view of an active subscription, as returned by require_subscription.
+
+    Has the attributes handlers read from Subscription rows, without ORM
+    state, so instances can be cached and shared between threads. Answered
+    from the entitlement snapshot, only status and current_period_end are
+    known; the ids are None.
+    """
+
+    # Spelled out rather than slots=True, which on Python 3.11 turns setting
+    # an unknown attribute into a TypeError instead of FrozenInstanceError
+    __slots__ = (
+        "id",
+        "customer_id",
+        "stripe_subscription_id",
+        "stripe_price_id",
+        "status",
+        "current_period_start",
+        "current_period_end",
+        "cancel_at",
+    )
+
+    id: int | None
+    customer_id: int | None
+    stripe_subscription_id: str | None
+    stripe_price_id: str | None
+    status: str
+    current_period_start: datetime | None
+    current_period_end: datetime | None
+    cancel_at: datetime | None
+
+    @classmethod
+    def from_subscription(cls, sub) -> "Entitlement":
+        return cls(*(getattr(sub, name) for name in cls.__slots__))
+
+
+@dataclass
+class CustomerRecord:
+    id: int
+    user_id: int
+    email: str
+    stripe_customer_id: str
+    created_at: object = field(default_factory=utcnow)
+
+
+@dataclass
+class SubscriptionRecord:
+    id: int
+    customer_id: int
+    stripe_subscription_id: str
+    stripe_price_id: str
+    status: str = "incomplete"
+    current_period_start: object = None
+    current_period_end: object = None
+    cancel_at: object = None
+    version: int = 1
+    last_event_at: int | None = None
+    created_at: object = field(default_factory=utcnow)
+    updated_at: object = field(default_factory=utcnow)
+
+
+@dataclass
+class PaymentRecord:
+    id: int
+    customer_id: int
+    amount_cents: int
+    stripe_session_id: str | None = None
+    stripe_payment_intent_id: str | None = None
+    currency: str = "usd"
+    status: str = "pending"
+    mode: str = "payment"
+    created_at: object = field(default_factory=utcnow)
+
+
+class MemoryStore(PayStore):
+    """In-process PayStore for tests and dev runs.
+
+    Plain dict indexes: each write is a single dict/attribute assignment
+    (atomic under the GIL), ids come from itertools.count, and uniqueness is
+    enforced with dict.setdefault. The one lock makes a subscription's
+    version check and write a single step. Writes are visible immediately;
+    commit() is a no-op and nothing is persisted.
+    """
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+        self.customers_by_user: dict[int, CustomerRecord] = {}
+        self.customers_by_stripe_id: dict[str, CustomerRecord] = {}
+        self.customers_by_id: dict[int, CustomerRecord] = {}
+        self.subscriptions: dict[str, SubscriptionRecord] = {}
+        self.subscriptions_by_customer: dict[int, list[SubscriptionRecord]] = {}
+        self.payments: dict[int, PaymentRecord] = {}
+        self.payments_by_session: dict[str, PaymentRecord] = {}
+        self.payments_by_intent: dict[str, PaymentRecord] = {}
+        self._version_lock = threading.Lock()
+
+    def session(self):
+        return nullcontext()
+
+    def commit(self, db):
+        pass
+
+    def get_customer(self, db, user_id):
+        return self.customers_by_user.get(user_id)
+
+    def get_customer_by_stripe_id(self, db, stripe_customer_id):
+        return self.customers_by_stripe_id.get(stripe_customer_id)
+
+    def get_customer_by_id(self, db, customer_id):
+        return self.customers_by_id.get(customer_id)
+
+    def _put_customer(self, customer: CustomerRecord) -> CustomerRecord:
+        """Index `customer` unless its user has one; returns the user's customer."""
+        existing = self.customers_by_user.setdefault(customer.user_id, customer)
+        if existing is customer:
+            self.customers_by_stripe_id[customer.stripe_customer_id] = customer
+            self.customers_by_id[customer.id] = customer
+        return existing
+
+    def add_customer(self, db, user_id, email, stripe_customer_id):
+        customer = CustomerRecord(next(self._ids), user_id, email, stripe_customer_id)
+        if self._put_customer(customer) is not customer:
+            raise ValueError(f"customer for user {user_id} already exists")
+        return customer
+
+    def get_or_add_customer(self, db, user_id, email, stripe_customer_id):
+        return self._put_customer(
+            CustomerRecord(next(self._ids), user_id, email, stripe_customer_id)
+        )
+
+    def get_customer_user_ids(self, db, user_ids):
+        return {user_id for user_id in user_ids if user_id in self.customers_by_user}
+
+    def add_customers(self, db, rows):
+        added = 0
+        for row in rows:
+            customer = CustomerRecord(
+                next(self._ids), row["user_id"], row["email"], row["stripe_customer_id"]
+            )
+            added += self._put_customer(customer) is customer
+        return added
+
+    def get_subscription(self, db, stripe_subscription_id):
+        return self.subscriptions.get(stripe_subscription_id)
+
+    def get_active_subscription(self, db, user_id, statuses):
+        customer = self.customers_by_user.get(user_id)
+        if customer is None:
+            return None
+        for sub in self.subscriptions_by_customer.get(customer.id, ()):
+            if sub.status in statuses:
+                return sub
+        return None
+
+    def get_active_price_ids(self, db, user_id, statuses):
+        customer = self.customers_by_user.get(user_id)
+        if customer is None:
+            return []
+        return [
+            sub.stripe_price_id
+            for sub in self.subscriptions_by_customer.get(customer.id, ())
+            if sub.status in statuses
+        ]
+
+    def iter_entitlement_rows(self, db, statuses, user_id=None, user_ids=None):
+        if user_id is not None:
+            user_ids = [user_id]
+        if user_ids is not None:
+            found = (self.customers_by_user.get(u) for u in user_ids)
+            customers = [customer for customer in found if customer]
+        else:
+            customers = list(self.customers_by_user.values())
+        for customer in customers:
+            for sub in self.subscriptions_by_customer.get(customer.id, ()):
+                if sub.status in statuses:
+                    yield customer.user_id, sub.current_period_end, sub.stripe_price_id
+
+    def add_subscription(self, db, customer_id, stripe_subscription_id, stripe_price_id, status):
+        sub = SubscriptionRecord(
+            next(self._ids), customer_id, stripe_subscription_id, stripe_price_id, status
+        )
+        if self.subscriptions.setdefault(stripe_subscription_id, sub) is not sub:
+            raise ValueError(f"subscription {stripe_subscription_id} already exists")
+        self.subscriptions_by_customer.setdefault(customer_id, []).append(sub)
+        return sub
+
+    def add_subscription_if_new(
+        self, db, customer_id, stripe_subscription_id, stripe_price_id, status
+    ):
+        try:
+            self.add_subscription(db, customer_id, stripe_subscription_id, stripe_price_id, status)
+        except ValueError:
+            return False
+        return True
+
+    def update_subscription(self, db, sub, event_at=None, **fields):
+        # Records are shared, so `sub` is always the current version
+        with self._version_lock:
+            if event_at is not None and sub.last_event_at is not None and event_at < sub.last_event_at:
+                return False
+            fields.setdefault("updated_at", utcnow())
+            if event_at is not None:
+                fields["last_event_at"] = event_at
+            for name, value in fields.items():
+                setattr(sub, name, value)
+            sub.version += 1
+        return True
+
+    def get_payment_by_session(self, db, stripe_session_id):
+        return self.payments_by_session.get(stripe_session_id)
+
+    def get_payment_by_intent(self, db, stripe_payment_intent_id):
+        return self.payments_by_intent.get(stripe_payment_intent_id)
+
+    def add_payment(self, db, **fields):
+        payment = PaymentRecord(id=next(self._ids), **fields)
+        # Both ids are unique columns in SQL; check both before indexing either
+        session_id, intent_id = payment.stripe_session_id, payment.stripe_payment_intent_id
+        if session_id and session_id in self.payments_by_session:
+            raise ValueError(f"payment for session {session_id} already exists")
+        if intent_id and intent_id in self.payments_by_intent:
+            raise ValueError(f"payment for intent {intent_id} already exists")
+        if session_id:
+            self.payments_by_session[session_id] = payment
+        if intent_id:
+            self.payments_by_intent[intent_id] = payment
+        self.payments[payment.id] = payment
+        return payment
+
+    def add_payment_if_new(self, db, **fields):
+        try:
+            self.add_payment(db, **fields)
+        except ValueError:
+            return False
+        return True
+
+    def update_payment(self, db, payment, **fields):
+        for name, value in fields.items():
+            setattr(payment, name, value)
+        return payment
@@ -0,0 +1,366 @@
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+from .storage import PayStore
+
+STORM_USER_ID_OFFSET = 900_000_000
+PRICE_ID = "price_storm_monthly"
+
+
+def sign_payload(payload: bytes, secret: str, timestamp: int | None = None) -> str:
+    """Stripe-Signature header value (`t=...,v1=...`) for `payload`."""
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signed = f"{timestamp}.".encode() + payload
+    digest = hmac.new(secret.encode(), signed, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={digest}"
+
+
+def _event(event_id: str, event_type: str, created: int, obj: dict) -> dict:
+    return {
+        "id": event_id,
+        "object": "event",
+        "type": event_type,
+        "created": created,
+        "livemode": False,
+        "data": {"object": obj},
+    }
+
+
+def generate_events(customers: int, seed: int = 0, start: int | None = None):
+    """Synthesize per-customer Stripe event sequences.
+
+    Customer n is `cus_storm_<n>`. Most customers subscribe (checkout,
+    activation, then possibly a failed payment with or without recovery,
+    and a cancellation); the rest make a one-off payment that may be
+    refunded. Events of one customer have increasing `created` times.
+
+    Returns (sequences, expected): one event list per customer and the
+    final state each customer should reach, keyed by Stripe customer id.
+    """
+    rng = random.Random(seed)
+    start = int(time.time()) - 3600 if start is None else start
+    sequences = []
+    expected = {}
+    for n in range(customers):
+        cus = f"cus_storm_{n}"
+        session_id = f"cs_storm_{n}"
+        created = start
+        events = []
+
+        def add(event_type, obj):
+            nonlocal created
+            created += 1
+            events.append(_event(f"evt_storm_{n}_{len(events)}", event_type, created, obj))
+
+        if rng.random() < 0.8:
+            sub_id = f"sub_storm_{n}"
+            add("checkout.session.completed", {
+                "id": session_id,
+                "object": "checkout.session",
+                "customer": cus,
+                "mode": "subscription",
+                "subscription": sub_id,
+                "amount_total": 1900,
+                "currency": "usd",
+                "metadata": {"user_id": str(STORM_USER_ID_OFFSET + n), "price_id": PRICE_ID},
+            })
+
+            def subscription(status):
+                return {
+                    "id": sub_id,
+                    "object": "subscription",
+                    "customer": cus,
+                    "status": status,
+                    "items": {"data": [{"price": {"id": PRICE_ID}}]},
+                    "current_period_start": start,
+                    "current_period_end": start + 30 * 86400,
+                    "cancel_at": None,
+                }
+
+            add("customer.subscription.updated", subscription("active"))
+            status = "active"
+            if rng.random() < 0.3:
+                add("invoice.payment_failed", {
+                    "id": f"in_storm_{n}",
+                    "object": "invoice",
+                    "customer": cus,
+                    "subscription": sub_id,
+                })
+                status = "past_due"
+                if rng.random() < 0.5:
+                    add("customer.subscription.updated", subscription("active"))
+                    status = "active"
+            if rng.random() < 0.2:
+                add("customer.subscription.deleted", subscription("canceled"))
+                status = "canceled"
+            expected[cus] = {
+                "session": session_id,
+                "payment": "completed",
+                "subscription": sub_id,
+                "status": status,
+            }
+        else:
+            intent = f"pi_storm_{n}"
+            add("checkout.session.completed", {
+                "id": session_id,
+                "object": "checkout.session",
+                "customer": cus,
+                "mode": "payment",
+                "payment_intent": intent,
+                "amount_total": 4900,
+                "currency": "usd",
+                "metadata": {"user_id": str(STORM_USER_ID_OFFSET + n), "price_id": PRICE_ID},
+            })
+            payment = "completed"
+            if rng.random() < 0.25:
+                add("charge.refunded", {
+                    "id": f"ch_storm_{n}",
+                    "object": "charge",
+                    "customer": cus,
+                    "payment_intent": intent,
+                })
+                payment = "refunded"
+            expected[cus] = {"session": session_id, "payment": payment}
+        sequences.append(events)
+    return sequences, expected
+
+
+def interleave(sequences: list[list[dict]]) -> list[dict]:
+    """Round-robin by step: every customer's first event, then every second, ...
+
+    Consecutive events of one customer are as far apart in the stream as
+    possible, as with real traffic spread over many customers.
+    """
+    stream = []
+    step = 0
+    while True:
+        batch = [events[step] for events in sequences if step < len(events)]
+        if not batch:
+            return stream
+        stream.extend(batch)
+        step += 1
+
+
+def seed_customers(store: PayStore, customers: int) -> int:
+    """Create the `cus_storm_<n>` customers the events refer to. Returns rows added."""
+    users = {STORM_USER_ID_OFFSET + n: n for n in range(customers)}
+    with store.session() as db:
+        existing = store.get_customer_user_ids(db, users)
+        rows = [
+            {
+                "user_id": user_id,
+                "email": f"storm{n}@example.com",
+                "stripe_customer_id": f"cus_storm_{n}",
+            }
+            for user_id, n in users.items()
+            if user_id not in existing
+        ]
+        store.add_customers(db, rows)
+        store.commit(db)
+    return len(rows)
+
+
+def check_consistency(store: PayStore, expected: dict, max_examples: int = 10) -> dict:
+    """Compare subscription and payment rows against the expected final states."""
+    mismatches = 0
+    examples = []
+    with store.session() as db:
+        for cus, want in expected.items():
+            got = {}
+            payment = store.get_payment_by_session(db, want["session"])
+            got["payment"] = payment.status if payment else None
+            if "subscription" in want:
+                sub = store.get_subscription(db, want["subscription"])
+                got["status"] = sub.status if sub else None
+            wanted = {key: want[key] for key in got}
+            if got != wanted:
+                mismatches += 1
+                if len(examples) < max_examples:
+                    examples.append({"customer": cus, "expected": wanted, "actual": got})
+    return {"checked": len(expected), "mismatches": mismatches, "examples": examples}
+
+
+def percentile(sorted_values: list[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+async def run_storm(
+    events: list[dict],
+    rate: float,
+    app=None,
+    url: str | None = None,
+    arrival: str = "uniform",
+    secret: str | None = None,
+    webhook_path: str = "/pay/webhook",
+    timeout: float = 30.0,
+    seed: int = 0,
+) -> dict:
+    """POST `events` to the webhook endpoint at `rate` events/sec, open loop.
+
+    Sends are scheduled by the arrival process ("uniform" spacing or
+    "poisson" with exponential gaps) whether or not earlier requests have
+    finished, so a slow server builds up a backlog the way Stripe traffic
+    would. Targets `app` in process (ASGI) or a running server at `url`.
+    Requires httpx.
+    """
+    import httpx
+
+    if app is not None:
+        transport = httpx.ASGITransport(app=app)
+        client = httpx.AsyncClient(transport=transport, base_url="http://storm")
+    else:
+        client = httpx.AsyncClient(base_url=url)
+
+    rng = random.Random(seed)
+    latencies: list[float] = []
+    statuses: dict[int, int] = {}
+    errors: dict[str, int] = {}
+
+    async def send(event):
+        payload = json.dumps(event).encode()
+        headers = {"content-type": "application/json"}
+        if secret:
+            headers["stripe-signature"] = sign_payload(payload, secret)
+        start = time.perf_counter()
+        try:
+            resp = await client.post(
+                webhook_path, content=payload, headers=headers, timeout=timeout
+            )
+        except Exception as exc:
+            errors[type(exc).__name__] = errors.get(type(exc).__name__, 0) + 1
+            return
+        latencies.append(time.perf_counter() - start)
+        statuses[resp.status_code] = statuses.get(resp.status_code, 0) + 1
+
+    tasks = []
+    async with client:
+        begin = time.perf_counter()
+        due = 0.0
+        for event in events:
+            delay = begin + due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(send(event)))
+            due += rng.expovariate(rate) if arrival == "poisson" else 1.0 / rate
+        send_seconds = time.perf_counter() - begin
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - begin
+
+    latencies.sort()
+    sent = len(events)
+    ok = sum(count for status, count in statuses.items() if 200 <= status < 300)
+    return {
+        "sent": sent,
+        "target_rate": rate,
+        "offered_rate": round(sent / send_seconds, 1) if send_seconds else None,
+        "completed_rate": round(sent / elapsed, 1) if elapsed else None,
+        "duration_seconds": round(elapsed, 2),
+        "statuses": dict(sorted(statuses.items())),
+        "transport_errors": errors,
+        # Anything but 2xx makes Stripe redeliver the event later
+        "error_rate": round((sent - ok) / sent, 4) if sent else 0.0,
+        "latency_ms": {
+            name: round(percentile(latencies, pct) * 1000, 1)
+            for name, pct in (("p50", 50), ("p90", 90), ("p99", 99), ("max", 100))
+        },
+    }
+
+
+def main(argv=None):
+    """CLI — webhook load test: python -m viv_pay.storm --customers 1000 --rate 200"""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import declarative_base, sessionmaker
+
+    from .models import create_pay_models
+    from .storage import SQLAlchemyStore
+
+    parser = argparse.ArgumentParser(
+        description="Replay synthetic signed Stripe events against /pay/webhook"
+    )
+    parser.add_argument("--customers", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=100.0, help="Target events/sec")
+    parser.add_argument("--arrival", choices=("uniform", "poisson"), default="uniform")
+    parser.add_argument("--url", help="Running app to target; default is an in-process app")
+    parser.add_argument(
+        "--database-url",
+        help="The app's DB, for seeding customers and the consistency check "
+        "(in-process default: a temporary SQLite file)",
+    )
+    parser.add_argument("--secret", default=os.environ.get("STRIPE_WEBHOOK_SECRET"))
+    parser.add_argument("--webhook-path", default="/pay/webhook")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.url and not args.database_url:
+        store = None
+    else:
+        if args.database_url:
+            engine = create_engine(args.database_url)
+        else:
+            # A file, not :memory:, so each worker thread gets its own connection
+            path = os.path.join(tempfile.mkdtemp(prefix="viv-pay-storm-"), "storm.db")
+            engine = create_engine(f"sqlite:///{path}")
+        SessionLocal = sessionmaker(bind=engine)
+        Base = declarative_base()
+
+        def get_db():
+            db = SessionLocal()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        if args.url:
+            models = create_pay_models(Base)
+            Base.metadata.create_all(bind=engine)
+            store = SQLAlchemyStore(get_db, *models)
+        else:
+            from fastapi import FastAPI
+
+            from . import init_pay
+
+            app = FastAPI()
+            init_pay(app, engine, Base, get_db, app_name="storm")
+            store = app.state.pay_store
+
+    logging.basicConfig(level=logging.WARNING)
+    sequences, expected = generate_events(args.customers, seed=args.seed)
+    events = interleave(sequences)
+    if store is not None:
+        seed_customers(store, args.customers)
+
+    report = asyncio.run(
+        run_storm(
+            events,
+            args.rate,
+            app=None if args.url else app,
+            url=args.url,
+            arrival=args.arrival,
+            secret=args.secret,
+            webhook_path=args.webhook_path,
+            seed=args.seed,
+        )
+    )
+    if store is not None:
+        report["consistency"] = check_consistency(store, expected)
+    print(json.dumps(report, indent=2))
+    consistent = store is None or not report["consistency"]["mismatches"]
+    return 0 if consistent and not report["error_rate"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
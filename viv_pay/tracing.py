@@ -0,0 +1,199 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from fastapi.routing import APIRoute
+
+# Innermost open viv-pay span, and the Server-Timing collector of the
+# current request (a list of (phase, seconds)) when one is being built.
+_current: ContextVar["Span | None"] = ContextVar("viv_pay_span", default=None)
+_timings: ContextVar[list | None] = ContextVar("viv_pay_timings", default=None)
+
+
+def _otel_tracer():
+    try:
+        from opentelemetry import trace
+    except ImportError:
+        return None
+    return trace.get_tracer("viv-pay")
+
+
+class Span:
+    """A viv-pay span as seen by the in-memory exporter.
+
+    `duration` is in seconds; `error` is the exception type name, if any.
+    """
+
+    __slots__ = ("name", "phase", "attributes", "parent", "start", "end", "error", "_otel")
+
+    def __init__(self, name: str, phase: str | None, attributes: dict, parent: "Span | None"):
+        self.name = name
+        self.phase = phase
+        self.attributes = attributes
+        self.parent = parent
+        self.start = time.perf_counter()
+        self.end = None
+        self.error = None
+        self._otel = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+        if self._otel is not None:
+            self._otel.set_attribute(key, value)
+
+    def __repr__(self):
+        return f"Span({self.name!r}, {self.duration * 1000:.1f}ms)"
+
+
+class InMemorySpanExporter:
+    """Collects finished spans in a list, for tests."""
+
+    def __init__(self):
+        self.spans: list[Span] = []
+
+    def export(self, span: Span):
+        self.spans.append(span)
+
+    def names(self) -> list[str]:
+        return [span.name for span in self.spans]
+
+    def clear(self):
+        self.spans.clear()
+
+
+class PayTracer:
+    """Spans around viv-pay routes, DB queries, Stripe calls and webhooks.
+
+    Spans go to OpenTelemetry when `opentelemetry-api` is installed (and
+    `otel` is left on), to `exporter` if given, and into the Server-Timing
+    breakdown of the current request. With none of these active, `span()`
+    does no work beyond a couple of lookups.
+    """
+
+    def __init__(self, exporter: InMemorySpanExporter | None = None, otel: bool = True):
+        self.exporter = exporter
+        self._otel = _otel_tracer() if otel else None
+
+    @property
+    def recording(self) -> bool:
+        return self.exporter is not None or self._otel is not None or _timings.get() is not None
+
+    @contextmanager
+    def span(self, name: str, phase: str | None = None, **attributes):
+        """Open a span; `phase` names its entry in the Server-Timing header."""
+        if not self.recording:
+            yield None
+            return
+        span = Span(name, phase, attributes, _current.get())
+        token = _current.set(span)
+        otel_cm = None
+        if self._otel is not None:
+            otel_cm = self._otel.start_as_current_span(name, attributes=attributes)
+            span._otel = otel_cm.__enter__()
+        error = None
+        try:
+            yield span
+        except BaseException as exc:
+            error = exc
+            raise
+        finally:
+            span.end = time.perf_counter()
+            _current.reset(token)
+            if error is not None:
+                span.error = type(error).__name__
+            if otel_cm is not None:
+                if error is None:
+                    otel_cm.__exit__(None, None, None)
+                else:
+                    otel_cm.__exit__(type(error), error, error.__traceback__)
+            timings = _timings.get()
+            if timings is not None and phase is not None:
+                timings.append((phase, span.end - span.start))
+            if self.exporter is not None:
+                self.exporter.export(span)
+
+    @contextmanager
+    def request(self, name: str, server_timing: bool = False, **attributes):
+        """Root span for a viv-pay route; yields the (phase, seconds) list."""
+        timings: list = []
+        token = _timings.set(timings) if server_timing else None
+        start = time.perf_counter()
+        try:
+            with self.span(name, **attributes):
+                yield timings
+        finally:
+            if token is not None:
+                _timings.reset(token)
+            timings.append(("total", time.perf_counter() - start))
+
+
+def server_timing_header(timings: list) -> str:
+    """`db;dur=1.2, stripe.customer.create;dur=310.4, total;dur=315.0`.
+
+    Durations of the same phase are summed, in order of first appearance.
+    """
+    totals: dict[str, float] = {}
+    for phase, seconds in timings:
+        totals[phase] = totals.get(phase, 0.0) + seconds
+    return ", ".join(f"{phase};dur={seconds * 1000:.1f}" for phase, seconds in totals.items())
+
+
+def instrument_engine(engine, tracer: PayTracer):
+    """Trace each query run on `engine` inside a viv-pay span.
+
+    Queries outside one (the app's own) are left alone.
+    """
+    from sqlalchemy import event
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is None or _current.get() is None:
+            return
+        cm = tracer.span("db.query", phase="db", **{"db.statement": statement[:500]})
+        cm.__enter__()
+        context._viv_pay_span = cm
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        cm = getattr(context, "_viv_pay_span", None)
+        if cm is not None:
+            context._viv_pay_span = None
+            cm.__exit__(None, None, None)
+
+    def handle_error(exception_context):
+        context = exception_context.execution_context
+        cm = getattr(context, "_viv_pay_span", None)
+        if cm is not None:
+            context._viv_pay_span = None
+            exc = exception_context.original_exception
+            cm.__exit__(type(exc), exc, exc.__traceback__)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(engine, "handle_error", handle_error)
+
+
+def create_traced_route_class(tracer: PayTracer, server_timing: bool = False):
+    """APIRoute subclass that wraps each viv-pay route in a root span.
+
+    With `server_timing`, successful responses carry a Server-Timing header
+    with the per-phase breakdown of the request.
+    """
+
+    class TracedRoute(APIRoute):
+        def get_route_handler(self):
+            handler = super().get_route_handler()
+            name = f"{'/'.join(sorted(self.methods))} {self.path}"
+
+            async def traced_handler(request):
+                with tracer.request(name, server_timing, **{"http.route": self.path}) as timings:
+                    response = await handler(request)
+                if server_timing:
+                    response.headers["Server-Timing"] = server_timing_header(timings)
+                return response
+
+            return traced_handler
+
+    return TracedRoute
@@ -0,0 +1,178 @@
+from sqlalchemy import func, insert, update
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+
+# Dialects with INSERT ... ON CONFLICT and RETURNING (SQLite 3.35+)
+_ON_CONFLICT = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+# Dialects with INSERT IGNORE / ON DUPLICATE KEY UPDATE, without RETURNING
+_ON_DUPLICATE_KEY = {"mysql": mysql.insert, "mariadb": mysql.insert}
+
+
+def _dialect(db) -> str:
+    return db.get_bind().dialect.name
+
+
+def insert_ignore(db, Model, values: dict, key: str) -> bool:
+    """INSERT `values` unless a row with the same unique `key` exists.
+
+    One statement on PostgreSQL, SQLite and MySQL. Returns whether the row
+    was inserted. Other dialects insert in a SAVEPOINT and treat an
+    IntegrityError as an existing row.
+    """
+    dialect = _dialect(db)
+    table = Model.__table__
+    if dialect in _ON_CONFLICT:
+        stmt = _ON_CONFLICT[dialect](table).values(values).on_conflict_do_nothing(
+            index_elements=[key]
+        )
+    elif dialect in _ON_DUPLICATE_KEY:
+        # IGNORE also turns other errors into warnings. Callers only pass
+        # values that are already valid, so only duplicates are skipped.
+        stmt = _ON_DUPLICATE_KEY[dialect](table).values(values).prefix_with("IGNORE")
+    else:
+        try:
+            with db.begin_nested():
+                db.execute(insert(table).values(values))
+            return True
+        except IntegrityError:
+            return False
+    return db.execute(stmt).rowcount == 1
+
+
+def insert_ignore_many(db, Model, rows: list[dict], key: str) -> int:
+    """INSERT each row unless a row with the same unique `key` exists.
+
+    On PostgreSQL and SQLite one INSERT ... ON CONFLICT DO NOTHING RETURNING
+    covers up to 1000 rows (SQLAlchemy's insertmanyvalues batching), and the
+    returned keys give the count. MySQL runs one INSERT IGNORE executemany.
+    Other dialects fall back to insert_ignore per row. All rows must have
+    the same columns. Returns the number of rows inserted.
+    """
+    if not rows:
+        return 0
+    dialect = _dialect(db)
+    table = Model.__table__
+    if dialect in _ON_CONFLICT:
+        stmt = (
+            _ON_CONFLICT[dialect](table)
+            .on_conflict_do_nothing(index_elements=[key])
+            .returning(table.c[key])
+        )
+        return len(db.execute(stmt, rows).all())
+    if dialect in _ON_DUPLICATE_KEY:
+        return db.execute(_ON_DUPLICATE_KEY[dialect](table).prefix_with("IGNORE"), rows).rowcount
+    return sum(insert_ignore(db, Model, row, key) for row in rows)
+
+
+def insert_or_get(db, Model, values: dict, key: str):
+    """INSERT `values`, or keep the row that already has the same unique `key`.
+
+    Returns that row as an ORM instance. On PostgreSQL and SQLite this is a
+    single statement: a no-op ON CONFLICT DO UPDATE makes RETURNING produce
+    the existing row too. MySQL needs a primary-key lookup afterwards, and
+    other dialects a lookup by `key`.
+    """
+    dialect = _dialect(db)
+    if dialect in _ON_CONFLICT:
+        stmt = _ON_CONFLICT[dialect](Model).values(values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[key], set_={key: stmt.excluded[key]}
+        ).returning(Model)
+        return db.scalars(stmt, execution_options={"populate_existing": True}).one()
+    if dialect in _ON_DUPLICATE_KEY:
+        table = Model.__table__
+        # LAST_INSERT_ID(id) makes lastrowid the existing row's id on a duplicate
+        stmt = (
+            _ON_DUPLICATE_KEY[dialect](table)
+            .values(values)
+            .on_duplicate_key_update(id=func.last_insert_id(table.c.id))
+        )
+        return db.get(Model, db.execute(stmt).lastrowid)
+    insert_ignore(db, Model, values, key)
+    return db.query(Model).filter(getattr(Model, key) == values[key]).one()
+
+
+def upsert(db, Model, rows: list[dict], key: str, newer: str | None = None) -> int:
+    """INSERT each row, or overwrite the other columns of the row with the same `key`.
+
+    One executemany on PostgreSQL, SQLite and MySQL; all rows must have the
+    same columns. Other dialects fall back to insert-or-update per row.
+
+    With `newer`, an existing row is only overwritten if its `newer` column
+    is <= the incoming value, checked in the same statement (ON CONFLICT
+    DO UPDATE ... WHERE; on MySQL each assignment is an IF), so a
+    concurrent writer with a later value is never overwritten by an earlier
+    one. Returns the driver's rowcount: 0 for a single row means a newer
+    one was kept, except on MySQL, which also counts rows left unchanged.
+    """
+    if not rows:
+        return 0
+    dialect = _dialect(db)
+    table = Model.__table__
+    columns = [name for name in rows[0] if name != key]
+    if newer is not None:
+        # MySQL assigns left to right: the guard column must change last
+        columns = [name for name in columns if name != newer] + [newer]
+    if dialect in _ON_CONFLICT:
+        stmt = _ON_CONFLICT[dialect](table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[key],
+            set_={name: stmt.excluded[name] for name in columns},
+            where=None if newer is None else table.c[newer] <= stmt.excluded[newer],
+        )
+    elif dialect in _ON_DUPLICATE_KEY:
+        stmt = _ON_DUPLICATE_KEY[dialect](table)
+        if newer is None:
+            values = {name: stmt.inserted[name] for name in columns}
+        else:
+            guard = table.c[newer] <= stmt.inserted[newer]
+            values = {
+                name: func.if_(guard, stmt.inserted[name], table.c[name]) for name in columns
+            }
+        stmt = stmt.on_duplicate_key_update(values)
+    else:
+        written = 0
+        for row in rows:
+            if insert_ignore(db, Model, row, key):
+                written += 1
+                continue
+            condition = table.c[key] == row[key]
+            if newer is not None:
+                condition &= table.c[newer] <= row[newer]
+            written += db.execute(update(table).where(condition).values(row)).rowcount
+        return written
+    return db.execute(stmt, rows[0] if len(rows) == 1 else rows).rowcount
+
+
+def increment(db, Model, rows: list[dict], keys: list[str], column: str):
+    """INSERT each row, or add its `column` to the row with the same unique `keys`.
+
+    One executemany on PostgreSQL, SQLite and MySQL; the addition happens in
+    the database, so concurrent writers do not lose each other's amounts.
+    Other dialects fall back to insert-or-update per row.
+    """
+    if not rows:
+        return
+    dialect = _dialect(db)
+    table = Model.__table__
+    if dialect in _ON_CONFLICT:
+        stmt = _ON_CONFLICT[dialect](table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=keys, set_={column: table.c[column] + stmt.excluded[column]}
+        )
+    elif dialect in _ON_DUPLICATE_KEY:
+        stmt = _ON_DUPLICATE_KEY[dialect](table)
+        stmt = stmt.on_duplicate_key_update({column: table.c[column] + stmt.inserted[column]})
+    else:
+        for row in rows:
+            try:
+                with db.begin_nested():
+                    db.execute(insert(table).values(row))
+            except IntegrityError:
+                db.execute(
+                    update(table)
+                    .where(*(table.c[key] == row[key] for key in keys))
+                    .values({column: table.c[column] + row[column]})
+                )
+        return
+    db.execute(stmt, rows)
@@ -0,0 +1,294 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import timedelta
+
+from sqlalchemy import delete, select, update
+from starlette.concurrency import run_in_threadpool
+
+from .config import is_dev_mode
+from .models import utcnow
+from .upsert import increment
+
+logger = logging.getLogger("viv-pay")
+
+
+class UsageRecorder:
+    """Buffered usage metering: memory -> `usage_records` -> Stripe meter events.
+
+    `record()` is the hot path: one deque append, no lock, no I/O. The deque
+    is a ring buffer of `buffer_size` entries; if flushing falls behind, the
+    oldest entries are overwritten and counted in `dropped`.
+
+    `flush()` drains the buffer, sums quantities per (user, meter, window)
+    and adds the totals to that window's open row (one upsert per batch),
+    so workers flushing every second share one row per window. `push()`
+    claims the open rows, which freezes their quantity, and sends each as
+    one billing meter event with the row id as the event identifier, so a
+    retried push is deduplicated by Stripe. Usage flushed into a window
+    after its row was claimed opens a new row and is sent by the next push.
+    No transaction is held open across the Stripe calls. Stripe's meter
+    event API takes one event per request, so a push makes one call per row,
+    i.e. per active (user, meter, window); a longer `window` means fewer
+    calls. Pushed rows older than `retention_days` are deleted. In dev mode
+    nothing is sent and rows are deleted once their window is older than
+    `retention_days`. Both run from `run()`, which init_pay
+    starts in the app lifespan; with `push_interval` None, `run()` only
+    flushes and pushing is left to the caller (init_pay schedules it on one
+    worker through JobScheduler). With a `writer` (SQLiteWriter) the writes
+    run on the writer thread; the Stripe calls never do.
+    """
+
+    def __init__(
+        self,
+        get_db,
+        UsageRecord,
+        StripeCustomer,
+        gateway=None,
+        buffer_size: int = 100_000,
+        window: int = 60,
+        flush_interval: float = 1.0,
+        push_interval: float | None = 60.0,
+        batch_size: int = 500,
+        retention_days: float = 7,
+        writer=None,
+    ):
+        self.get_db = get_db
+        self.UsageRecord = UsageRecord
+        self.StripeCustomer = StripeCustomer
+        self.gateway = gateway
+        self.window = window
+        self.flush_interval = flush_interval
+        self.push_interval = push_interval
+        self.batch_size = batch_size
+        self.retention_days = retention_days
+        self.writer = writer
+        self._buffer: deque = deque(maxlen=buffer_size)
+        self.recorded = 0
+        self.dropped = 0
+        self.flushed = 0
+        self.pushed = 0
+        self.pruned = 0
+        self._task: asyncio.Task | None = None
+
+    def record(self, user_id: int, meter: str, quantity: int = 1, timestamp: float | None = None):
+        """Record usage for one user. Constant time; never blocks or raises on overflow."""
+        buffer = self._buffer
+        if len(buffer) == buffer.maxlen:
+            self.dropped += 1
+        buffer.append((user_id, meter, quantity, time.time() if timestamp is None else timestamp))
+        self.recorded += 1
+
+    def _write(self, fn):
+        """Run `fn(db)` and commit it, on the writer if there is one."""
+        if self.writer is not None:
+            return self.writer.write(fn)
+        db = next(self.get_db())
+        try:
+            result = fn(db)
+            db.commit()
+            return result
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _drain(self) -> dict[tuple[int, str, int], int]:
+        totals: dict[tuple[int, str, int], int] = {}
+        window = self.window
+        popleft = self._buffer.popleft
+        while True:
+            try:
+                user_id, meter, quantity, ts = popleft()
+            except IndexError:
+                return totals
+            key = (user_id, meter, int(ts // window) * window)
+            totals[key] = totals.get(key, 0) + quantity
+
+    def flush(self) -> int:
+        """Add buffered usage to `usage_records`. Returns rows written."""
+        totals = self._drain()
+        if not totals:
+            return 0
+        rows = [
+            {
+                "user_id": user_id,
+                "meter": meter,
+                "window_start": window_start,
+                "quantity": quantity,
+                "push_key": 0,
+            }
+            for (user_id, meter, window_start), quantity in totals.items()
+        ]
+        keys = ["user_id", "meter", "window_start", "push_key"]
+
+        def add_totals(db):
+            for i in range(0, len(rows), self.batch_size):
+                increment(db, self.UsageRecord, rows[i : i + self.batch_size], keys, "quantity")
+
+        try:
+            self._write(add_totals)
+        except Exception:
+            # Put the totals back so the next flush retries them; appendleft
+            # into a full buffer evicts the newest entry, which is a drop too
+            buffer = self._buffer
+            for (user_id, meter, window_start), quantity in totals.items():
+                if len(buffer) == buffer.maxlen:
+                    self.dropped += 1
+                buffer.appendleft((user_id, meter, quantity, window_start))
+            raise
+        self.flushed += len(rows)
+        return len(rows)
+
+    def _claim(self) -> list:
+        """Claim a batch of open rows and return claimed, unpushed rows to send.
+
+        Claiming sets push_key to the row id in its own short transaction;
+        later flushes into the same window open a new row instead. Rows
+        claimed by a push that failed midway are returned again, unchanged.
+        """
+        UsageRecord, StripeCustomer = self.UsageRecord, self.StripeCustomer
+        # Usage of users without a Stripe customer waits until one exists
+        customer = StripeCustomer.user_id == UsageRecord.user_id
+
+        def claim(db):
+            open_ids = db.scalars(
+                select(UsageRecord.id)
+                .join(StripeCustomer, customer)
+                .where(UsageRecord.push_key == 0)
+                .order_by(UsageRecord.id)
+                .limit(self.batch_size)
+            ).all()
+            if open_ids:
+                db.execute(
+                    update(UsageRecord)
+                    .where(UsageRecord.id.in_(open_ids), UsageRecord.push_key == 0)
+                    .values(push_key=UsageRecord.id)
+                )
+
+        self._write(claim)
+        db = next(self.get_db())
+        try:
+            return db.execute(
+                select(
+                    UsageRecord.id,
+                    UsageRecord.meter,
+                    UsageRecord.window_start,
+                    UsageRecord.quantity,
+                    StripeCustomer.stripe_customer_id,
+                )
+                .join(StripeCustomer, customer)
+                .where(UsageRecord.push_key != 0, UsageRecord.pushed_at.is_(None))
+                .order_by(UsageRecord.id)
+                .limit(self.batch_size)
+            ).all()
+        finally:
+            db.close()
+
+    def _mark_pushed(self, ids: list[int]):
+        UsageRecord = self.UsageRecord
+        self._write(
+            lambda db: db.execute(
+                update(UsageRecord).where(UsageRecord.id.in_(ids)).values(pushed_at=utcnow())
+            )
+        )
+
+    def prune(self) -> int:
+        """Delete rows pushed more than `retention_days` ago. Returns rows deleted.
+
+        In dev mode rows are never pushed, so rows whose window ended more
+        than `retention_days` ago are deleted instead.
+        """
+        UsageRecord = self.UsageRecord
+        cutoff = utcnow() - timedelta(days=self.retention_days)
+        if is_dev_mode():
+            expired = UsageRecord.window_start < int(cutoff.timestamp()) - self.window
+        else:
+            expired = UsageRecord.pushed_at < cutoff
+        deleted = self._write(lambda db: db.execute(delete(UsageRecord).where(expired)).rowcount)
+        self.pruned += deleted
+        return deleted
+
+    def push(self) -> int:
+        """Send unpushed usage totals to Stripe. Returns rows pushed."""
+        if is_dev_mode():
+            self.prune()
+            return 0
+        import stripe
+
+        pushed = 0
+        try:
+            while True:
+                batch = self._claim()
+                if not batch:
+                    break
+                sent = []
+                try:
+                    for row_id, meter, window_start, quantity, stripe_customer_id in batch:
+                        self.gateway.call(
+                            "billing.meter_event.create",
+                            stripe.billing.MeterEvent.create,
+                            idempotent=True,
+                            event_name=meter,
+                            identifier=f"viv-pay-usage-{row_id}",
+                            timestamp=window_start,
+                            payload={
+                                "stripe_customer_id": stripe_customer_id,
+                                "value": str(quantity),
+                            },
+                        )
+                        sent.append(row_id)
+                finally:
+                    # Keep the rows already sent marked, even if a later one failed
+                    if sent:
+                        self._mark_pushed(sent)
+                        pushed += len(sent)
+        finally:
+            self.pushed += pushed
+        if pushed:
+            logger.info("[viv-pay] Pushed %d usage record(s) to Stripe", pushed)
+        self.prune()
+        return pushed
+
+    def stats(self) -> dict:
+        return {
+            "buffered": len(self._buffer),
+            "recorded": self.recorded,
+            "dropped": self.dropped,
+            "flushed": self.flushed,
+            "pushed": self.pushed,
+            "pruned": self.pruned,
+        }
+
+    async def run(self):
+        last_push = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await run_in_threadpool(self.flush)
+                if (
+                    self.push_interval is not None
+                    and time.monotonic() - last_push >= self.push_interval
+                ):
+                    last_push = time.monotonic()
+                    await run_in_threadpool(self.push)
+            except Exception:
+                logger.exception("[viv-pay] Usage flush/push failed")
+
+    async def start(self):
+        self._task = asyncio.create_task(self.run(), name="viv-pay-usage")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await run_in_threadpool(self.flush)
+        except Exception:
+            logger.exception("[viv-pay] Final usage flush failed")
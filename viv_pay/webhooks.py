@@ -1,17 +1,437 @@
+import asyncio
+import functools
+import inspect
 import json
 import logging
+import os
+import queue
+import struct
+import threading
+import time
+import uuid
+import zlib
+from contextlib import nullcontext
 from datetime import datetime, timezone
+from pathlib import Path
 
 from fastapi import Request
 from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
 
 from .config import get_stripe_webhook_secret, is_dev_mode
+from .log import log_duration
+from .storage import PayStore
 
 logger = logging.getLogger("viv-pay")
 
 
-def create_webhook_handler(get_db, StripeCustomer, Subscription, Payment):
-    """Factory — creates the Stripe webhook endpoint handler."""
+class WebhookRegistry:
+    """Maps Stripe event types to handlers.
+
+    Handlers are called as `handler(db, data, event)` and may be plain
+    functions (run in the threadpool, so blocking DB work does not stall the
+    event loop) or coroutines. Several handlers can share an event type; they
+    run in registration order on one session. A session is only opened when
+    at least one handler for the type was registered with `needs_db=True`;
+    event types without handlers are acked without touching the pool.
+    With a `tracer`, each handler run is a "webhook.<handler name>" span.
+    """
+
+    def __init__(self, tracer=None):
+        self._handlers: dict[str, list[tuple[str, object, bool]]] = {}
+        self._timing_hooks = []
+        self.tracer = tracer
+
+    def register(self, event_type: str, handler, needs_db: bool = True, name: str | None = None):
+        name = name or getattr(handler, "__name__", repr(handler))
+        self._handlers.setdefault(event_type, []).append((name, handler, needs_db))
+
+    def on(self, event_type: str, needs_db: bool = True):
+        """Decorator form of `register`."""
+
+        def decorator(handler):
+            self.register(event_type, handler, needs_db)
+            return handler
+
+        return decorator
+
+    def handles(self, event_type: str) -> bool:
+        return bool(self._handlers.get(event_type))
+
+    def event_types(self) -> list[str]:
+        return sorted(t for t, handlers in self._handlers.items() if handlers)
+
+    def add_timing_hook(self, hook):
+        """Register `hook(event_type, handler_name, seconds, error)`.
+
+        Called after every handler run; `error` is the exception or None.
+        """
+        self._timing_hooks.append(hook)
+
+    def _report(self, event_type, name, seconds, error):
+        for hook in self._timing_hooks:
+            try:
+                hook(event_type, name, seconds, error)
+            except Exception:
+                logger.exception("[viv-pay] Webhook timing hook failed")
+
+    def _span(self, name: str, event_type: str):
+        if self.tracer is None:
+            return nullcontext()
+        return self.tracer.span(
+            f"webhook.{name}", phase="webhook", **{"stripe.event_type": event_type}
+        )
+
+    def _run_sync(self, handlers, event_type: str, data, event, db):
+        """Run sync `handlers` in order on `db`, on the current thread."""
+        for name, handler, needs_db in handlers:
+            start = time.perf_counter()
+            try:
+                with self._span(name, event_type):
+                    handler(db if needs_db else None, data, event)
+            except Exception as exc:
+                self._report(event_type, name, time.perf_counter() - start, exc)
+                raise
+            self._report(event_type, name, time.perf_counter() - start, None)
+
+    async def dispatch(self, store: PayStore, event_type: str, data, event) -> bool:
+        """Run the handlers for `event_type`. Returns False if there are none.
+
+        With a store writer, an event whose handlers are all sync runs as one
+        write on the writer thread. Its changes are committed with the
+        writer's batch, after the handlers return; handlers that publish
+        state outside the database defer that with store.after_commit().
+        """
+        handlers = self._handlers.get(event_type)
+        if not handlers:
+            return False
+
+        needs_session = any(needs_db for _, _, needs_db in handlers)
+        if (
+            needs_session
+            and store.writer is not None
+            and not any(inspect.iscoroutinefunction(handler) for _, handler, _ in handlers)
+        ):
+            run = functools.partial(self._run_sync, handlers, event_type, data, event)
+            await asyncio.wrap_future(store.writer.submit(run))
+            return True
+
+        with store.session() if needs_session else nullcontext() as db:
+            for name, handler, needs_db in handlers:
+                start = time.perf_counter()
+                try:
+                    session = db if needs_db else None
+                    with self._span(name, event_type):
+                        if inspect.iscoroutinefunction(handler):
+                            await handler(session, data, event)
+                        else:
+                            result = await run_in_threadpool(handler, session, data, event)
+                            if inspect.isawaitable(result):
+                                await result
+                except Exception as exc:
+                    self._report(event_type, name, time.perf_counter() - start, exc)
+                    raise
+                self._report(event_type, name, time.perf_counter() - start, None)
+        return True
+
+
+def event_to_dict(event) -> dict:
+    """Plain dict for a Stripe event; StripeObject is not a dict subclass."""
+    if isinstance(event, dict):
+        return event
+    return event.to_dict()
+
+
+def _bind(handler, store):
+    """Adapt a built-in `_handle_*(db, data, store, event)` to the registry signature."""
+
+    @functools.wraps(handler)
+    def bound(db, data, event):
+        return handler(db, data, store, event)
+
+    return bound
+
+
+def create_default_registry(store: PayStore, tracer=None) -> WebhookRegistry:
+    """Registry preloaded with viv-pay's built-in handlers."""
+    registry = WebhookRegistry(tracer)
+    registry.register("checkout.session.completed", _bind(_handle_checkout_completed, store))
+    registry.register("customer.subscription.updated", _bind(_handle_subscription_updated, store))
+    registry.register("customer.subscription.deleted", _bind(_handle_subscription_deleted, store))
+    registry.register("invoice.payment_failed", _bind(_handle_payment_failed, store))
+    registry.register("charge.refunded", _bind(_handle_refund, store))
+    return registry
+
+
+_BLOCK_HEADER = struct.Struct("<II")  # compressed length, record count
+_RECORD_HEADER = struct.Struct("<HI")  # event id length, payload length
+
+
+def _segment_number(name: str) -> int:
+    return int(name.split("-")[1])
+
+
+class WebhookArchive:
+    """Append-only archive of raw webhook bodies, as received.
+
+    Payloads are framed into blocks of roughly `block_bytes`, each block is
+    zlib-compressed and appended to the current segment file, and segments
+    rotate at `segment_bytes`. Every segment has a text sidecar index
+    (`<event id>\t<block offset>` per line) so `get()` reads and inflates a
+    single block.
+
+    Several workers can share one directory: each process writes only its
+    own segments, named `webhooks-<number>-<writer>.seg`, so block offsets
+    in an index always refer to that process's writes.
+
+    `append()` only enqueues; a background thread does the compression and
+    file writes. When the queue is full the payload is dropped and counted
+    rather than slowing the webhook down. Buffered records are written out
+    every `flush_interval` seconds, on `flush()` and on `close()`. A block
+    that cannot be written is logged, counted in `failed` and dropped, and
+    the writer moves on to a fresh segment.
+    """
+
+    def __init__(
+        self,
+        directory: str | os.PathLike,
+        segment_bytes: int = 64 * 1024 * 1024,
+        block_bytes: int = 256 * 1024,
+        flush_interval: float = 1.0,
+        max_queue: int = 10000,
+        level: int = 6,
+    ):
+        self.dir = Path(directory)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.segment_bytes = segment_bytes
+        self.block_bytes = block_bytes
+        self.flush_interval = flush_interval
+        self.level = level
+        self.archived = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._index: dict[str, tuple[str, int]] | None = None
+        self._index_lock = threading.Lock()
+        # Segment files are private to this process; a restart never appends
+        # to a segment a previous process may have left torn
+        self._writer = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        existing = self.segments()
+        self._number = _segment_number(existing[-1]) + 1 if existing else 1
+        self._segment = self._segment_name(self._number)
+        self._seg_file = None
+        self._idx_file = None
+        self._block: list[tuple[str, bytes]] = []
+        self._block_size = 0
+        self._thread = threading.Thread(target=self._run, name="viv-pay-webhook-archive", daemon=True)
+        self._thread.start()
+
+    def _segment_name(self, number: int) -> str:
+        return f"webhooks-{number:06d}-{self._writer}"
+
+    def _seg_path(self, segment: str) -> Path:
+        return self.dir / f"{segment}.seg"
+
+    def segments(self) -> list[str]:
+        """Segment names of every writer, oldest first."""
+        names = (p.stem for p in self.dir.glob("webhooks-*.seg"))
+        return sorted(names, key=lambda name: (_segment_number(name), name))
+
+    # Writing
+
+    def append(self, event_id: str, payload: bytes) -> bool:
+        """Queue one raw body for archiving. Never blocks; False if dropped."""
+        try:
+            self._queue.put_nowait((event_id, payload))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self._try_write_block()
+                continue
+            try:
+                if item is None:
+                    self._try_write_block()
+                    return
+                if isinstance(item, threading.Event):
+                    self._try_write_block()
+                    item.set()
+                    continue
+                event_id, payload = item
+                self._block.append((event_id, payload))
+                self._block_size += _RECORD_HEADER.size + len(event_id) + len(payload)
+                if self._block_size >= self.block_bytes:
+                    self._try_write_block()
+            finally:
+                self._queue.task_done()
+
+    def _try_write_block(self):
+        """Write the pending block; on error drop it and rotate the segment.
+
+        Never raises, so the thread survives disk errors and flush()/close()
+        always return.
+        """
+        try:
+            self._write_block()
+        except Exception:
+            self.failed += len(self._block)
+            logger.exception(
+                "[viv-pay] Webhook archive write failed; dropped %d record(s)", len(self._block)
+            )
+            self._block = []
+            self._block_size = 0
+            # The segment may end in a partial block; continue in a new one
+            for f in (self._seg_file, self._idx_file):
+                try:
+                    if f is not None:
+                        f.close()
+                except OSError:
+                    pass
+            self._seg_file = self._idx_file = None
+            self._number += 1
+            self._segment = self._segment_name(self._number)
+
+    def _write_block(self):
+        if not self._block:
+            return
+        raw = bytearray()
+        for event_id, payload in self._block:
+            key = event_id.encode()
+            raw += _RECORD_HEADER.pack(len(key), len(payload))
+            raw += key
+            raw += payload
+        compressed = zlib.compress(bytes(raw), self.level)
+
+        if self._seg_file is None:
+            self._seg_file = open(self._seg_path(self._segment), "ab")
+            self._idx_file = open(self._seg_path(self._segment).with_suffix(".idx"), "a")
+        offset = self._seg_file.tell()
+        self._seg_file.write(_BLOCK_HEADER.pack(len(compressed), len(self._block)))
+        self._seg_file.write(compressed)
+        self._seg_file.flush()
+        self._idx_file.write("".join(f"{event_id}\t{offset}\n" for event_id, _ in self._block))
+        self._idx_file.flush()
+
+        with self._index_lock:
+            if self._index is not None:
+                for event_id, _ in self._block:
+                    self._index[event_id] = (self._segment, offset)
+        self.archived += len(self._block)
+        self._block = []
+        self._block_size = 0
+
+        if offset + _BLOCK_HEADER.size + len(compressed) >= self.segment_bytes:
+            self._seg_file.close()
+            self._idx_file.close()
+            self._seg_file = self._idx_file = None
+            self._number += 1
+            self._segment = self._segment_name(self._number)
+
+    def flush(self, timeout: float | None = None):
+        """Block until everything appended so far is on disk."""
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._seg_file is not None:
+            self._seg_file.close()
+            self._idx_file.close()
+            self._seg_file = self._idx_file = None
+
+    # Reading
+
+    def _load_index(self, reload: bool = False) -> dict[str, tuple[str, int]]:
+        with self._index_lock:
+            if self._index is None or reload:
+                index = {}
+                for segment in self.segments():
+                    idx_path = self._seg_path(segment).with_suffix(".idx")
+                    if not idx_path.exists():
+                        continue
+                    with open(idx_path) as f:
+                        for line in f:
+                            event_id, _, offset = line.rstrip("\n").partition("\t")
+                            if offset:
+                                index[event_id] = (segment, int(offset))
+                self._index = index
+            return self._index
+
+    @staticmethod
+    def _read_block(f):
+        header = f.read(_BLOCK_HEADER.size)
+        if len(header) < _BLOCK_HEADER.size:
+            return None
+        length, count = _BLOCK_HEADER.unpack(header)
+        data = f.read(length)
+        if len(data) < length:
+            return None  # torn tail from a crash
+        raw = zlib.decompress(data)
+        records = []
+        pos = 0
+        for _ in range(count):
+            key_len, payload_len = _RECORD_HEADER.unpack_from(raw, pos)
+            pos += _RECORD_HEADER.size
+            event_id = raw[pos : pos + key_len].decode()
+            pos += key_len
+            records.append((event_id, raw[pos : pos + payload_len]))
+            pos += payload_len
+        return records
+
+    def get(self, event_id: str) -> bytes | None:
+        """Raw body of one archived event, or None."""
+        location = self._load_index().get(event_id)
+        if location is None:
+            # Possibly written by another worker since the index was loaded
+            location = self._load_index(reload=True).get(event_id)
+        if location is None:
+            return None
+        segment, offset = location
+        with open(self._seg_path(segment), "rb") as f:
+            f.seek(offset)
+            for record_id, payload in self._read_block(f) or ():
+                if record_id == event_id:
+                    return payload
+        return None
+
+    def iter_payloads(self, segments=None):
+        """Yield (event_id, raw body) in arrival order, one block in memory at a time."""
+        for segment in segments if segments is not None else self.segments():
+            with open(self._seg_path(segment), "rb") as f:
+                while (records := self._read_block(f)) is not None:
+                    yield from records
+
+    def stats(self) -> dict:
+        return {
+            "archived": self.archived,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "queued": self._queue.qsize(),
+            "segment": self._segment,
+        }
+
+
+def create_webhook_handler(
+    store: PayStore,
+    registry: WebhookRegistry | None = None,
+    archive: WebhookArchive | None = None,
+):
+    """Factory — creates the Stripe webhook endpoint handler.
+
+    With `archive`, every verified body is queued for the raw payload archive
+    before dispatch.
+    """
+    if registry is None:
+        registry = create_default_registry(store)
 
     async def handle_stripe_webhook(request: Request):
         payload = await request.body()
@@ -23,8 +443,8 @@ def create_webhook_handler(get_db, StripeCustomer, Subscription, Payment):
             except (json.JSONDecodeError, Exception):
                 logger.warning("[viv-pay] DEV MODE — invalid webhook payload")
                 return JSONResponse({"error": "invalid payload"}, status_code=400)
-            logger.info(
-                f"[viv-pay] DEV MODE — webhook received: {event.get('type', 'unknown')}"
+            logger.debug(
+                "[viv-pay] DEV MODE — webhook received: %s", event.get("type", "unknown")
             )
         else:
             import stripe
@@ -42,160 +462,164 @@ def create_webhook_handler(get_db, StripeCustomer, Subscription, Payment):
             except stripe.SignatureVerificationError:
                 logger.warning("[viv-pay] Webhook signature verification failed")
                 return JSONResponse({"error": "invalid signature"}, status_code=400)
+            event = event_to_dict(event)
+
+        event_type = event.get("type", "")
+
+        if archive is not None and event.get("id"):
+            archive.append(event["id"], payload)
+
+        # Ack ignored event types before any DB work
+        if not registry.handles(event_type):
+            logger.debug(
+                "[viv-pay] Unhandled webhook event: %s", event_type,
+                extra={"event_type": event_type},
+            )
+            return JSONResponse({"received": True})
 
-        event_type = event.get("type", "") if isinstance(event, dict) else event["type"]
-        data_obj = event.get("data", {}).get("object", {}) if isinstance(event, dict) else event["data"]["object"]
+        data_obj = event.get("data", {}).get("object", {})
 
-        db = next(get_db())
+        start = time.perf_counter()
         try:
-            if event_type == "checkout.session.completed":
-                _handle_checkout_completed(db, data_obj, StripeCustomer, Subscription, Payment)
-            elif event_type == "customer.subscription.updated":
-                _handle_subscription_updated(db, data_obj, Subscription)
-            elif event_type == "customer.subscription.deleted":
-                _handle_subscription_deleted(db, data_obj, Subscription)
-            elif event_type == "invoice.payment_failed":
-                _handle_payment_failed(db, data_obj, StripeCustomer, Subscription)
-            elif event_type == "charge.refunded":
-                _handle_refund(db, data_obj, StripeCustomer, Payment)
-            else:
-                logger.info(f"[viv-pay] Unhandled webhook event: {event_type}")
+            await registry.dispatch(store, event_type, data_obj, event)
         except Exception:
-            logger.exception(f"[viv-pay] Error processing webhook {event_type}")
-            db.rollback()
+            logger.exception(
+                "[viv-pay] Error processing webhook %s", event_type,
+                extra={"event_type": event_type},
+            )
             return JSONResponse({"error": "processing failed"}, status_code=500)
-        finally:
-            db.close()
 
+        log_duration(
+            logger, logging.DEBUG, "[viv-pay] Webhook %s handled", event_type,
+            start=start, event_type=event_type,
+        )
         return JSONResponse({"received": True})
 
     return handle_stripe_webhook
 
 
-def _handle_checkout_completed(db, data, StripeCustomer, Subscription, Payment):
+def _event_created(event) -> int | None:
+    """The event's `created` timestamp, for ordering updates to one row."""
+    return event.get("created") if event else None
+
+
+def _handle_checkout_completed(db, data, store: PayStore, event=None):
     stripe_customer_id = data.get("customer")
     session_id = data.get("id")
     mode = data.get("mode", "payment")
 
-    customer = (
-        db.query(StripeCustomer)
-        .filter(StripeCustomer.stripe_customer_id == stripe_customer_id)
-        .first()
-    )
+    customer = store.get_customer_by_stripe_id(db, stripe_customer_id)
     if not customer:
         logger.warning(
-            f"[viv-pay] Checkout completed for unknown customer {stripe_customer_id}"
+            "[viv-pay] Checkout completed for unknown customer %s", stripe_customer_id
         )
         return
 
     if mode == "subscription":
         sub_id = data.get("subscription")
-        if sub_id:
-            existing = (
-                db.query(Subscription)
-                .filter(Subscription.stripe_subscription_id == sub_id)
-                .first()
+        if sub_id and store.add_subscription_if_new(
+            db,
+            customer_id=customer.id,
+            stripe_subscription_id=sub_id,
+            stripe_price_id=data.get("metadata", {}).get("price_id", "unknown"),
+            status="active",
+        ):
+            logger.info(
+                "[viv-pay] Subscription %s created for customer %s", sub_id, customer.id,
+                extra={"user_id": customer.user_id},
             )
-            if not existing:
-                sub = Subscription(
-                    customer_id=customer.id,
-                    stripe_subscription_id=sub_id,
-                    stripe_price_id=data.get("metadata", {}).get("price_id", "unknown"),
-                    status="active",
-                )
-                db.add(sub)
-                logger.info(f"[viv-pay] Subscription {sub_id} created for customer {customer.id}")
 
     amount = data.get("amount_total", 0)
     currency = data.get("currency", "usd")
-    payment = Payment(
+    recorded = store.add_payment_if_new(
+        db,
         customer_id=customer.id,
         stripe_session_id=session_id,
+        # Set for one-off payments; lets charge.refunded find the payment
+        stripe_payment_intent_id=data.get("payment_intent"),
         amount_cents=amount,
         currency=currency,
         status="completed",
         mode=mode,
     )
-    db.add(payment)
-    db.commit()
-    logger.info(f"[viv-pay] Payment recorded: {amount} {currency} for customer {customer.id}")
+    store.commit(db)
+    if not recorded:
+        # Redelivered event (webhook retry or poller overlap)
+        logger.info("[viv-pay] Payment for session %s already recorded", session_id)
+        return
+    logger.info(
+        "[viv-pay] Payment recorded: %s %s for customer %s", amount, currency, customer.id,
+        extra={"user_id": customer.user_id},
+    )
 
 
-def _handle_subscription_updated(db, data, Subscription):
+def _handle_subscription_updated(db, data, store: PayStore, event=None):
     sub_id = data.get("id")
-    sub = (
-        db.query(Subscription)
-        .filter(Subscription.stripe_subscription_id == sub_id)
-        .first()
-    )
+    sub = store.get_subscription(db, sub_id)
     if not sub:
-        logger.warning(f"[viv-pay] Subscription update for unknown sub {sub_id}")
+        logger.warning("[viv-pay] Subscription update for unknown sub %s", sub_id)
         return
 
-    sub.status = data.get("status", sub.status)
+    fields = {"status": data.get("status", sub.status)}
+    items = (data.get("items") or {}).get("data") or []
+    if items and items[0].get("price", {}).get("id"):
+        # Plan changes arrive as a new price on the first item
+        fields["stripe_price_id"] = items[0]["price"]["id"]
     period = data.get("current_period_start")
     if period:
-        sub.current_period_start = datetime.fromtimestamp(period, tz=timezone.utc)
+        fields["current_period_start"] = datetime.fromtimestamp(period, tz=timezone.utc)
     period_end = data.get("current_period_end")
     if period_end:
-        sub.current_period_end = datetime.fromtimestamp(period_end, tz=timezone.utc)
+        fields["current_period_end"] = datetime.fromtimestamp(period_end, tz=timezone.utc)
     cancel_at = data.get("cancel_at")
-    sub.cancel_at = (
+    fields["cancel_at"] = (
         datetime.fromtimestamp(cancel_at, tz=timezone.utc) if cancel_at else None
     )
-    db.commit()
-    logger.info(f"[viv-pay] Subscription {sub_id} updated: status={sub.status}")
+    if not store.update_subscription(db, sub, event_at=_event_created(event), **fields):
+        logger.info("[viv-pay] Ignoring stale update for subscription %s", sub_id)
+        return
+    store.commit(db)
+    logger.info("[viv-pay] Subscription %s updated: status=%s", sub_id, fields["status"])
 
 
-def _handle_subscription_deleted(db, data, Subscription):
+def _handle_subscription_deleted(db, data, store: PayStore, event=None):
     sub_id = data.get("id")
-    sub = (
-        db.query(Subscription)
-        .filter(Subscription.stripe_subscription_id == sub_id)
-        .first()
-    )
+    sub = store.get_subscription(db, sub_id)
     if not sub:
-        logger.warning(f"[viv-pay] Subscription delete for unknown sub {sub_id}")
+        logger.warning("[viv-pay] Subscription delete for unknown sub %s", sub_id)
         return
 
-    sub.status = "canceled"
-    db.commit()
-    logger.info(f"[viv-pay] Subscription {sub_id} canceled")
+    if not store.update_subscription(db, sub, event_at=_event_created(event), status="canceled"):
+        logger.info("[viv-pay] Ignoring stale delete for subscription %s", sub_id)
+        return
+    store.commit(db)
+    logger.info("[viv-pay] Subscription %s canceled", sub_id)
 
 
-def _handle_payment_failed(db, data, StripeCustomer, Subscription):
+def _handle_payment_failed(db, data, store: PayStore, event=None):
     stripe_customer_id = data.get("customer")
     sub_id = data.get("subscription")
 
     if sub_id:
-        sub = (
-            db.query(Subscription)
-            .filter(Subscription.stripe_subscription_id == sub_id)
-            .first()
-        )
-        if sub:
-            sub.status = "past_due"
-            db.commit()
-            logger.info(f"[viv-pay] Subscription {sub_id} marked past_due (payment failed)")
+        sub = store.get_subscription(db, sub_id)
+        if sub and store.update_subscription(
+            db, sub, event_at=_event_created(event), status="past_due"
+        ):
+            store.commit(db)
+            logger.info("[viv-pay] Subscription %s marked past_due (payment failed)", sub_id)
     else:
         logger.warning(
-            f"[viv-pay] Payment failed for customer {stripe_customer_id}, no subscription"
+            "[viv-pay] Payment failed for customer %s, no subscription", stripe_customer_id
         )
 
 
-def _handle_refund(db, data, StripeCustomer, Payment):
+def _handle_refund(db, data, store: PayStore, event=None):
     payment_intent_id = data.get("payment_intent")
     if not payment_intent_id:
         return
 
-    payment = (
-        db.query(Payment)
-        .filter(Payment.stripe_payment_intent_id == payment_intent_id)
-        .first()
-    )
-    if payment:
-        payment.status = "refunded"
-        db.commit()
-        logger.info(f"[viv-pay] Payment {payment_intent_id} refunded")
+    if store.update_payment_by_intent(db, payment_intent_id, status="refunded"):
+        store.commit(db)
+        logger.info("[viv-pay] Payment %s refunded", payment_intent_id)
     else:
-        logger.info(f"[viv-pay] Refund for unknown payment_intent {payment_intent_id}")
+        logger.info("[viv-pay] Refund for unknown payment_intent %s", payment_intent_id)